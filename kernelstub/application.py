@@ -39,7 +39,7 @@ terms.
  kernelstub will load parameters from the /etc/default/kernelstub config file.
 """
 
-import logging, os
+import atexit, copy, logging, os, queue, time
 
 systemd_support = False
 try:
@@ -57,12 +57,317 @@ from . import opsys as Opsys
 from . import installer as Installer
 from . import config as Config
 from . import kernel_option as KernelOption
+from . import plan as Plan
+from . import transfer as Transfer
+from . import boottime as BootTime
+from . import state as State
+from . import initrd as Initrd
+from . import esp as Esp
+from . import metrics as Metrics
+from . import signing as Signing
+from . import backend as Backend
+from . import plugins as Plugins
+from . import facts as Facts
+from . import bundle as Bundle
+from . import history as History
+from .errors import KernelstubError
+
+class CmdLineError(KernelstubError):
+    exit_code = 168
+
+class ImageNotFoundError(KernelstubError):
+    # The hooks run us during package installs, so a missing image must not
+    # make the command line tool fail.
+    exit_code = 0
+
+class Options():
+    """Options for a single Kernelstub.run() call.
+
+    Paths and option strings are None when they should come from the system
+    or the configuration. setup_loader, manage_mode, low_impact and defer are
+    True or False to override the configuration, or None to keep it.
+    target_version limits the run to the ESP slot holding that kernel
+    version, and changed ('kernel' or 'initrd') to one of its artifacts.
+    export_bundle and import_bundle are paths to a bundle of prebuilt ESP
+    files to write instead of installing, or to install from.
+    """
+
+    def __init__(self, esp_path=None, root_path=None, kernel_path=None,
+                 initrd_path=None, kernel_options=None, add_options=None,
+                 remove_options=None, setup_loader=None, manage_mode=None,
+                 force_update=False, dry_run=False, print_config=False,
+                 preserve_live=False, plan_file=None, apply_plan=None,
+                 low_impact=None, record_boot=False, boot_report=False,
+                 analyze_initrd=None, esp_report=False, gc=False,
+                 defer=None, commit_pending=False, target_version=None,
+                 changed=None, export_bundle=None, import_bundle=None):
+        self.esp_path = esp_path
+        self.root_path = root_path
+        self.kernel_path = kernel_path
+        self.initrd_path = initrd_path
+        self.kernel_options = kernel_options
+        self.add_options = add_options
+        self.remove_options = remove_options
+        self.setup_loader = setup_loader
+        self.manage_mode = manage_mode
+        self.force_update = force_update
+        self.dry_run = dry_run
+        self.print_config = print_config
+        self.preserve_live = preserve_live
+        self.plan_file = plan_file
+        self.apply_plan = apply_plan
+        self.low_impact = low_impact
+        self.record_boot = record_boot
+        self.boot_report = boot_report
+        self.analyze_initrd = analyze_initrd
+        self.esp_report = esp_report
+        self.gc = gc
+        self.defer = defer
+        self.commit_pending = commit_pending
+        self.target_version = target_version
+        self.changed = changed
+        self.export_bundle = export_bundle
+        self.import_bundle = import_bundle
+
+    def pending_record(self, pending=None):
+        """Collapse this request into the pending state.
+
+        The newest request decides which images get installed; a forced
+        update stays forced until it has been committed.
+        """
+        now = int(time.time())
+        record = {
+            'first_requested' : now,
+            'requests' : 0,
+            'force_update' : False,
+        }
+        if pending is not None:
+            record['first_requested'] = pending['first_requested']
+            record['requests'] = pending['requests']
+            record['force_update'] = pending['force_update']
+        record['last_requested'] = now
+        record['requests'] = record['requests'] + 1
+        record['force_update'] = record['force_update'] or self.force_update
+        record['root_path'] = self.root_path
+        record['kernel_path'] = self.kernel_path
+        record['initrd_path'] = self.initrd_path
+        return record
+
+    def with_pending(self, pending):
+        # Paths given to --commit-pending itself win over the recorded ones.
+        options = copy.copy(self)
+        for key in ('root_path', 'kernel_path', 'initrd_path'):
+            if getattr(options, key) is None:
+                setattr(options, key, pending[key])
+        options.force_update = options.force_update or pending['force_update']
+        return options
 
-class CmdLineError(Exception):
-    pass
+    @classmethod
+    def from_args(cls, args):
+        setup_loader = None
+        if args.setup_loader:
+            setup_loader = True
+        if args.off_loader:
+            setup_loader = False
+
+        manage_mode = None
+        if args.install_stub:
+            manage_mode = False
+        if args.manage_mode:
+            manage_mode = True
+
+        return cls(
+            esp_path=args.esp_path,
+            root_path=args.root_path,
+            kernel_path=args.kernel_path,
+            initrd_path=args.initrd_path,
+            kernel_options=args.k_options,
+            add_options=args.add_options,
+            remove_options=args.remove_options,
+            setup_loader=setup_loader,
+            manage_mode=manage_mode,
+            force_update=args.force_update,
+            dry_run=args.dry_run,
+            print_config=args.print_config,
+            preserve_live=args.preserve_live,
+            plan_file=args.plan_file,
+            apply_plan=args.apply_plan,
+            low_impact=args.low_impact or None,
+            record_boot=args.record_boot,
+            boot_report=args.boot_report,
+            analyze_initrd=args.analyze_initrd,
+            esp_report=args.esp_report,
+            gc=args.gc,
+            defer=args.defer or None,
+            commit_pending=args.commit_pending,
+            target_version=args.target_version,
+            changed=args.changed,
+            export_bundle=args.export_bundle,
+            import_bundle=args.import_bundle)
+
+class Result():
+    """What a Kernelstub.run() call did.
+
+    status is 'complete', 'deferred', 'no_pending', 'up_to_date', 'live_mode',
+    'print_config', 'plan_applied', 'boot_recorded', 'boot_report',
+    'initrd_report' or 'esp_report'; report holds text for the last four.
+    files_written and nvram_changes are empty for dry runs, which describe
+    their changes in plan instead.
+    """
+
+    def __init__(self):
+        self.status = None
+        self.kernel_path = None
+        self.initrd_path = None
+        self.kernel_options = None
+        self.configuration = None
+        self.files_written = []
+        self.nvram_changes = []
+        self.plan = None
+        self.report = None
 
 class Kernelstub():
 
+    config = None
+    queue_log = None
+    backend = None
+    plugins = None
+    state_dir = '/var/lib/kernelstub'
+
+    file_levels = {
+        'warning' : logging.WARNING,
+        'info' : logging.INFO,
+        'debug' : logging.DEBUG,
+    }
+
+    def set_file_level(self, file_level):
+        # Records below both the console and file levels are dropped by the
+        # logger before any message formatting happens.
+        log = logging.getLogger('kernelstub')
+        self.queue_log.setLevel(file_level)
+        log.setLevel(min(self.console_level, file_level))
+
+    def artifact_info(self, path):
+        info = {
+            'path' : path,
+            'size' : None,
+            'mtime' : None,
+            'mtime_ns' : None,
+        }
+        try:
+            stat = os.stat(path)
+            info['size'] = stat.st_size
+            info['mtime'] = int(stat.st_mtime)
+            info['mtime_ns'] = stat.st_mtime_ns
+        except OSError:
+            pass
+        return info
+
+    def image_version(self, path):
+        name = os.path.basename(os.path.realpath(path))
+        if name.startswith('vmlinuz-'):
+            return name.split('-', 1)[1]
+        return None
+
+    def artifact_unchanged(self, record, artifact, path):
+        # Compared against what installed.json says was copied last time.
+        # Whole seconds would miss an initrd regenerated at the same size
+        # within the second it was last copied.
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return False
+        return (record.get('%s_path' % artifact) == os.path.realpath(path) and
+                record.get('%s_size' % artifact) == stat.st_size and
+                record.get('%s_mtime_ns' % artifact) == stat.st_mtime_ns)
+
+    def target(self, options, opsys, installed):
+        """Work out what a targeted update has to copy.
+
+        Returns the slot, 'current' or 'previous', holding
+        options.target_version, and the artifacts to copy for it. The slot
+        is None if everything has to be updated, and the artifacts are
+        empty if nothing does.
+        """
+        log = logging.getLogger('kernelstub')
+        paths = {
+            'current' : (opsys.kernel_path, opsys.initrd_path),
+            'previous' : (opsys.old_kernel_path, opsys.old_initrd_path),
+        }
+        for slot in ('current', 'previous'):
+            if self.image_version(paths[slot][0]) == options.target_version:
+                break
+        else:
+            log.info('Kernel %s isn\'t installed to the ESP, nothing to do',
+                     options.target_version)
+            return None, ()
+
+        # Only the artifacts of a slot that already holds this version can
+        # be updated alone; a new kernel moves both slots.
+        record = installed.get(slot) or {}
+        esp_version = self.image_version(record.get('kernel_path') or '')
+        if esp_version != options.target_version:
+            log.info('The %s kernel on the ESP is %s, updating everything',
+                     slot, esp_version)
+            return None, ('kernel', 'initrd')
+
+        artifacts = []
+        for artifact, path in zip(('kernel', 'initrd'), paths[slot]):
+            if options.changed not in (None, artifact):
+                continue
+            if self.artifact_unchanged(record, artifact, path):
+                log.info('The %s %s is unchanged', slot, artifact)
+                continue
+            artifacts.append(artifact)
+        return slot, tuple(artifacts)
+
+    def import_bundle(self, path, installer, esp_path, manage_mode,
+                      simulate=False):
+        """Install the ESP files, loader entries and NVRAM entry from a
+        bundle made by --export-bundle on a host with the same kernels."""
+        log = logging.getLogger('kernelstub')
+        bundle = Bundle.Bundle(path)
+        manifest = bundle.extract(
+            esp_path, bundle.host_identity(installer.opsys, installer.drive),
+            simulate=simulate)
+
+        for item in manifest['loader']:
+            # The cmdline file holds this host's own running cmdline.
+            if item['kind'] == 'cmdline':
+                continue
+            loader_path = os.path.join(esp_path, item['path'])
+            if simulate:
+                log.info('Simulate writing %s %s', item['kind'], loader_path)
+                continue
+            os.makedirs(os.path.dirname(loader_path), exist_ok=True)
+            installer.write_file(loader_path, item['contents'])
+        installer.copy_cmdline(simulate=simulate)
+
+        # Recorded as if installed here, so later runs know what the ESP holds.
+        installed = manifest['installed']
+        installer.kernel_file = installed['current']['esp_kernel']
+        installer.initrd_names = installed['current']['esp_initrds']
+        installer.old_kernel = 'previous' in installed
+        if installer.old_kernel:
+            installer.old_kernel_file = installed['previous']['esp_kernel']
+            installer.old_initrd_names = installed['previous']['esp_initrds']
+        installer.blobs.update(
+            os.path.basename(item['path']) for item in manifest['files'])
+
+        if manage_mode:
+            return manifest
+        drive = installer.drive
+        for item in manifest['nvram']:
+            installer.nvram.update()
+            if installer.nvram.os_entry_index >= 0:
+                installer.nvram.delete_boot_entry(
+                    installer.nvram.order_num, simulate)
+            # The entry boots from this host's ESP disk and partition.
+            installer.nvram.create_entry(
+                drive, item['label'], item['loader'], item['options'],
+                simulate)
+        return manifest
+
     def parse_options(self, options):
         for index, option in enumerate(options):
             if '"' in option:
@@ -104,7 +409,7 @@ class Kernelstub():
         }
 
         console_level = level[verbosity]
-        file_level = level[2]
+        file_level = self.file_levels['info']
 
         stream_fmt = logging.Formatter(
             '%(name)-21s: %(levelname)-8s %(message)s')
@@ -119,30 +424,147 @@ class Kernelstub():
         file_log = handlers.RotatingFileHandler(
             log_file_path, maxBytes=(1048576*5), backupCount=5)
         file_log.setFormatter(file_fmt)
-        file_log.setLevel(file_level)
 
-        log.addHandler(console_log)
-        log.addHandler(file_log)
+        # File and journald writes happen on the listener's thread, so only
+        # the console handler runs inline with the rest of the program.
+        log_queue = queue.Queue(-1)
+        self.queue_log = handlers.QueueHandler(log_queue)
+        log_handlers = [file_log]
 
         if systemd_support:
             journald_log = JournalHandler()
-            journald_log.setLevel(file_level)
             journald_log.setFormatter(stream_fmt)
-            log.addHandler(journald_log)
+            log_handlers.append(journald_log)
 
-        log.setLevel(logging.DEBUG)
+        self.log_listener = handlers.QueueListener(log_queue, *log_handlers)
+        self.log_listener.start()
+        atexit.register(self.log_listener.stop)
 
-        log.debug('Got command line options: %s' % args)
+        log.addHandler(console_log)
+        log.addHandler(self.queue_log)
+        self.console_level = console_level
+        self.set_file_level(file_level)
+
+        log.debug('Got command line options: %s', args)
+
+        try:
+            result = self.run(Options.from_args(args))
+        except KernelstubError as e:
+            log.debug('Stopping with exit code %s: %s', e.exit_code, e)
+            exit(e.exit_code)
+
+        if result.report:
+            print(result.report)
+
+        return 0
+
+    def run(self, options):
+        result = Result()
+        metrics = Metrics.Metrics()
+        try:
+            self.run_steps(options, result, metrics)
+        except KernelstubError as e:
+            metrics.exit_status = e.exit_code
+            raise
+        except Exception:
+            # Unexpected errors end the program with status 1.
+            metrics.exit_status = 1
+            raise
+        finally:
+            # Only installs are exported; reports and plans leave the
+            # previous run's metrics in place.
+            if result.status in (None, 'complete'):
+                metrics.write()
+            self.record_history(options, result, metrics)
+        return result
+
+    def record_history(self, options, result, metrics):
+        # Only installs are recorded; kernelstub-boottime.service alone
+        # would add a report run every boot. Failed runs have no status.
+        if result.status not in (None, 'complete', 'deferred', 'plan_applied'):
+            return
+        if (options.record_boot or options.boot_report or
+                options.analyze_initrd or options.esp_report or options.gc):
+            return
+        configuration = Config.Config.config_default['default']
+        if self.config is not None:
+            configuration = self.config.config['user']
+        backend = self.backend
+        if backend is None:
+            backend = Backend.SystemBackend()
+        history = History.History(
+            state=State.State(self.state_dir, backend=backend),
+            retention_days=configuration['history_days'])
+        history.record(
+            metrics, result,
+            dry_run=bool(options.dry_run or options.export_bundle))
+
+    def run_steps(self, options, result, metrics):
+        log = logging.getLogger('kernelstub')
+        backend = self.backend
+        if backend is None:
+            backend = Backend.SystemBackend()
+        state = State.State(self.state_dir, backend=backend)
+
+        if options.record_boot or options.boot_report:
+            boot_times = BootTime.BootTimes(state=state, backend=backend)
+            if options.record_boot:
+                record = boot_times.record()
+                result.status = 'boot_recorded'
+                if record:
+                    result.report = boot_times.report()
+            if options.boot_report:
+                result.status = 'boot_report'
+                result.report = boot_times.report()
+            return
+
+        if options.analyze_initrd:
+            initrd = Initrd.Initrd(options.analyze_initrd)
+            result.status = 'initrd_report'
+            result.report = initrd.report(initrd.analyze())
+            return
+
+        if options.apply_plan:
+            try:
+                result.plan = Plan.Plan(backend=backend).load(options.apply_plan)
+                result.plan.apply()
+            except Plan.PlanError as e:
+                log.exception('Couldn\'t apply the execution plan! %s', e)
+                raise
+            log.debug('Plan applied!\n\n')
+            result.status = 'plan_applied'
+            return
+
+        pending = state.load('pending.json')
+        if options.commit_pending:
+            if pending is None:
+                log.info('No deferred changes to commit')
+                result.status = 'no_pending'
+                return
+            log.info('Committing %s deferred request(s), the last from %s',
+                     pending['requests'], time.ctime(pending['last_requested']))
+            options = options.with_pending(pending)
 
         # Figure out runtime options
         no_run = False
-        if args.dry_run:
+        plan = None
+        if options.dry_run or options.export_bundle:
             no_run = True
-
-        config = Config.Config()
+            plan = Plan.Plan(backend=backend)
+            result.plan = plan
+
+        # The configuration is only loaded once, so callers embedding
+        # kernelstub can reuse the same object across runs.
+        if self.config is None:
+            self.config = Config.Config(backend=backend)
+        config = self.config
         configuration = config.config['user']
+        result.configuration = configuration
+        if self.queue_log is not None:
+            self.set_file_level(self.file_levels.get(
+                configuration.get('file_log_level', 'info'), logging.INFO))
 
-        if args.preserve_live and configuration['live_mode']:
+        if options.preserve_live and configuration['live_mode']:
             configuration['live_mode'] = True
             log.warning(
                 'Live mode is enabled!\n'
@@ -152,27 +574,53 @@ class Kernelstub():
                 'If you are not running a live disk, please run '
                 '`sudo kernelstub` to disable live mode.'
             )
-            exit(0)
+            result.status = 'live_mode'
+            return
 
         configuration['live_mode'] = False
 
-        if args.esp_path:
-            configuration['esp_path'] = args.esp_path
+        if not no_run:
+            metrics.directory = configuration['metrics_dir']
+
+        if options.esp_path:
+            configuration['esp_path'] = options.esp_path
 
         root_path = "/"
-        if args.root_path:
-            root_path = args.root_path
+        if options.root_path:
+            root_path = options.root_path
 
         boot_path = os.path.join(root_path, 'boot')
-        latest_option, previous_option = KernelOption.latest_option(boot_path)
-
-        opsys = Opsys.OS()
-
-        if args.kernel_path:
+        latest_option, previous_option = KernelOption.latest_option(
+            boot_path,
+            flavor=configuration.get('kernel_flavor'),
+            pinned=configuration.get('pinned_kernel'))
+
+        facts = Facts.Facts(state=state, backend=backend)
+        opsys = Opsys.OS(backend=backend, facts=facts)
+
+        if options.esp_report or options.gc:
+            drive = Drive.Drive(
+                root_path=root_path, esp_path=configuration['esp_path'],
+                backend=backend, facts=facts)
+            facts.save()
+            nvram = Nvram.NVRAM(opsys.name, opsys.version, backend=backend,
+                                verbose=True)
+            esp = Esp.ESP(configuration['esp_path'], nvram.nvram,
+                          root_uuid=drive.root_uuid, backend=backend)
+            esp.scan()
+            if options.gc:
+                reclaimed = esp.collect(simulate=no_run)
+                log.info('Reclaimed %s bytes from the ESP', reclaimed)
+                esp.scan()
+            result.status = 'esp_report'
+            result.report = esp.report()
+            return
+
+        if options.kernel_path:
             log.debug(
                 'Manually specified kernel path:\n ' +
-                '               %s' % args.kernel_path)
-            opsys.kernel_path = args.kernel_path
+                '               %s', options.kernel_path)
+            opsys.kernel_path = options.kernel_path
         elif latest_option:
             opsys.kernel_path = latest_option['kernel']
         else:
@@ -180,11 +628,11 @@ class Kernelstub():
             if not os.path.exists(opsys.kernel_path):
                 opsys.kernel_path = os.path.join(root_path, opsys.kernel_name)
 
-        if args.initrd_path:
+        if options.initrd_path:
             log.debug(
                 'Manually specified initrd path:\n ' +
-                '               %s' % args.initrd_path)
-            opsys.initrd_path = args.initrd_path
+                '               %s', options.initrd_path)
+            opsys.initrd_path = options.initrd_path
         elif latest_option:
             opsys.initrd_path = latest_option['initrd']
         else:
@@ -208,21 +656,45 @@ class Kernelstub():
                     boot_path, opsys.old_initrd_name
                 )
 
+        if self.plugins is None:
+            self.plugins = Plugins.Plugins.load()
+        plugins = self.plugins
+        if plugins:
+            artifacts = {}
+            for key in ('kernel', 'initrd', 'old_kernel', 'old_initrd'):
+                artifacts[key] = self.artifact_info(
+                    getattr(opsys, '%s_path' % key))
+            plugins.run('select', artifacts)
+            for key, artifact in artifacts.items():
+                setattr(opsys, '%s_path' % key, artifact['path'])
+
         if not os.path.exists(opsys.kernel_path):
-            log.exception('Can\'t find the kernel image \'' + opsys.kernel_path + '\'! \n\n'
-                         'Please use the --kernel-path option to specify '
-                         'the path to the kernel image')
-            exit(0)
+            log.exception('Can\'t find the kernel image \'%s\'! \n\n'
+                          'Please use the --kernel-path option to specify '
+                          'the path to the kernel image', opsys.kernel_path)
+            raise ImageNotFoundError(
+                'Can\'t find the kernel image %s' % opsys.kernel_path)
 
         if not os.path.exists(opsys.initrd_path):
-            log.exception('Can\'t find the initrd image \'' + opsys.initrd_path + '\'! \n\n'
-                         'Please use the --initrd-path option to specify '
-                         'the path to the initrd image')
-            exit(0)
+            log.exception('Can\'t find the initrd image \'%s\'! \n\n'
+                          'Please use the --initrd-path option to specify '
+                          'the path to the initrd image', opsys.initrd_path)
+            raise ImageNotFoundError(
+                'Can\'t find the initrd image %s' % opsys.initrd_path)
+
+        installed = state.load('installed.json', {})
+        target_slot = None
+        artifacts = ('kernel', 'initrd')
+        if options.target_version:
+            target_slot, artifacts = self.target(options, opsys, installed)
+            if not artifacts:
+                result.status = 'up_to_date'
+                return
 
         # Check for kernel parameters. Without them, stop and fail
-        if args.k_options:
-            configuration['kernel_options'] = self.parse_options(args.k_options.split())
+        if options.kernel_options:
+            configuration['kernel_options'] = self.parse_options(
+                options.kernel_options.split())
         else:
             try:
                 configuration['kernel_options']
@@ -234,19 +706,15 @@ class Kernelstub():
                          "default or fix the existing one.")
                 log.exception(error)
                 raise CmdLineError("No Kernel Parameters found")
-                exit(168)
 
-        log.debug(config.print_config())
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug(config.print_config())
 
-        if args.setup_loader:
-            configuration['setup_loader'] = True
-        if args.off_loader:
-            configuration['setup_loader'] = False
+        if options.setup_loader is not None:
+            configuration['setup_loader'] = options.setup_loader
 
-        if args.install_stub:
-            configuration['manage_mode'] = False
-        if args.manage_mode:
-            configuration['manage_mode'] = True
+        if options.manage_mode is not None:
+            configuration['manage_mode'] = options.manage_mode
 
 
         log.debug('Checking configuration integrity...')
@@ -265,94 +733,284 @@ class Kernelstub():
                 'If you can\'t figure it out, then deleting them should fix '
                 'the errors and cause kernelstub to regenerate them from '
                 'Default. \n\n You can use "-vv" to get the configuration used.')
-            log.debug('Configuration we got: \n\n%s' % config.print_config())
-            exit(169)
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug('Configuration we got: \n\n%s', config.print_config())
+            raise Config.ConfigError('Malformed configuration!')
 
 
-        if args.add_options:
-            add_opts = args.add_options.split(" ")
+        if options.add_options:
+            add_opts = options.add_options.split(" ")
             add_opts = config.parse_options(add_opts)
             for opt in add_opts:
                 if opt not in kernel_opts:
                     kernel_opts.append(opt)
                     configuration['kernel_options'] = kernel_opts
 
-        if args.remove_options:
-            rem_opts = args.remove_options.split(" ")
+        if options.remove_options:
+            rem_opts = options.remove_options.split(" ")
             rem_opts = config.parse_options(rem_opts)
             kernel_opts = list(set(kernel_opts) - set(rem_opts))
             configuration['kernel_options'] = kernel_opts
 
-        if args.force_update:
+        if options.force_update:
             force = True
         if configuration['force_update'] == True:
             force = True
 
         log.debug('Structing objects')
 
-        drive = Drive.Drive(root_path=root_path, esp_path=esp_path)
-        nvram = Nvram.NVRAM(opsys.name, opsys.version)
-        installer = Installer.Installer(nvram, opsys, drive)
+        low_impact = configuration['low_impact_io']
+        if options.low_impact is not None:
+            low_impact = options.low_impact
+
+        defer = configuration['defer_commit']
+        if options.defer is not None:
+            defer = options.defer
+        if defer and not (no_run or options.print_config or
+                          options.commit_pending):
+            # Only the configuration is written now; the ESP and NVRAM are
+            # updated once, by --commit-pending at shutdown.
+            record = options.pending_record(pending)
+            state.save('pending.json', record)
+            log.info('Deferred until shutdown (%s pending request(s))',
+                     record['requests'])
+            config.config['user'] = configuration
+            config.save_config()
+            result.status = 'deferred'
+            return
+
+        metrics.esp_path = esp_path
+        with metrics.phase('probe'):
+            drive = Drive.Drive(
+                root_path=root_path, esp_path=esp_path, backend=backend,
+                facts=facts)
+            facts.save()
+            # Verbose, so the ESP scan below can match entries to directories
+            # the same way --gc does.
+            nvram = Nvram.NVRAM(
+                opsys.name, opsys.version, plan=plan, backend=backend,
+                plugins=plugins, verbose=True)
+        transfer = Transfer.Transfer(
+            low_impact=low_impact and not no_run,
+            rate_limit=configuration['io_rate_limit'],
+            verify=configuration['verify_copies'],
+            delta=configuration['delta_updates'],
+            manifests=state.load('blocks.json', {}),
+            hashing=bool(plugins),
+            defragment=configuration['defragment_esp'])
+        metrics.watch(transfer, nvram)
+        signer = None
+        if configuration['signing_key'] and configuration['signing_cert']:
+            signer = Signing.Signer(
+                configuration['signing_key'],
+                configuration['signing_cert'],
+                cache_dir=os.path.join(self.state_dir, 'signed'))
+        installer = Installer.Installer(
+            nvram, opsys, drive, plan=plan, transfer=transfer,
+            initrd_budget=configuration['initrd_budget'], signer=signer,
+            zboot_policy=configuration['zboot_policy'], backend=backend,
+            plugins=plugins,
+            share_early_initrd=configuration['share_early_initrd'],
+            esp_layout=configuration['esp_layout'],
+            full_plan=bool(options.export_bundle))
+
+        with metrics.phase('esp_scan'):
+            esp = Esp.ESP(esp_path, nvram.nvram, root_uuid=drive.root_uuid,
+                          backend=backend)
+            esp.scan()
+        orphans = esp.orphans()
+        if orphans:
+            log.info('%s orphaned kernelstub directories are using %s bytes '
+                     'on the ESP. Run `sudo kernelstub --gc` to remove them.',
+                     len(orphans), sum(item['size'] for item in orphans))
 
         # Log some helpful information, to file and optionally console
-        info = (
-            '    OS:..................%s %s\n' %(opsys.name_pretty,opsys.version) +
-            '    Root partition:......%s\n'    % drive.root_fs +
-            '    Root FS UUID:........%s\n'    % drive.root_uuid +
-            '    ESP Path:............%s\n'    % esp_path +
-            '    ESP Partition:.......%s\n'    % drive.esp_fs +
-            '    ESP Partition #:.....%s\n'    % drive.esp_num +
-            '    NVRAM entry #:.......%s\n'    % nvram.os_entry_index +
-            '    Boot Variable #:.....%s\n'    % nvram.order_num +
-            '    Kernel Boot Options:.%s\n'    % " ".join(kernel_opts) +
-            '    Kernel Image Path:...%s\n'    % opsys.kernel_path +
-            '    Initrd Image Path:...%s\n'    % opsys.initrd_path +
-            '    Force-overwrite:.....%s\n'    % str(force))
-
-        log.info('System information: \n\n%s' % info)
-
-        if args.print_config:
-            all_config = (
-                '   ESP Location:..................%s\n' % configuration['esp_path'] +
-                '   Management Mode:...............%s\n' % configuration['manage_mode'] +
-                '   Install Loader configuration:..%s\n' % configuration['setup_loader'] +
-                '   Configuration version:.........%s\n' % configuration['config_rev'])
-            log.info('Configuration details: \n\n%s' % all_config)
-            exit(0)
+        log.info(
+            'System information: \n\n' +
+            '    OS:..................%s %s\n' +
+            '    Root partition:......%s\n' +
+            '    Root FS UUID:........%s\n' +
+            '    ESP Path:............%s\n' +
+            '    ESP Partition:.......%s\n' +
+            '    ESP Partition #:.....%s\n' +
+            '    NVRAM entry #:.......%s\n' +
+            '    Boot Variable #:.....%s\n' +
+            '    Kernel Boot Options:.%s\n' +
+            '    Kernel Image Path:...%s\n' +
+            '    Initrd Image Path:...%s\n' +
+            '    Force-overwrite:.....%s\n',
+            opsys.name_pretty, opsys.version,
+            drive.root_fs,
+            drive.root_uuid,
+            esp_path,
+            drive.esp_fs,
+            drive.esp_num,
+            nvram.os_entry_index,
+            nvram.order_num,
+            " ".join(kernel_opts),
+            opsys.kernel_path,
+            opsys.initrd_path,
+            force)
+
+        if options.print_config:
+            log.info(
+                'Configuration details: \n\n' +
+                '   ESP Location:..................%s\n' +
+                '   Management Mode:...............%s\n' +
+                '   Install Loader configuration:..%s\n' +
+                '   File log level:................%s\n' +
+                '   Low-impact I/O:................%s\n' +
+                '   I/O rate limit (bytes/s):......%s\n' +
+                '   Verify copies:.................%s\n' +
+                '   Signing certificate:...........%s\n' +
+                '   Zboot kernels:.................%s\n' +
+                '   Delta updates:.................%s\n' +
+                '   Defragment ESP files:..........%s\n' +
+                '   Share early initrd:............%s\n' +
+                '   ESP layout:....................%s\n' +
+                '   History retention (days):......%s\n' +
+                '   Configuration version:.........%s\n',
+                configuration['esp_path'],
+                configuration['manage_mode'],
+                configuration['setup_loader'],
+                configuration['file_log_level'],
+                configuration['low_impact_io'],
+                configuration['io_rate_limit'],
+                configuration['verify_copies'],
+                configuration['signing_cert'],
+                configuration['zboot_policy'],
+                configuration['delta_updates'],
+                configuration['defragment_esp'],
+                configuration['share_early_initrd'],
+                configuration['esp_layout'],
+                configuration['history_days'],
+                configuration['config_rev'])
+            result.status = 'print_config'
+            return
 
         log.debug('Setting up boot...')
 
         kopts = 'root=UUID=%s ro %s' % (drive.root_uuid, " ".join(kernel_opts))
-        log.debug('kopts: %s' % kopts)
-
-
+        log.debug('kopts: %s', kopts)
+        result.kernel_path = opsys.kernel_path
+        result.initrd_path = opsys.initrd_path
+        result.kernel_options = kopts
 
-        installer.setup_kernel(
-            kopts,
-            setup_loader=setup_loader,
-            overwrite=force,
-            simulate=no_run)
-        try:
-            installer.backup_old(
-                kopts,
-                setup_loader=setup_loader,
-                simulate=no_run)
-        except Exception as e:
-            log.debug('Couldn\'t back up old kernel. \nThis might just mean ' +
-                      'You don\'t have an old kernel installed. If you do, try ' +
-                      'with -vv to see debuging information')
-            log.debug(e)
 
-        installer.copy_cmdline(simulate=no_run)
 
-        if not manage_mode:
-            installer.setup_stub(kopts, simulate=no_run)
+        if options.import_bundle:
+            try:
+                with metrics.phase('import_bundle'):
+                    self.import_bundle(
+                        options.import_bundle, installer, esp_path,
+                        manage_mode, simulate=no_run)
+            except Bundle.BundleError as e:
+                log.error('Couldn\'t import the bundle! %s', e)
+                raise
+        else:
+            if target_slot in (None, 'current'):
+                with metrics.phase('setup_kernel'):
+                    installer.setup_kernel(
+                        kopts,
+                        setup_loader=setup_loader,
+                        overwrite=force,
+                        simulate=no_run,
+                        artifacts=artifacts)
+            if installer.kernel_info:
+                metrics.kernel_version = installer.kernel_info['version']
+            if target_slot in (None, 'previous'):
+                try:
+                    with metrics.phase('backup_old'):
+                        installer.backup_old(
+                            kopts,
+                            setup_loader=setup_loader,
+                            simulate=no_run,
+                            artifacts=artifacts)
+                except Exception as e:
+                    log.debug('Couldn\'t back up old kernel. \nThis might just mean ' +
+                              'You don\'t have an old kernel installed. If you do, try ' +
+                              'with -vv to see debuging information')
+                    log.debug(e)
+
+            if target_slot is None:
+                installer.copy_cmdline(simulate=no_run)
+
+            current = installed.get('current') or {}
+            if target_slot == 'previous':
+                log.debug('Only the previous kernel changed, leaving NVRAM alone')
+            elif (target_slot == 'current' and
+                  current.get('kernel_path') == os.path.realpath(opsys.kernel_path) and
+                  current.get('kernel_options') == kopts and
+                  current.get('esp_kernel') == installer.kernel_file and
+                  current.get('esp_initrds') == installer.initrd_names):
+                log.info('The kernel path and options are unchanged, leaving '
+                         'NVRAM alone')
+            elif not manage_mode:
+                with metrics.phase('setup_stub'):
+                    installer.setup_stub(kopts, simulate=no_run)
+
+        if target_slot is None:
+            # Only once NVRAM points at the new files. A targeted run doesn't
+            # know every slot's shared files, so leftovers wait for the next
+            # full run.
+            installer.prune_blobs(simulate=no_run)
+
+        if plan is not None:
+            totals = plan.totals()
+            log.info('Execution plan: %s bytes to the ESP, %s NVRAM writes '
+                     '(about %s bytes)',
+                     totals['esp_bytes_written'],
+                     totals['nvram_writes'],
+                     totals['nvram_bytes_written'])
+            if options.plan_file:
+                plan.save(options.plan_file)
+            if options.export_bundle:
+                bundle = Bundle.Bundle(options.export_bundle)
+                try:
+                    with metrics.phase('export_bundle'):
+                        bundle.export(plan, esp_path,
+                                      bundle.host_identity(opsys, drive),
+                                      installer.identity(kopts))
+                except Bundle.BundleError as e:
+                    log.error('Couldn\'t export the bundle! %s', e)
+                    raise
+
+        if not no_run:
+            identity = installer.identity(kopts)
+            if target_slot is not None:
+                # The other slot wasn't touched, so its record still holds.
+                record = dict(installed)
+                record['installed'] = identity['installed']
+                record[target_slot] = identity.get(target_slot)
+                # Nor were the artifacts left out, whatever /boot holds now.
+                for artifact in ('kernel', 'initrd'):
+                    if artifact in artifacts or not record[target_slot]:
+                        continue
+                    for key in ('path', 'size', 'mtime_ns'):
+                        key = '%s_%s' % (artifact, key)
+                        record[target_slot][key] = installed[target_slot].get(key)
+                identity = record
+            state.save('installed.json', identity)
+            if transfer.digests:
+                digests = state.load('digests.json', {})
+                digests.update(transfer.digests)
+                state.save('digests.json', digests)
+            if transfer.delta:
+                # Files removed from the ESP take their manifests with them.
+                state.save('blocks.json', {
+                    path : manifest
+                    for path, manifest in transfer.manifests.items()
+                    if os.path.exists(path)})
+            # This run supersedes everything deferred before it started.
+            if pending is not None and state.load('pending.json') == pending:
+                state.remove('pending.json')
 
         log.debug('Saving configuration to file')
 
         config.config['user'] = configuration
         config.save_config()
 
+        result.files_written = installer.files_written
+        result.nvram_changes = nvram.changes
+        result.status = 'complete'
         log.debug('Setup complete!\n\n')
-
-        return 0
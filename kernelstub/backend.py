@@ -0,0 +1,392 @@
+#!/usr/bin/python3
+
+"""
+ kernelstub
+ The automatic manager for using the Linux Kernel EFI Stub to boot
+
+ Copyright 2017-2018 Ian Santopietro <isantop@gmail.com>
+
+Permission to use, copy, modify, and/or distribute this software for any purpose
+with or without fee is hereby granted, provided that the above copyright notice
+and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS
+OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF
+THIS SOFTWARE.
+
+Please see the provided LICENSE.txt file for additional distribution/copyright
+terms.
+"""
+
+
+import logging, os, shutil, subprocess
+
+class Backend():
+    """Everything kernelstub reads from, writes to or runs on the system.
+
+    Drive, NVRAM, OS, Config, Installer, ESP, Plan, State and BootTimes
+    only touch the system through a backend, so they can run against the
+    live system, a mounted image, or a layout held entirely in memory.
+    Kernel and initrd images are the exception, see Transfer.
+    """
+
+    def read_text(self, path):
+        raise NotImplementedError
+
+    def write_text(self, path, contents):
+        raise NotImplementedError
+
+    def exists(self, path):
+        raise NotImplementedError
+
+    def mtime(self, path):
+        """Return when path was last modified, in nanoseconds.
+
+        Raises OSError if path doesn't exist.
+        """
+        raise NotImplementedError
+
+    def makedirs(self, path):
+        raise NotImplementedError
+
+    def readlink(self, path):
+        raise NotImplementedError
+
+    def realpath(self, path):
+        raise NotImplementedError
+
+    def read_bytes(self, path):
+        raise NotImplementedError
+
+    def listdir(self, path):
+        """Return the names in the directory path.
+
+        Raises OSError if path isn't a directory.
+        """
+        raise NotImplementedError
+
+    def isdir(self, path):
+        raise NotImplementedError
+
+    def size(self, path):
+        raise NotImplementedError
+
+    def rename(self, src, dest):
+        """Move src over dest in one step."""
+        raise NotImplementedError
+
+    def remove(self, path):
+        raise NotImplementedError
+
+    def rmtree(self, path):
+        raise NotImplementedError
+
+    def database(self, path):
+        """Return what sqlite3.connect() should open for path."""
+        raise NotImplementedError
+
+    def present_uuids(self):
+        """Return the UUIDs of the filesystems attached to the system."""
+        raise NotImplementedError
+
+    def run(self, command, check=False):
+        """Run command and return its output as text.
+
+        Raises OSError if the program can't be run, and
+        subprocess.CalledProcessError if check is set and it fails.
+        """
+        raise NotImplementedError
+
+class SystemBackend(Backend):
+    """The running system, or an OS image mounted at root.
+
+    The kernel's view of the system (/proc, /sys and /dev) always comes
+    from the running system.
+    """
+
+    host_dirs = ('/proc/', '/sys/', '/dev/')
+
+    def __init__(self, root='/'):
+        self.log = logging.getLogger('kernelstub.Backend')
+        self.log.debug('loaded kernelstub.SystemBackend')
+        self.root = root
+
+    def path(self, path):
+        if self.root == '/' or path.startswith(self.host_dirs):
+            return path
+        return os.path.join(self.root, path.lstrip('/'))
+
+    def read_text(self, path):
+        with open(self.path(path)) as in_file:
+            return in_file.read()
+
+    def write_text(self, path, contents):
+        with open(self.path(path), mode='w') as out_file:
+            out_file.write(contents)
+
+    def exists(self, path):
+        return os.path.exists(self.path(path))
+
+    def mtime(self, path):
+        return os.stat(self.path(path)).st_mtime_ns
+
+    def makedirs(self, path):
+        os.makedirs(self.path(path), exist_ok=True)
+
+    def readlink(self, path):
+        return os.readlink(self.path(path))
+
+    def realpath(self, path):
+        return os.path.realpath(self.path(path))
+
+    def read_bytes(self, path):
+        with open(self.path(path), 'rb') as in_file:
+            return in_file.read()
+
+    def listdir(self, path):
+        return os.listdir(self.path(path))
+
+    def isdir(self, path):
+        return os.path.isdir(self.path(path))
+
+    def size(self, path):
+        return os.lstat(self.path(path)).st_size
+
+    def rename(self, src, dest):
+        os.replace(self.path(src), self.path(dest))
+
+    def remove(self, path):
+        os.remove(self.path(path))
+
+    def rmtree(self, path):
+        shutil.rmtree(self.path(path))
+
+    def database(self, path):
+        return self.path(path)
+
+    def present_uuids(self):
+        # Filesystems that are mounted or at least attached to this system.
+        present = set()
+        try:
+            present.update(self.listdir('/dev/disk/by-uuid'))
+        except OSError as e:
+            self.log.debug('Couldn\'t list attached filesystems: %s', e)
+        try:
+            present.update(self.run(['findmnt', '-rn', '-o', 'UUID']).split())
+        except OSError as e:
+            self.log.debug('Couldn\'t list mounted filesystems: %s', e)
+        return {uuid.lower() for uuid in present}
+
+    def run(self, command, check=False):
+        self.log.debug('Running %s', command)
+        result = subprocess.run(command, stdout=subprocess.PIPE, check=check)
+        return result.stdout.decode('UTF-8')
+
+class MemoryBackend(Backend):
+    """A system layout held in memory, for tests and benchmarks.
+
+    files maps paths to their contents and links maps symlinks to their
+    targets. uuids maps mount points to the UUIDs of the filesystems
+    mounted there. commands maps program names to functions that take the
+    command line and return (returncode, output); efibootmgr and findmnt
+    are emulated unless they are given there. Databases are opened in
+    memory, so they only last as long as one connection.
+    """
+
+    def __init__(self, files=None, links=None, commands=None, uuids=None,
+                 boot_entries=None):
+        self.files = dict(files or {})
+        self.links = dict(links or {})
+        self.directories = set()
+        # Files count as modified at 0, and each write_text moves them on.
+        self.mtimes = {}
+        self.uuids = dict(uuids or {})
+        self.efibootmgr = EfiBootMgr(boot_entries)
+        self.commands = {
+            'efibootmgr' : self.efibootmgr,
+            'findmnt' : self.findmnt,
+        }
+        self.commands.update(commands or {})
+        self.history = []
+
+    @classmethod
+    def layout(cls, name='Linux', version='1.0', root_dev='/dev/sda2',
+               esp_dev='/dev/sda1', esp_path='/boot/efi',
+               root_uuid='12345678-1234-1234-1234-123456789abc',
+               cmdline=None, boot_entries=None):
+        """Return a backend for a typical single-disk system."""
+        if cmdline is None:
+            cmdline = 'BOOT_IMAGE=/vmlinuz root=UUID=%s ro quiet splash\n' % (
+                root_uuid)
+        esp_name = os.path.basename(esp_dev)
+        disk_name = esp_name.rstrip('0123456789')
+        if disk_name.endswith('p') and disk_name[:-1][-1:].isdigit():
+            disk_name = disk_name[:-1]
+        return cls(
+            files={
+                '/proc/mounts' : (
+                    '%s / ext4 rw,relatime 0 0\n' % root_dev +
+                    '%s %s vfat rw,relatime 0 0\n' % (esp_dev, esp_path)),
+                '/proc/cmdline' : cmdline,
+                '/etc/os-release' : (
+                    'NAME="%s"\n' % name +
+                    'VERSION_ID="%s"\n' % version),
+            },
+            links={
+                '/sys/class/block/%s' % esp_name : (
+                    '../../devices/pci0000:00/block/%s/%s' % (
+                        disk_name, esp_name)),
+            },
+            uuids={
+                '/' : root_uuid,
+                esp_path : 'ABCD-1234',
+            },
+            boot_entries=boot_entries)
+
+    def read_text(self, path):
+        try:
+            return self.files[path]
+        except KeyError:
+            raise FileNotFoundError(path) from None
+
+    def write_text(self, path, contents):
+        if os.path.dirname(path) not in self.directories:
+            raise FileNotFoundError(os.path.dirname(path))
+        self.files[path] = contents
+        self.mtimes[path] = max(self.mtimes.values(), default=0) + 1
+
+    def exists(self, path):
+        return (path in self.files or path in self.directories or
+                path in self.links)
+
+    def mtime(self, path):
+        if path not in self.files:
+            raise FileNotFoundError(path)
+        return self.mtimes.get(path, 0)
+
+    def makedirs(self, path):
+        while path and path != '/':
+            self.directories.add(path)
+            path = os.path.dirname(path)
+
+    def readlink(self, path):
+        try:
+            return self.links[path]
+        except KeyError:
+            raise OSError('%s is not a link' % path) from None
+
+    def realpath(self, path):
+        seen = set()
+        while path in self.links and path not in seen:
+            seen.add(path)
+            path = os.path.normpath(os.path.join(
+                os.path.dirname(path), self.links[path]))
+        return path
+
+    def read_bytes(self, path):
+        contents = self.read_text(path)
+        if isinstance(contents, str):
+            contents = contents.encode('UTF-8')
+        return contents
+
+    def children(self, path):
+        prefix = path.rstrip('/') + '/'
+        names = set()
+        for item in (list(self.files) + list(self.directories) +
+                     list(self.links)):
+            if item.startswith(prefix):
+                names.add(item[len(prefix):].split('/')[0])
+        return names
+
+    def listdir(self, path):
+        names = self.children(path)
+        if not names and path not in self.directories:
+            raise FileNotFoundError(path)
+        return sorted(names)
+
+    def isdir(self, path):
+        return path in self.directories or bool(self.children(path))
+
+    def size(self, path):
+        return len(self.read_bytes(path))
+
+    def rename(self, src, dest):
+        self.files[dest] = self.read_text(src)
+        del self.files[src]
+        self.mtimes[dest] = max(self.mtimes.values(), default=0) + 1
+        self.mtimes.pop(src, None)
+
+    def remove(self, path):
+        self.read_text(path)
+        del self.files[path]
+        self.mtimes.pop(path, None)
+
+    def rmtree(self, path):
+        if not self.isdir(path):
+            raise FileNotFoundError(path)
+        prefix = path.rstrip('/') + '/'
+        self.files = {item : contents for item, contents in self.files.items()
+                      if not item.startswith(prefix)}
+        self.links = {item : target for item, target in self.links.items()
+                      if not item.startswith(prefix)}
+        self.directories = {item for item in self.directories
+                            if item != path and not item.startswith(prefix)}
+
+    def database(self, path):
+        return ':memory:'
+
+    def present_uuids(self):
+        return {uuid.lower() for uuid in self.uuids.values()}
+
+    def run(self, command, check=False):
+        self.history.append(list(command))
+        try:
+            handler = self.commands[command[0]]
+        except KeyError:
+            raise FileNotFoundError(command[0]) from None
+        returncode, output = handler(command)
+        if check and returncode:
+            raise subprocess.CalledProcessError(returncode, command, output)
+        return output
+
+    def findmnt(self, command):
+        mountpoint = command[command.index('--mountpoint') + 1]
+        if mountpoint not in self.uuids:
+            return 1, ''
+        return 0, '%s\n' % self.uuids[mountpoint]
+
+class EfiBootMgr():
+    """Just enough of efibootmgr for kernelstub's use of it."""
+
+    def __init__(self, entries=None):
+        self.entries = dict(entries or {})
+        self.order = sorted(self.entries)
+
+    def __call__(self, command):
+        if '-c' in command:
+            number = 0
+            while number in self.entries:
+                number = number + 1
+            self.entries[number] = command[command.index('-L') + 1]
+            self.order.insert(0, number)
+        elif '-B' in command:
+            number = int(command[command.index('-b') + 1], 16)
+            if number not in self.entries:
+                return 1, ''
+            del self.entries[number]
+            self.order.remove(number)
+        return 0, self.output()
+
+    def output(self):
+        lines = [
+            'BootCurrent: %04X' % (self.order[0] if self.order else 0),
+            'Timeout: 0 seconds',
+            'BootOrder: %s' % ','.join('%04X' % number for number in self.order),
+        ]
+        for number in sorted(self.entries):
+            lines.append('Boot%04X* %s' % (number, self.entries[number]))
+        return '\n'.join(lines) + '\n'
@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+
+"""
+ kernelstub
+ The automatic manager for using the Linux Kernel EFI Stub to boot
+
+ Copyright 2017-2018 Ian Santopietro <isantop@gmail.com>
+
+Permission to use, copy, modify, and/or distribute this software for any purpose
+with or without fee is hereby granted, provided that the above copyright notice
+and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS
+OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF
+THIS SOFTWARE.
+
+Please see the provided LICENSE.txt file for additional distribution/copyright
+terms.
+"""
+
+import logging, os, time
+
+from .backend import SystemBackend
+from .state import State
+
+# systemd-boot and other loaders implementing the Boot Loader Interface store
+# their timestamps in variables under this vendor GUID.
+LOADER_GUID = '4a67b082-0a4c-41cf-b6c7-440b29bb8c4f'
+
+class BootTimes():
+
+    history_file = 'boot-history.json'
+    history_size = 500
+    fpdt_fields = [
+        'firmware_start_ns',
+        'bootloader_load_ns',
+        'bootloader_launch_ns',
+        'exitbootservice_start_ns',
+        'exitbootservice_end_ns',
+    ]
+
+    def __init__(self, sys_root='/sys', proc_root='/proc', state=None,
+                 backend=None):
+        self.log = logging.getLogger('kernelstub.BootTimes')
+        self.log.debug('loaded kernelstub.BootTimes')
+
+        self.sys_root = sys_root
+        self.proc_root = proc_root
+        self.backend = backend
+        if backend is None:
+            self.backend = SystemBackend()
+        self.state = state
+        if state is None:
+            self.state = State(backend=self.backend)
+
+    def read_text(self, path):
+        try:
+            return self.backend.read_text(path).strip()
+        except OSError as e:
+            self.log.debug('Couldn\'t read %s: %s', path, e)
+            return None
+
+    def read_efivar_usec(self, name):
+        # efivarfs files start with four bytes of attributes; loader
+        # timestamps are a NUL terminated UTF-16 decimal string.
+        path = os.path.join(self.sys_root, 'firmware', 'efi', 'efivars',
+                            '%s-%s' % (name, LOADER_GUID))
+        try:
+            data = self.backend.read_bytes(path)[4:]
+            return int(data.decode('UTF-16-LE').rstrip('\0'))
+        except (OSError, ValueError) as e:
+            self.log.debug('Couldn\'t read %s: %s', path, e)
+            return None
+
+    def read_fpdt(self):
+        fpdt = {}
+        for field in self.fpdt_fields:
+            value = self.read_text(os.path.join(
+                self.sys_root, 'firmware', 'acpi', 'fpdt', 'boot', field))
+            if value is not None:
+                fpdt[field] = int(value)
+        return fpdt
+
+    def read_init_start_usec(self):
+        # Field 22 of /proc/1/stat is when init started, in clock ticks since
+        # boot: the time the kernel itself took to get to userspace.
+        stat = self.read_text(os.path.join(self.proc_root, '1', 'stat'))
+        if stat is None:
+            return None
+        fields = stat.rsplit(')', 1)[-1].split()
+        return int(fields[19]) * 1000000 // os.sysconf('SC_CLK_TCK')
+
+    def boot_method(self, cmdline, loader_init):
+        if cmdline and 'BOOT_IMAGE=' in cmdline:
+            return 'grub'
+        if loader_init is not None:
+            return 'systemd-boot'
+        return 'efistub'
+
+    def collect(self):
+        cmdline = self.read_text(os.path.join(self.proc_root, 'cmdline'))
+        uptime = self.read_text(os.path.join(self.proc_root, 'uptime'))
+        loader_init = self.read_efivar_usec('LoaderTimeInitUSec')
+        loader_exec = self.read_efivar_usec('LoaderTimeExecUSec')
+        fpdt = self.read_fpdt()
+
+        record = {
+            'boot_id' : self.read_text(os.path.join(
+                self.proc_root, 'sys', 'kernel', 'random', 'boot_id')),
+            'recorded' : int(time.time()),
+            'kernel_release' : self.read_text(os.path.join(
+                self.proc_root, 'sys', 'kernel', 'osrelease')),
+            'method' : self.boot_method(cmdline, loader_init),
+            'uptime_usec' : None,
+            'firmware_usec' : None,
+            'loader_usec' : None,
+            'kernel_usec' : self.read_init_start_usec(),
+            'fpdt' : fpdt,
+        }
+        if uptime is not None:
+            record['uptime_usec'] = int(float(uptime.split()[0]) * 1000000)
+
+        if loader_init is not None:
+            record['firmware_usec'] = loader_init
+            if loader_exec is not None:
+                record['loader_usec'] = loader_exec - loader_init
+        elif 'bootloader_launch_ns' in fpdt:
+            record['firmware_usec'] = fpdt['bootloader_launch_ns'] // 1000
+            if 'exitbootservice_end_ns' in fpdt:
+                record['loader_usec'] = (fpdt['exitbootservice_end_ns'] -
+                                         fpdt['bootloader_launch_ns']) // 1000
+
+        record['identity'] = self.identity(record['kernel_release'])
+        return record
+
+    def identity(self, kernel_release):
+        # Tie the boot to what kernelstub installed, if it's what we booted.
+        installed = self.state.load('installed.json', {})
+        for role in ('current', 'previous'):
+            item = installed.get(role)
+            if item and item.get('kernel_version') == kernel_release:
+                return dict(item, role=role)
+        return {'kernel_version' : kernel_release}
+
+    def record(self):
+        record = self.collect()
+        history = self.state.load(self.history_file, [])
+        if any(item['boot_id'] == record['boot_id'] for item in history):
+            self.log.info('Boot %s is already recorded', record['boot_id'])
+            return None
+
+        history.append(record)
+        self.state.save(self.history_file, history[-self.history_size:])
+        self.log.info('Recorded boot %s: %s via %s', record['boot_id'],
+                      record['kernel_release'], record['method'])
+        return record
+
+    def total_usec(self, record):
+        parts = [record['firmware_usec'], record['loader_usec'],
+                 record['kernel_usec']]
+        return sum(part for part in parts if part is not None)
+
+    def summary(self):
+        groups = {}
+        for record in self.state.load(self.history_file, []):
+            key = (record['identity'].get('kernel_version'), record['method'])
+            groups.setdefault(key, []).append(record)
+
+        summary = []
+        for (kernel, method), records in sorted(groups.items(),
+                                                key=lambda item: str(item[0])):
+            row = {'kernel' : kernel, 'method' : method, 'boots' : len(records)}
+            for field in ('firmware_usec', 'loader_usec', 'kernel_usec'):
+                values = [record[field] for record in records
+                          if record[field] is not None]
+                row[field] = None
+                if values:
+                    row[field] = sum(values) // len(values)
+            row['total_usec'] = sum(
+                self.total_usec(record) for record in records) // len(records)
+            summary.append(row)
+        return summary
+
+    def report(self):
+        lines = ['%-32s %-13s %5s %10s %10s %10s %10s' % (
+            'Kernel', 'Method', 'Boots', 'Firmware', 'Loader', 'Kernel',
+            'Total')]
+        for row in self.summary():
+            times = []
+            for field in ('firmware_usec', 'loader_usec', 'kernel_usec',
+                          'total_usec'):
+                if row[field] is None:
+                    times.append('-')
+                else:
+                    times.append('%.2fs' % (row[field] / 1000000))
+            lines.append('%-32s %-13s %5s %10s %10s %10s %10s' % tuple(
+                [row['kernel'], row['method'], row['boots']] + times))
+        return '\n'.join(lines)
@@ -0,0 +1,278 @@
+#!/usr/bin/python3
+
+"""
+ kernelstub
+ The automatic manager for using the Linux Kernel EFI Stub to boot
+
+ Copyright 2017-2018 Ian Santopietro <isantop@gmail.com>
+
+Permission to use, copy, modify, and/or distribute this software for any purpose
+with or without fee is hereby granted, provided that the above copyright notice
+and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS
+OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF
+THIS SOFTWARE.
+
+Please see the provided LICENSE.txt file for additional distribution/copyright
+terms.
+"""
+
+
+import hashlib, io, json, logging, os, tarfile, tempfile, time
+
+from .errors import KernelstubError
+
+class BundleError(KernelstubError):
+    exit_code = 183
+
+class Bundle():
+    """A prebuilt set of ESP files for hosts with the same kernels and root.
+
+    The archive holds manifest.json first, then the files under esp/, so
+    it can be checked and extracted in one pass without seeking.
+    """
+
+    bundle_rev = 2
+    chunk_size = 1048576
+    manifest_name = 'manifest.json'
+    entry_fields = ('label', 'loader', 'options')
+    identity_names = {
+        'root_uuid' : 'root filesystem',
+        'current' : 'current kernel or initrd',
+        'previous' : 'previous kernel or initrd',
+    }
+
+    def __init__(self, path):
+        self.log = logging.getLogger('kernelstub.Bundle')
+        self.log.debug('loaded kernelstub.Bundle')
+        self.path = path
+        self.manifest = None
+
+    def host_identity(self, opsys, drive):
+        """What a bundle's files were built from, on this host."""
+        identity = {'root_uuid' : drive.root_uuid}
+        for slot, kernel_path, initrd_path in (
+                ('current', opsys.kernel_path, opsys.initrd_path),
+                ('previous', opsys.old_kernel_path, opsys.old_initrd_path)):
+            identity[slot] = {
+                'kernel_name' : os.path.basename(os.path.realpath(kernel_path)),
+                'kernel_sha256' : self.hash_file(kernel_path),
+                'initrd_sha256' : self.hash_file(initrd_path),
+            }
+        return identity
+
+    def hash_file(self, path):
+        digest = hashlib.sha256()
+        try:
+            with open(path, 'rb') as in_obj:
+                while True:
+                    data = in_obj.read(self.chunk_size)
+                    if not data:
+                        break
+                    digest.update(data)
+        except OSError:
+            return None
+        return digest.hexdigest()
+
+    def esp_relative(self, esp_path, path):
+        relative = os.path.relpath(path, esp_path)
+        if relative == '..' or relative.startswith('../'):
+            raise BundleError('%s is outside the ESP %s' % (path, esp_path))
+        return relative
+
+    def manifest_path(self, path):
+        """Return a path from the manifest, normalized, if it stays inside
+        the ESP. The manifest can't be trusted any more than the files."""
+        if not isinstance(path, str) or not path:
+            raise BundleError('Invalid path %r in the bundle' % (path,))
+        normal = os.path.normpath(path)
+        if (os.path.isabs(path) or '..' in path.split('/') or
+                normal == '.' or normal.split('/')[0] == '..'):
+            raise BundleError('%s in the bundle is outside the ESP' % path)
+        return normal
+
+    def manifest_entry(self, item):
+        """Return the fields of the NVRAM entry item from a manifest."""
+        entry = {key : item[key] for key in self.entry_fields}
+        if not all(isinstance(value, str) for value in entry.values()):
+            raise BundleError('Invalid NVRAM entry in the bundle')
+        return entry
+
+    def export(self, plan, esp_path, identity, installed):
+        """Write the files plan puts on the ESP into the bundle.
+
+        plan has to cover every file the boot entries use, not only the
+        ones that changed since the last run.
+        """
+        self.log.info('Exporting bundle to %s', self.path)
+        self.manifest = {
+            'bundle_rev' : self.bundle_rev,
+            'created' : int(time.time()),
+            'identity' : identity,
+            'installed' : installed,
+            'directories' : [self.esp_relative(esp_path, path)
+                             for path in plan.directories],
+            'files' : [],
+            'loader' : [],
+            # Boot numbers, deletions and disks are the exporting host's, so
+            # only what the new entries boot is kept.
+            'nvram' : [{key : item[key] for key in self.entry_fields}
+                       for item in plan.nvram if item['action'] == 'create'],
+        }
+        for item in plan.loader:
+            self.manifest['loader'].append({
+                'kind' : item['kind'],
+                'path' : self.esp_relative(esp_path, item['path']),
+                'contents' : item['contents'],
+            })
+
+        tmp_path = '%s.tmp' % self.path
+        with tempfile.TemporaryDirectory() as work_dir:
+            # The manifest comes first and lists every digest, so each file
+            # is built once up front.
+            built = {}
+            for index, artifact in enumerate(plan.artifacts):
+                relative = self.esp_relative(esp_path, artifact['destination'])
+                # Shared files are planned once for each slot using them.
+                if relative in built:
+                    continue
+                work_path = os.path.join(work_dir, str(index))
+                with open(work_path, 'wb') as out_obj:
+                    plan.write_artifact(artifact, out_obj)
+                self.manifest['files'].append({
+                    'path' : relative,
+                    'size' : os.path.getsize(work_path),
+                    'sha256' : self.hash_file(work_path),
+                })
+                built[relative] = work_path
+
+            try:
+                with tarfile.open(tmp_path, mode='w:xz') as archive:
+                    data = json.dumps(self.manifest, indent=2).encode('UTF-8')
+                    info = tarfile.TarInfo(self.manifest_name)
+                    info.size = len(data)
+                    info.mtime = self.manifest['created']
+                    archive.addfile(info, io.BytesIO(data))
+                    for relative, work_path in built.items():
+                        archive.add(work_path,
+                                    arcname=os.path.join('esp', relative),
+                                    recursive=False)
+                os.replace(tmp_path, self.path)
+            except (OSError, tarfile.TarError) as e:
+                raise BundleError('Could not write %s' % self.path) from e
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+        self.log.info('Exported %s files', len(built))
+        return self.manifest
+
+    def extract(self, esp_path, identity, simulate=False):
+        """Check the bundle against identity and put its files on the ESP.
+
+        Files are streamed to temporary names and only moved into place
+        once every one has matched its digest. Returns the manifest.
+        """
+        self.log.info('Importing bundle %s', self.path)
+        tmp_paths = {}
+        try:
+            with tarfile.open(self.path, mode='r|*') as archive:
+                for member in archive:
+                    if self.manifest is None:
+                        self.read_manifest(archive, member, identity)
+                        expected = {
+                            os.path.join('esp', item['path']) : item
+                            for item in self.manifest['files']}
+                        continue
+                    item = expected.pop(member.name, None)
+                    if item is None or not member.isfile():
+                        raise BundleError(
+                            'Unexpected %s in the bundle' % member.name)
+                    dest = os.path.join(esp_path, item['path'])
+                    tmp_path = None
+                    if not simulate:
+                        tmp_path = '%s.kernelstub-tmp' % dest
+                        os.makedirs(os.path.dirname(dest), exist_ok=True)
+                        tmp_paths[dest] = tmp_path
+                    self.extract_file(archive, member, item, tmp_path)
+        except (OSError, tarfile.TarError, ValueError) as e:
+            self.remove_all(tmp_paths.values())
+            raise BundleError('Could not read the bundle %s' % self.path) from e
+        except BundleError:
+            self.remove_all(tmp_paths.values())
+            raise
+
+        if self.manifest is None:
+            raise BundleError('%s is empty' % self.path)
+        if expected:
+            self.remove_all(tmp_paths.values())
+            raise BundleError('The bundle is missing %s' % ', '.join(
+                sorted(expected)))
+
+        for dest, tmp_path in tmp_paths.items():
+            os.replace(tmp_path, dest)
+            self.log.debug('Imported %s', dest)
+        if simulate:
+            self.log.info('Simulate importing %s files',
+                          len(self.manifest['files']))
+        return self.manifest
+
+    def read_manifest(self, archive, member, identity):
+        if member.name != self.manifest_name:
+            raise BundleError('%s doesn\'t start with a manifest' % self.path)
+        manifest = json.load(archive.extractfile(member))
+        if manifest.get('bundle_rev') != self.bundle_rev:
+            raise BundleError('Unsupported bundle revision: %s' %
+                              manifest.get('bundle_rev'))
+        # Checked before anything is extracted or written.
+        try:
+            for item in manifest['files'] + manifest['loader']:
+                item['path'] = self.manifest_path(item['path'])
+            manifest['directories'] = [
+                self.manifest_path(path) for path in manifest['directories']]
+            manifest['nvram'] = [self.manifest_entry(item)
+                                 for item in manifest['nvram']]
+        except (KeyError, TypeError, AttributeError) as e:
+            raise BundleError('Malformed manifest in %s' % self.path) from e
+        for key, value in identity.items():
+            if manifest['identity'].get(key) != value:
+                self.log.debug('Bundle %s: %s, this host: %s', key,
+                               manifest['identity'].get(key), value)
+                raise BundleError(
+                    'The bundle was built for a different %s' %
+                    self.identity_names.get(key, key))
+        self.log.info('Bundle from %s matches this host',
+                      time.ctime(manifest['created']))
+        self.manifest = manifest
+
+    def extract_file(self, archive, member, item, tmp_path):
+        # Hashed while streaming, so each file is only read once.
+        digest = hashlib.sha256()
+        size = 0
+        in_obj = archive.extractfile(member)
+        out_obj = None
+        if tmp_path is not None:
+            out_obj = open(tmp_path, 'wb')
+        try:
+            while True:
+                data = in_obj.read(self.chunk_size)
+                if not data:
+                    break
+                size = size + len(data)
+                digest.update(data)
+                if out_obj is not None:
+                    out_obj.write(data)
+        finally:
+            if out_obj is not None:
+                out_obj.close()
+        if size != item['size'] or digest.hexdigest() != item['sha256']:
+            raise BundleError('%s doesn\'t match its digest' % member.name)
+
+    def remove_all(self, paths):
+        for path in paths:
+            if os.path.exists(path):
+                os.remove(path)
@@ -22,10 +22,13 @@ Please see the provided LICENSE.txt file for additional distribution/copyright
 terms.
 """
 
-import json, os, logging
+import copy, json, logging
 
-class ConfigError(Exception):
-    pass
+from .backend import SystemBackend
+from .errors import KernelstubError
+
+class ConfigError(KernelstubError):
+    exit_code = 169
 
 class Config():
 
@@ -39,45 +42,64 @@ class Config():
             'manage_mode': False,
             'force_update' : False,
             'live_mode' : False,
-            'config_rev' : 3
+            'file_log_level' : 'info',
+            'low_impact_io' : False,
+            'io_rate_limit' : 52428800,
+            'kernel_flavor' : None,
+            'pinned_kernel' : None,
+            'initrd_budget' : 0,
+            'metrics_dir' : None,
+            'verify_copies' : False,
+            'signing_key' : None,
+            'signing_cert' : None,
+            'defer_commit' : False,
+            'zboot_policy' : 'compressed',
+            'delta_updates' : False,
+            'defragment_esp' : False,
+            'share_early_initrd' : False,
+            'esp_layout' : 'fixed',
+            'history_days' : 90,
+            'config_rev' : 17
         }
     }
 
-    def __init__(self, path='/etc/kernelstub/configuration'):
+    def __init__(self, path='/etc/kernelstub/configuration', backend=None):
         self.log = logging.getLogger('kernelstub.Config')
         self.log.debug('loaded kernelstub.Config')
+        self.backend = backend
+        if backend is None:
+            self.backend = SystemBackend()
         self.config_path = path
         self.config = self.load_config()
-        os.makedirs('/etc/kernelstub/', exist_ok=True)
+        self.backend.makedirs('/etc/kernelstub')
 
     def load_config(self):
         self.log.info('Looking for configuration...')
 
-        if os.path.exists(self.config_path):
-            self.log.debug('Checking %s' % self.config_path)
+        if self.backend.exists(self.config_path):
+            self.log.debug('Checking %s', self.config_path)
 
-            with open(self.config_path) as config_file:
-                self.config = json.load(config_file)
+            self.config = json.loads(self.backend.read_text(self.config_path))
 
-        elif os.path.exists('/etc/default/kernelstub'):
+        elif self.backend.exists('/etc/default/kernelstub'):
             self.log.debug('Checking fallback /etc/default/kernelstub')
 
-            with open('/etc/default/kernelstub', mode='r') as config_file:
-                self.config = json.load(config_file)
+            self.config = json.loads(
+                self.backend.read_text('/etc/default/kernelstub'))
 
         else:
             self.log.info('No configuration file found, loading defaults.')
-            self.config = self.config_default
+            self.config = copy.deepcopy(self.config_default)
 
         self.log.debug('Configuration found!')
         try:
             user_config = self.config['user']
             self.log.debug(user_config)
         except KeyError:
-            self.config['user'] = self.config['default'].copy()
+            self.config['user'] = copy.deepcopy(self.config['default'])
 
         try:
-            self.log.debug('Configuration version: %s' % self.config['user']['config_rev'])
+            self.log.debug('Configuration version: %s', self.config['user']['config_rev'])
             if self.config['user']['config_rev'] < self.config_default['default']['config_rev']:
                 self.log.warning("Updating old configuration.")
                 self.config = self.update_config(self.config)
@@ -93,7 +115,6 @@ class Config():
                         self.config['user']['kernel_options'] = self.parse_options(self.config['user']['kernel_options'].split())
                     except:
                         raise ConfigError('Malformed configuration file found!')
-                        exit(169)
             else:
                 raise ConfigError("Configuration cannot be understood!")
         except KeyError:
@@ -103,10 +124,9 @@ class Config():
         return self.config
 
     def save_config(self, path='/etc/kernelstub/configuration'):
-        self.log.debug('Saving configuration to %s' % path)
+        self.log.debug('Saving configuration to %s', path)
 
-        with open(path, mode='w') as config_file:
-            json.dump(self.config, config_file, indent=2)
+        self.backend.write_text(path, json.dumps(self.config, indent=2))
         
         self.log.debug('Configuration saved!')
         return 0
@@ -120,8 +140,53 @@ class Config():
                 config['user']['kernel_options'] = self.parse_options(config['user']['kernel_options'].split())
             if type(config['default']['kernel_options']) is str:
                 config['default']['kernel_options'] = self.parse_options(config['default']['kernel_options'].split())
-        config['user']['config_rev'] = 3
-        config['default']['config_rev'] = 3
+        if config['user']['config_rev'] < 4:
+            config['user']['file_log_level'] = 'info'
+            config['default']['file_log_level'] = 'info'
+        if config['user']['config_rev'] < 5:
+            for section in ('user', 'default'):
+                config[section]['low_impact_io'] = False
+                config[section]['io_rate_limit'] = 52428800
+        if config['user']['config_rev'] < 6:
+            for section in ('user', 'default'):
+                config[section]['kernel_flavor'] = None
+                config[section]['pinned_kernel'] = None
+        if config['user']['config_rev'] < 7:
+            for section in ('user', 'default'):
+                config[section]['initrd_budget'] = 0
+        if config['user']['config_rev'] < 8:
+            for section in ('user', 'default'):
+                config[section]['metrics_dir'] = None
+        if config['user']['config_rev'] < 9:
+            for section in ('user', 'default'):
+                config[section]['verify_copies'] = False
+        if config['user']['config_rev'] < 10:
+            for section in ('user', 'default'):
+                config[section]['signing_key'] = None
+                config[section]['signing_cert'] = None
+        if config['user']['config_rev'] < 11:
+            for section in ('user', 'default'):
+                config[section]['defer_commit'] = False
+        if config['user']['config_rev'] < 12:
+            for section in ('user', 'default'):
+                config[section]['zboot_policy'] = 'compressed'
+        if config['user']['config_rev'] < 13:
+            for section in ('user', 'default'):
+                config[section]['delta_updates'] = False
+        if config['user']['config_rev'] < 14:
+            for section in ('user', 'default'):
+                config[section]['defragment_esp'] = False
+        if config['user']['config_rev'] < 15:
+            for section in ('user', 'default'):
+                config[section]['share_early_initrd'] = False
+        if config['user']['config_rev'] < 16:
+            for section in ('user', 'default'):
+                config[section]['esp_layout'] = 'fixed'
+        if config['user']['config_rev'] < 17:
+            for section in ('user', 'default'):
+                config[section]['history_days'] = 90
+        config['user']['config_rev'] = 17
+        config['default']['config_rev'] = 17
         return config
 
     def parse_options(self, options):
@@ -22,13 +22,16 @@ Please see the provided LICENSE.txt file for additional distribution/copyright
 terms.
 """
 
-import os, logging, subprocess
+import os, logging
 
-class NoBlockDevError(Exception):
-    pass
+from .backend import SystemBackend
+from .errors import KernelstubError
 
-class UUIDNotFoundError(Exception):
-    pass
+class NoBlockDevError(KernelstubError):
+    exit_code = 174
+
+class UUIDNotFoundError(KernelstubError):
+    exit_code = 177
 
 class Drive():
 
@@ -40,17 +43,39 @@ class Drive():
     esp_path = '/boot/efi'
     esp_num = 0
 
-    def __init__(self, root_path="/", esp_path="/boot/efi"):
+    def __init__(self, root_path="/", esp_path="/boot/efi", backend=None,
+                 facts=None):
         self.log = logging.getLogger('kernelstub.Drive')
         self.log.debug('loaded kernelstub.Drive')
 
+        self.backend = backend
+        if backend is None:
+            self.backend = SystemBackend()
+
         self.esp_path = esp_path
         self.root_path = root_path
-        self.log.debug('root path = %s' % self.root_path)
-        self.log.debug('esp_path = %s' % self.esp_path)
+        self.log.debug('root path = %s', self.root_path)
+        self.log.debug('esp_path = %s', self.esp_path)
 
         self.mtab = self.get_drives()
 
+        # The devices and UUID only change when something is (re)mounted.
+        # An automounted ESP coming and going doesn't count, so a cached
+        # run never has to mount it.
+        group = 'drive %s %s' % (self.root_path, self.esp_path)
+        key = None
+        cached = None
+        if facts is not None:
+            key = {'mounts' : facts.digest(''.join(self.stable_mounts()))}
+            cached = facts.get(group, key)
+        if cached is not None:
+            self.root_fs = cached['root_fs']
+            self.esp_fs = cached['esp_fs']
+            self.drive_name = cached['drive_name']
+            self.esp_num = cached['esp_num']
+            self.root_uuid = cached['root_uuid']
+            return
+
         try:
             self.root_fs = self.get_part_dev(self.root_path)
             self.esp_fs = self.get_part_dev(self.esp_path)
@@ -62,52 +87,83 @@ class Drive():
                                'partition. This is a critical error and we ' +
                                'cannot continue.')
             self.log.debug(e)
-            exit(174)
+            raise
         except UUIDNotFoundError as e:
             self.log.exception('Could not get a UUID for the a filesystem. ' +
                                'This is a critical error and we cannot continue')
             self.log.debug(e)
-            exit(177)
+            raise
 
 
-        self.log.debug('Root is on /dev/%s' % self.drive_name)
-        self.log.debug('root_fs = %s ' % self.root_fs)
-        self.log.debug('root_uuid is %s' % self.root_uuid)
+        self.log.debug('Root is on /dev/%s', self.drive_name)
+        self.log.debug('root_fs = %s ', self.root_fs)
+        self.log.debug('root_uuid is %s', self.root_uuid)
+        if facts is not None:
+            facts.put(group, key, {
+                'root_fs' : self.root_fs,
+                'esp_fs' : self.esp_fs,
+                'drive_name' : self.drive_name,
+                'esp_num' : self.esp_num,
+                'root_uuid' : self.root_uuid,
+            })
 
 
     def get_drives(self):
         self.log.debug('Getting a list of drives')
-        with open('/proc/mounts', mode='r') as proc_mounts:
-            mtab = proc_mounts.readlines()
+        mtab = self.backend.read_text('/proc/mounts').splitlines(keepends=True)
 
-        self.log.debug(mtab)
+        self.log.debug('Mount table: %s', mtab)
         return mtab
 
-    def get_part_dev(self, path):
-        self.log.debug('Getting the block device file for %s' % path)
+    def autofs_paths(self):
+        return {mount.split(" ")[1] for mount in self.mtab
+                if mount.split(" ")[2] == 'autofs'}
+
+    def stable_mounts(self):
+        # Everything but the filesystems mounted on demand over autofs.
+        autofs = self.autofs_paths()
+        return [mount for mount in self.mtab
+                if mount.split(" ")[1] not in autofs
+                or mount.split(" ")[2] == 'autofs']
+
+    def get_part_dev(self, path, trigger=True):
+        self.log.debug('Getting the block device file for %s', path)
+        automount = False
         for mount in self.mtab:
             drive = mount.split(" ")
-            if drive[1] == path:
-                part_dev = os.path.realpath(drive[0])
-                self.log.debug('%s is on %s' % (path, part_dev))
-                return part_dev
+            if drive[1] != path:
+                continue
+            # x-systemd.automount leaves an autofs entry, with the real
+            # filesystem listed after it once something has accessed it.
+            if drive[2] == 'autofs':
+                automount = True
+                continue
+            part_dev = self.backend.realpath(drive[0])
+            self.log.debug('%s is on %s', path, part_dev)
+            return part_dev
+
+        if automount and trigger:
+            # Looking inside the mount point mounts it; once is enough.
+            self.log.info('%s is mounted on demand, mounting it now', path)
+            self.backend.exists(os.path.join(path, '.'))
+            self.mtab = self.get_drives()
+            return self.get_part_dev(path, trigger=False)
         raise NoBlockDevError('Couldn\'t find the block device for %s' % path)
 
     def get_drive_dev(self, esp):
         # Ported from bash, out of @jackpot51's firmware updater
         efi_name = os.path.basename(esp)
-        efi_sys = os.readlink('/sys/class/block/%s' % efi_name)
+        efi_sys = self.backend.readlink('/sys/class/block/%s' % efi_name)
         disk_sys = os.path.dirname(efi_sys)
         disk_name = os.path.basename(disk_sys)
-        self.log.debug('ESP is a partition on /dev/%s' % disk_name)
+        self.log.debug('ESP is a partition on /dev/%s', disk_name)
         return disk_name
 
     def get_uuid(self, path):
-        self.log.debug('Looking for UUID for path %s' % path)
+        self.log.debug('Looking for UUID for path %s', path)
         try:
             args = ['findmnt', '-n', '-o', 'UUID', '--mountpoint', path]
-            result = subprocess.run(args, stdout=subprocess.PIPE)
-            uuid = result.stdout.decode('ASCII')
+            uuid = self.backend.run(args)
             uuid = uuid.strip()
             return uuid
         except OSError as e:
@@ -0,0 +1,37 @@
+#!/usr/bin/python3
+
+"""
+ kernelstub
+ The automatic manager for using the Linux Kernel EFI Stub to boot
+
+ Copyright 2017-2018 Ian Santopietro <isantop@gmail.com>
+
+Permission to use, copy, modify, and/or distribute this software for any purpose
+with or without fee is hereby granted, provided that the above copyright notice
+and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS
+OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF
+THIS SOFTWARE.
+
+Please see the provided LICENSE.txt file for additional distribution/copyright
+terms.
+"""
+
+class KernelstubError(Exception):
+    """Base class for errors that should stop kernelstub.
+
+    exit_code is the status the command line tool exits with, see the
+    "Return codes" table in the README.
+    """
+
+    exit_code = 1
+
+    def __init__(self, *args, exit_code=None):
+        super().__init__(*args)
+        if exit_code is not None:
+            self.exit_code = exit_code
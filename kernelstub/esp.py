@@ -0,0 +1,171 @@
+#!/usr/bin/python3
+
+"""
+ kernelstub
+ The automatic manager for using the Linux Kernel EFI Stub to boot
+
+ Copyright 2017-2018 Ian Santopietro <isantop@gmail.com>
+
+Permission to use, copy, modify, and/or distribute this software for any purpose
+with or without fee is hereby granted, provided that the above copyright notice
+and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS
+OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF
+THIS SOFTWARE.
+
+Please see the provided LICENSE.txt file for additional distribution/copyright
+terms.
+"""
+
+import logging, os, re
+
+from .backend import SystemBackend
+from .errors import KernelstubError
+
+class ESPError(KernelstubError):
+    exit_code = 184
+
+class ESP():
+
+    # kernelstub installs into EFI/<os name>-<root fs UUID>. FAT and NTFS
+    # roots have short UUIDs, everything else uses the usual 36 characters.
+    dir_pattern = re.compile(
+        r'^(?P<name>.+)-(?P<uuid>'
+        r'[0-9a-fA-F]{8}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{4}-[0-9a-fA-F]{12}'
+        r'|[0-9a-fA-F]{4}-[0-9a-fA-F]{4}|[0-9a-fA-F]{16})$')
+
+    def __init__(self, esp_path, nvram_lines=None, root_uuid=None,
+                 backend=None):
+        self.log = logging.getLogger('kernelstub.ESP')
+        self.log.debug('loaded kernelstub.ESP')
+
+        self.backend = backend
+        if backend is None:
+            self.backend = SystemBackend()
+        self.esp_path = esp_path
+        self.nvram_lines = [line for line in nvram_lines or [] if line.strip()]
+        # The running system's directory is never an orphan, even when its
+        # root filesystem doesn't show up (e.g. inside a chroot).
+        self.root_uuid = None
+        if root_uuid:
+            self.root_uuid = root_uuid.lower()
+        self.directories = []
+        self.entries = []
+
+    def scan(self):
+        self.directories = []
+        self.entries = []
+        efi_dir = os.path.join(self.esp_path, 'EFI')
+        for name in self.listdir(efi_dir):
+            path = os.path.join(efi_dir, name)
+            match = self.dir_pattern.match(name)
+            if not match or not self.backend.isdir(path):
+                continue
+            self.directories.append({
+                'name' : name,
+                'path' : path,
+                'os_name' : match.group('name'),
+                'uuid' : match.group('uuid').lower(),
+                'size' : self.tree_size(path),
+                'entries' : [],
+                'nvram' : [],
+            })
+
+        by_name = {item['name'].lower() : item for item in self.directories}
+        entry_dir = os.path.join(self.esp_path, 'loader', 'entries')
+        for name in self.listdir(entry_dir):
+            path = os.path.join(entry_dir, name)
+            if not name.endswith('.conf') or self.backend.isdir(path):
+                continue
+            directory = self.entry_directory(path)
+            if directory is None or directory.lower() not in by_name:
+                continue
+            by_name[directory.lower()]['entries'].append(path)
+            self.entries.append(path)
+
+        for line in self.nvram_lines:
+            lowered = line.lower()
+            for name, item in by_name.items():
+                if '\\efi\\%s\\' % name in lowered or '/efi/%s/' % name in lowered:
+                    item['nvram'].append(line[:8])
+
+        present = self.backend.present_uuids()
+        for item in self.directories:
+            item['present'] = (item['uuid'] in present or
+                               item['uuid'] == self.root_uuid)
+            item['orphan'] = (not item['present'] and not item['nvram'] and
+                              not item['entries'])
+        return self.directories
+
+    def listdir(self, path):
+        try:
+            return self.backend.listdir(path)
+        except OSError as e:
+            self.log.debug('Couldn\'t scan %s: %s', path, e)
+            return []
+
+    def tree_size(self, path):
+        size = 0
+        for name in self.listdir(path):
+            child = os.path.join(path, name)
+            if self.backend.isdir(child):
+                size = size + self.tree_size(child)
+            else:
+                size = size + self.backend.size(child)
+        return size
+
+    def entry_directory(self, path):
+        # The directory an entry boots from is the first part of its
+        # linux line: "linux /EFI/<directory>/vmlinuz.efi"
+        try:
+            for line in self.backend.read_text(path).splitlines():
+                if line.startswith('linux '):
+                    parts = line.split()[1].replace('\\', '/').split('/')
+                    parts = [part for part in parts if part]
+                    if len(parts) > 2 and parts[0].upper() == 'EFI':
+                        return parts[1]
+        except OSError as e:
+            self.log.debug('Couldn\'t read %s: %s', path, e)
+        return None
+
+    def orphans(self):
+        return [item for item in self.directories if item['orphan']]
+
+    def collect(self, simulate=False):
+        if not self.nvram_lines:
+            # Without the firmware's entries (a chroot, or efibootmgr
+            # failing) a directory the firmware boots looks orphaned.
+            self.log.error('Couldn\'t read the NVRAM, refusing to remove '
+                           'anything from the ESP')
+            raise ESPError('No NVRAM entries to check the ESP against')
+        reclaimed = 0
+        for item in self.orphans():
+            if simulate:
+                self.log.info('Simulate removing orphaned %s (%s bytes)',
+                              item['path'], item['size'])
+                reclaimed = reclaimed + item['size']
+                continue
+            self.log.info('Removing orphaned %s (%s bytes)',
+                          item['path'], item['size'])
+            self.backend.rmtree(item['path'])
+            reclaimed = reclaimed + item['size']
+        return reclaimed
+
+    def report(self):
+        lines = ['%-60s %12s %-8s %-8s %s' % (
+            'Directory', 'Bytes', 'Present', 'NVRAM', 'Loader entries')]
+        for item in self.directories:
+            lines.append('%-60s %12s %-8s %-8s %s' % (
+                item['name'], item['size'],
+                'yes' if item['present'] else 'no',
+                ','.join(item['nvram']) or '-',
+                len(item['entries'])))
+        orphans = self.orphans()
+        lines.append('%s orphaned directories, %s bytes reclaimable' % (
+            len(orphans), sum(item['size'] for item in orphans)))
+        return '\n'.join(lines)
@@ -0,0 +1,95 @@
+#!/usr/bin/python3
+
+"""
+ kernelstub
+ The automatic manager for using the Linux Kernel EFI Stub to boot
+
+ Copyright 2017-2018 Ian Santopietro <isantop@gmail.com>
+
+Permission to use, copy, modify, and/or distribute this software for any purpose
+with or without fee is hereby granted, provided that the above copyright notice
+and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS
+OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF
+THIS SOFTWARE.
+
+Please see the provided LICENSE.txt file for additional distribution/copyright
+terms.
+"""
+
+
+import hashlib, logging
+
+from .backend import SystemBackend
+
+class Facts():
+    """Probed system facts, kept in the state directory for one boot.
+
+    Each group of facts is stored with the key it was probed under, such
+    as the mtime of the file it came from, and is only reused while the
+    key still matches. The whole snapshot is dropped when the boot ID
+    changes.
+    """
+
+    boot_id_path = '/proc/sys/kernel/random/boot_id'
+
+    def __init__(self, state=None, backend=None):
+        self.log = logging.getLogger('kernelstub.Facts')
+        self.log.debug('loaded kernelstub.Facts')
+        self.state = state
+        self.backend = backend
+        if backend is None:
+            self.backend = SystemBackend()
+        self.changed = False
+
+        try:
+            self.boot_id = self.backend.read_text(self.boot_id_path).strip()
+        except OSError as e:
+            self.log.debug('No boot ID, not caching system facts: %s', e)
+            self.boot_id = None
+
+        self.snapshot = {'boot_id' : self.boot_id, 'groups' : {}}
+        if self.boot_id and state is not None:
+            snapshot = state.load('facts.json', {})
+            if snapshot.get('boot_id') == self.boot_id:
+                self.snapshot = snapshot
+
+    def get(self, group, key):
+        """Return the facts stored for group under key, or None."""
+        if not self.boot_id:
+            return None
+        entry = self.snapshot['groups'].get(group)
+        if entry is None or entry['key'] != key:
+            self.log.debug('No current facts for %s', group)
+            return None
+        self.log.debug('Reusing facts for %s', group)
+        return entry['facts']
+
+    def put(self, group, key, facts):
+        self.snapshot['groups'][group] = {'key' : key, 'facts' : facts}
+        self.changed = True
+
+    def save(self):
+        if not (self.changed and self.boot_id and self.state is not None):
+            return 0
+        try:
+            self.state.save('facts.json', self.snapshot)
+            self.changed = False
+        except OSError as e:
+            # Only a cache; the next run probes again.
+            self.log.debug('Couldn\'t save system facts: %s', e)
+        return 0
+
+    def mtime(self, path):
+        try:
+            return self.backend.mtime(path)
+        except OSError:
+            return None
+
+    def digest(self, text):
+        return hashlib.sha256(text.encode('UTF-8')).hexdigest()
@@ -0,0 +1,235 @@
+#!/usr/bin/python3
+
+"""
+ kernelstub
+ The automatic manager for using the Linux Kernel EFI Stub to boot
+
+ Copyright 2017-2018 Ian Santopietro <isantop@gmail.com>
+
+Permission to use, copy, modify, and/or distribute this software for any purpose
+with or without fee is hereby granted, provided that the above copyright notice
+and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS
+OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF
+THIS SOFTWARE.
+
+Please see the provided LICENSE.txt file for additional distribution/copyright
+terms.
+"""
+
+
+import hashlib, json, logging, os, sqlite3, time
+
+from .state import State
+
+class History():
+    """Every kernelstub run, kept in an SQLite database for reporting.
+
+    Recording never fails a run: database errors are only logged.
+    """
+
+    file_name = 'history.db'
+    schema_rev = 1
+    schema = '''
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY,
+            started REAL NOT NULL,
+            duration REAL NOT NULL,
+            hostname TEXT,
+            status TEXT NOT NULL,
+            exit_code INTEGER NOT NULL,
+            dry_run INTEGER NOT NULL,
+            kernel_path TEXT,
+            kernel_version TEXT,
+            config_fingerprint TEXT,
+            bytes_read INTEGER NOT NULL,
+            bytes_written INTEGER NOT NULL,
+            nvram_writes INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS runs_started ON runs (started);
+        CREATE TABLE IF NOT EXISTS phases (
+            run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+            name TEXT NOT NULL,
+            duration REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS phases_run ON phases (run_id);
+        CREATE TABLE IF NOT EXISTS nvram (
+            run_id INTEGER NOT NULL REFERENCES runs (id) ON DELETE CASCADE,
+            action TEXT NOT NULL,
+            target TEXT
+        );
+        CREATE INDEX IF NOT EXISTS nvram_run ON nvram (run_id);
+    '''
+
+    # Statuses of runs that installed something or tried to. Reports and
+    # runs with nothing to do aren't recorded, nor counted from databases
+    # written before that.
+    install_statuses = ('complete', 'deferred', 'plan_applied', 'failed')
+
+    groups = {
+        'day' : "date(started, 'unixepoch', 'localtime')",
+        'month' : "strftime('%Y-%m', started, 'unixepoch', 'localtime')",
+        'kernel' : "coalesce(kernel_version, '-')",
+        'status' : 'status',
+        'host' : "coalesce(hostname, '-')",
+    }
+
+    def __init__(self, state=None, retention_days=90):
+        self.log = logging.getLogger('kernelstub.History')
+        self.log.debug('loaded kernelstub.History')
+        self.state = state
+        if state is None:
+            self.state = State()
+        self.backend = self.state.backend
+        self.path = self.state.path(self.file_name)
+        self.retention_days = retention_days
+
+    def connect(self, read_only=False):
+        database = self.backend.database(self.path)
+        if read_only:
+            db = sqlite3.connect('file:%s?mode=ro' % database, uri=True)
+            db.row_factory = sqlite3.Row
+            return db
+        self.backend.makedirs(self.state.state_dir)
+        db = sqlite3.connect(database, timeout=10)
+        db.row_factory = sqlite3.Row
+        db.execute('PRAGMA foreign_keys = ON')
+        if db.execute('PRAGMA user_version').fetchone()[0] < self.schema_rev:
+            # auto_vacuum only takes effect if set before any table exists.
+            db.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            db.executescript(self.schema)
+            db.execute('PRAGMA user_version = %d' % self.schema_rev)
+        return db
+
+    def fingerprint(self, configuration):
+        if configuration is None:
+            return None
+        data = json.dumps(configuration, sort_keys=True).encode('UTF-8')
+        return hashlib.sha256(data).hexdigest()[:16]
+
+    def record(self, metrics, result, dry_run=False):
+        """Store a finished run described by metrics and result."""
+        if not self.retention_days:
+            return None
+        end = metrics.end
+        if end is None:
+            end = time.time()
+        bytes_read = bytes_written = 0
+        if metrics.transfer is not None:
+            bytes_read = metrics.transfer.bytes_read
+            bytes_written = metrics.transfer.bytes_written
+        nvram_changes = []
+        if metrics.nvram is not None:
+            nvram_changes = metrics.nvram.changes
+        # Runs stopped by an error never get a status.
+        status = result.status
+        if metrics.exit_status or status is None:
+            status = 'failed'
+
+        run_id = None
+        try:
+            db = self.connect()
+        except (OSError, sqlite3.Error) as e:
+            self.log.warning('Couldn\'t open the run history %s', self.path)
+            self.log.debug(e)
+            return None
+        try:
+            with db:
+                cursor = db.execute(
+                    'INSERT INTO runs (started, duration, hostname, status, '
+                    'exit_code, dry_run, kernel_path, kernel_version, '
+                    'config_fingerprint, bytes_read, bytes_written, '
+                    'nvram_writes) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    (metrics.start, end - metrics.start, os.uname().nodename,
+                     status, metrics.exit_status, int(dry_run),
+                     result.kernel_path, metrics.kernel_version,
+                     self.fingerprint(result.configuration), bytes_read,
+                     bytes_written, len(nvram_changes)))
+                run_id = cursor.lastrowid
+                db.executemany(
+                    'INSERT INTO phases (run_id, name, duration) '
+                    'VALUES (?, ?, ?)',
+                    [(run_id, name, duration)
+                     for name, duration in metrics.phases])
+                db.executemany(
+                    'INSERT INTO nvram (run_id, action, target) '
+                    'VALUES (?, ?, ?)',
+                    [(run_id, action, str(target))
+                     for action, target in nvram_changes])
+            self.compact(db)
+        except sqlite3.Error as e:
+            self.log.warning('Couldn\'t record this run in %s', self.path)
+            self.log.debug(e)
+        finally:
+            db.close()
+        self.log.debug('Recorded run %s', run_id)
+        return run_id
+
+    def compact(self, db):
+        """Drop runs older than the retention period and free their pages."""
+        cutoff = time.time() - self.retention_days * 86400
+        with db:
+            removed = db.execute(
+                'DELETE FROM runs WHERE started < ?', (cutoff,)).rowcount
+        if removed:
+            self.log.debug('Removed %s runs older than %s days', removed,
+                           self.retention_days)
+            db.execute('PRAGMA incremental_vacuum')
+        return removed
+
+    def summary(self, since_days=30, group_by='month'):
+        """Totals for the runs in the last since_days days, which changed
+        the system, grouped by day, month, kernel, status or host."""
+        if not self.backend.exists(self.path):
+            return [], []
+        cutoff = time.time() - since_days * 86400
+        db = self.connect(read_only=True)
+        try:
+            groups = db.execute(
+                'SELECT %s AS name, count(*) AS runs, '
+                'sum(status = \'failed\') AS failed, sum(duration) AS total, '
+                'avg(duration) AS average, max(duration) AS longest, '
+                'sum(bytes_written) AS bytes_written, '
+                'sum(nvram_writes) AS nvram_writes '
+                'FROM runs WHERE started >= ? AND dry_run = 0 '
+                'AND status IN (?, ?, ?, ?) '
+                'GROUP BY name ORDER BY name' % self.groups[group_by],
+                (cutoff,) + self.install_statuses).fetchall()
+            phases = db.execute(
+                'SELECT phases.name AS name, count(*) AS runs, '
+                'sum(phases.duration) AS total, avg(phases.duration) AS average, '
+                'max(phases.duration) AS longest '
+                'FROM phases JOIN runs ON runs.id = phases.run_id '
+                'WHERE runs.started >= ? AND runs.dry_run = 0 '
+                'AND runs.status IN (?, ?, ?, ?) '
+                'GROUP BY phases.name ORDER BY total DESC',
+                (cutoff,) + self.install_statuses).fetchall()
+        finally:
+            db.close()
+        return groups, phases
+
+    def report(self, since_days=30, group_by='month'):
+        groups, phases = self.summary(since_days, group_by)
+        if not groups:
+            return 'No runs recorded in the last %s days' % since_days
+        lines = ['%-24s %5s %6s %10s %9s %9s %12s %5s' % (
+            group_by.capitalize(), 'Runs', 'Failed', 'Total', 'Average',
+            'Longest', 'ESP bytes', 'NVRAM')]
+        for row in groups:
+            lines.append('%-24s %5s %6s %9.2fs %8.2fs %8.2fs %12s %5s' % (
+                row['name'], row['runs'], row['failed'], row['total'],
+                row['average'], row['longest'], row['bytes_written'],
+                row['nvram_writes']))
+        lines.append('')
+        lines.append('%-24s %5s %16s %9s %9s' % (
+            'Phase', 'Runs', 'Total', 'Average', 'Longest'))
+        for row in phases:
+            lines.append('%-24s %5s %15.2fs %8.2fs %8.2fs' % (
+                row['name'], row['runs'], row['total'], row['average'],
+                row['longest']))
+        return '\n'.join(lines)
@@ -0,0 +1,367 @@
+#!/usr/bin/python3
+
+"""
+ kernelstub
+ The automatic manager for using the Linux Kernel EFI Stub to boot
+
+ Copyright 2017-2018 Ian Santopietro <isantop@gmail.com>
+
+Permission to use, copy, modify, and/or distribute this software for any purpose
+with or without fee is hereby granted, provided that the above copyright notice
+and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS
+OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF
+THIS SOFTWARE.
+
+Please see the provided LICENSE.txt file for additional distribution/copyright
+terms.
+"""
+
+import bz2, logging, lzma, os, time, zlib
+
+from .errors import KernelstubError
+
+zstd_support = False
+try:
+    import zstandard
+    zstd_support = True
+
+except ImportError:
+    pass
+
+def decompressor(compression):
+    """Return a streaming decompressor for compression, or None."""
+    if compression == 'gzip':
+        return zlib.decompressobj(wbits=31)
+    if compression in ('xz', 'lzma'):
+        return lzma.LZMADecompressor()
+    if compression == 'bzip2':
+        return bz2.BZ2Decompressor()
+    if compression == 'zstd' and zstd_support:
+        return ZstdDecompressor()
+    return None
+
+class InitrdError(KernelstubError):
+    pass
+
+class RawReader():
+    """Reads a file sequentially, allowing bytes to be pushed back."""
+
+    chunk_size = 1048576
+
+    def __init__(self, file_obj):
+        self.file_obj = file_obj
+        self.buffer = b''
+        self.offset = 0
+
+    def read_chunk(self):
+        if self.buffer:
+            data, self.buffer = self.buffer, b''
+        else:
+            data = self.file_obj.read(self.chunk_size)
+        self.offset = self.offset + len(data)
+        return data
+
+    def unread(self, data):
+        self.buffer = data + self.buffer
+        self.offset = self.offset - len(data)
+
+    def peek(self, size):
+        while len(self.buffer) < size:
+            data = self.file_obj.read(self.chunk_size)
+            if not data:
+                break
+            self.buffer = self.buffer + data
+        return self.buffer[:size]
+
+    def skip_padding(self):
+        while True:
+            data = self.read_chunk()
+            if not data:
+                return
+            stripped = data.lstrip(b'\0')
+            if stripped:
+                self.unread(stripped)
+                return
+
+class SegmentReader():
+    """Reads one segment, decompressing it on the fly if needed."""
+
+    def __init__(self, raw, decompressor=None):
+        self.raw = raw
+        self.decompressor = decompressor
+        self.buffer = bytearray()
+        self.eof = False
+        self.decompress_time = 0.0
+        self.size = 0
+
+    def fill(self, size):
+        while len(self.buffer) < size and not self.eof:
+            data = self.raw.read_chunk()
+            if not data:
+                self.eof = True
+                break
+            if self.decompressor is None:
+                self.buffer.extend(data)
+                continue
+            start = time.perf_counter()
+            try:
+                self.buffer.extend(self.decompressor.decompress(data))
+            except (zlib.error, lzma.LZMAError, OSError, EOFError) as e:
+                # bz2 reports corrupt data as OSError.
+                raise InitrdError('Corrupt compressed segment: %s' % e) from e
+            self.decompress_time = (self.decompress_time +
+                                    time.perf_counter() - start)
+            if self.decompressor.eof:
+                # Anything after the end of the stream is the next segment.
+                self.raw.unread(self.decompressor.unused_data)
+                self.eof = True
+
+    def read(self, size):
+        self.fill(size)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        self.size = self.size + len(data)
+        return data
+
+    def skip(self, size):
+        while size > 0:
+            data = self.read(min(size, RawReader.chunk_size))
+            if not data:
+                raise InitrdError('Truncated cpio archive')
+            size = size - len(data)
+
+    def at_end(self):
+        # Compressed streams may carry NUL padding between cpio archives.
+        while True:
+            self.fill(1)
+            if not self.buffer:
+                return True
+            stripped = self.buffer.lstrip(b'\0')
+            self.size = self.size + len(self.buffer) - len(stripped)
+            self.buffer = bytearray(stripped)
+            if self.buffer:
+                return False
+
+    def finish(self):
+        # Uncompressed segments end at their trailer, not at the file end.
+        if self.decompressor is None:
+            self.raw.unread(bytes(self.buffer))
+            self.buffer = bytearray()
+
+class SliceReader():
+    """Reads size bytes of a file, starting at offset."""
+
+    def __init__(self, file_obj, offset, size):
+        self.file_obj = file_obj
+        self.file_obj.seek(offset)
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.file_obj.read(size)
+        self.remaining = self.remaining - len(data)
+        return data
+
+class Initrd():
+
+    compressions = [
+        (b'\x1f\x8b', 'gzip'),
+        (b'\xfd7zXZ\x00', 'xz'),
+        (b'\x5d\x00\x00', 'lzma'),
+        (b'BZh', 'bzip2'),
+        (b'\x28\xb5\x2f\xfd', 'zstd'),
+        (b'\x02\x21\x4c\x18', 'lz4'),
+        (b'\x89LZO', 'lzo'),
+    ]
+    categories = [
+        ('lib/firmware/', 'firmware'),
+        ('usr/lib/firmware/', 'firmware'),
+        ('kernel/', 'firmware'),
+        ('lib/modules/', 'modules'),
+        ('usr/lib/modules/', 'modules'),
+    ]
+
+    def __init__(self, path):
+        self.log = logging.getLogger('kernelstub.Initrd')
+        self.log.debug('loaded kernelstub.Initrd')
+        self.path = path
+
+    def decompressor(self, compression):
+        return decompressor(compression)
+
+    def category(self, name):
+        for prefix, category in self.categories:
+            if name.startswith(prefix):
+                return category
+        return 'userspace'
+
+    def early_size(self):
+        """Return the size of the early cpio archives starting the initrd.
+
+        These are the uncompressed archives holding only CPU microcode and
+        firmware, which are the same for every kernel. Returns 0 if there
+        are none, or if there is nothing after them to split off.
+        """
+        with open(self.path, 'rb') as initrd_file:
+            raw = RawReader(initrd_file)
+            while True:
+                raw.skip_padding()
+                offset = raw.offset
+                magic = raw.peek(6)
+                if not magic:
+                    return 0
+                if not magic.startswith(b'07070'):
+                    return offset
+                segment = {
+                    'files' : 0,
+                    'categories' : {'firmware' : 0, 'modules' : 0, 'userspace' : 0},
+                }
+                reader = SegmentReader(raw)
+                self.read_cpio(reader, segment)
+                reader.finish()
+                if (segment['categories']['modules'] or
+                        segment['categories']['userspace']):
+                    return offset
+
+    def opener(self, offset, size):
+        """Return an opener reading one part of the initrd, for Transfer."""
+        return lambda file_obj: SliceReader(file_obj, offset, size)
+
+    def analyze(self):
+        segments = []
+        with open(self.path, 'rb') as initrd_file:
+            raw = RawReader(initrd_file)
+            while True:
+                raw.skip_padding()
+                magic = raw.peek(6)
+                if not magic:
+                    break
+                segments.append(self.analyze_segment(raw, magic))
+
+        summary = {
+            'path' : self.path,
+            'size' : os.path.getsize(self.path),
+            'uncompressed_size' : 0,
+            'categories' : {'firmware' : 0, 'modules' : 0, 'userspace' : 0},
+            'segments' : segments,
+        }
+        for segment in segments:
+            summary['uncompressed_size'] = (summary['uncompressed_size'] +
+                                            (segment['uncompressed_size'] or 0))
+            for category, size in segment['categories'].items():
+                summary['categories'][category] = (
+                    summary['categories'][category] + size)
+        return summary
+
+    def analyze_segment(self, raw, magic):
+        offset = raw.offset
+        compression = None
+        if not magic.startswith(b'07070'):
+            compression = 'unknown'
+            for signature, name in self.compressions:
+                if magic.startswith(signature):
+                    compression = name
+                    break
+
+        segment = {
+            'offset' : offset,
+            'compression' : compression,
+            'compressed_size' : None,
+            'uncompressed_size' : None,
+            'decompress_seconds' : None,
+            'throughput' : None,
+            'files' : 0,
+            'categories' : {'firmware' : 0, 'modules' : 0, 'userspace' : 0},
+        }
+
+        decompressor = None
+        if compression is not None:
+            decompressor = self.decompressor(compression)
+            if decompressor is None:
+                # Can't look inside, but the rest of the file is this segment.
+                while raw.read_chunk():
+                    pass
+                segment['compressed_size'] = raw.offset - offset
+                self.log.debug('Can\'t decompress %s segment at %s',
+                               compression, offset)
+                return segment
+
+        reader = SegmentReader(raw, decompressor)
+        self.read_cpio(reader, segment)
+        while decompressor is not None and not reader.at_end():
+            self.read_cpio(reader, segment)
+        reader.finish()
+
+        segment['compressed_size'] = raw.offset - offset
+        segment['uncompressed_size'] = reader.size
+        if decompressor is not None:
+            segment['decompress_seconds'] = reader.decompress_time
+            if reader.decompress_time > 0:
+                segment['throughput'] = int(reader.size / reader.decompress_time)
+        return segment
+
+    def read_cpio(self, reader, segment):
+        while True:
+            header = reader.read(110)
+            if len(header) < 110 or header[:5] != b'07070':
+                raise InitrdError('Bad cpio header in %s' % self.path)
+            try:
+                file_size = int(header[54:62], 16)
+                name_size = int(header[94:102], 16)
+                mode = int(header[14:22], 16)
+            except ValueError as e:
+                raise InitrdError('Bad cpio header in %s' % self.path) from e
+
+            name = reader.read(name_size)[:-1].decode('UTF-8', 'replace')
+            reader.skip((4 - (110 + name_size) % 4) % 4)
+            if name == 'TRAILER!!!':
+                return
+
+            reader.skip(file_size + (4 - file_size % 4) % 4)
+            if mode & 0o170000 == 0o100000:
+                segment['files'] = segment['files'] + 1
+                category = self.category(name.lstrip('./'))
+                segment['categories'][category] = (
+                    segment['categories'][category] + file_size)
+
+    def report(self, summary):
+        lines = ['%s: %s bytes, %s bytes uncompressed' % (
+            summary['path'], summary['size'], summary['uncompressed_size'])]
+        for category, size in sorted(summary['categories'].items(),
+                                     key=lambda item: -item[1]):
+            lines.append('    %-10s %12s bytes' % (category, size))
+        for segment in summary['segments']:
+            line = '    segment at %s: %s, %s bytes' % (
+                segment['offset'], segment['compression'] or 'uncompressed',
+                segment['compressed_size'])
+            if segment['throughput']:
+                line = line + ' => %s bytes, %.1f MB/s decompression' % (
+                    segment['uncompressed_size'],
+                    segment['throughput'] / 1000000)
+            lines.append(line)
+        return '\n'.join(lines)
+
+class ZstdDecompressor():
+    """Gives zstandard the same interface as the stdlib decompressors."""
+
+    def __init__(self):
+        self.decompressor = zstandard.ZstdDecompressor().decompressobj()
+        self.eof = False
+        self.unused_data = b''
+
+    def decompress(self, data):
+        try:
+            output = self.decompressor.decompress(data)
+        except zstandard.ZstdError as e:
+            raise InitrdError('Corrupt compressed segment: %s' % e) from e
+        if self.decompressor.eof:
+            self.eof = True
+            self.unused_data = self.decompressor.unused_data
+        return output
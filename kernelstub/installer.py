@@ -22,12 +22,20 @@ Please see the provided LICENSE.txt file for additional distribution/copyright
 terms.
 """
 
-import os, shutil, logging, gzip
+import hashlib, os, logging, re, time
 
 from pathlib import Path
 
-class FileOpsError(Exception):
-    pass
+from .backend import SystemBackend
+from .errors import KernelstubError
+from .transfer import Transfer, TransferError
+from .plugins import Plugins, PluginError
+from .initrd import Initrd, InitrdError, SliceReader
+from .kernel_image import KernelImage, KernelImageError
+from .signing import SigningError
+
+class FileOpsError(KernelstubError):
+    exit_code = 170
 
 class Installer():
 
@@ -36,14 +44,39 @@ class Installer():
     os_dir_name = 'linux-kernelstub'
     work_dir = '/boot/efi/EFI/'
     old_kernel = True
+    # Files named after their contents, which are shared between slots.
+    blob_pattern = re.compile(r'^(early|vmlinuz|initrd)-[0-9a-f]{16}\.(img|efi)$')
 
-    def __init__(self, nvram, opsys, drive):
+    def __init__(self, nvram, opsys, drive, plan=None, transfer=None,
+                 initrd_budget=0, signer=None, zboot_policy='compressed',
+                 backend=None, plugins=None, share_early_initrd=False,
+                 esp_layout='fixed', full_plan=False):
         self.log = logging.getLogger('kernelstub.Installer')
         self.log.debug('loaded kernelstub.Installer')
 
+        self.backend = backend
+        if backend is None:
+            self.backend = SystemBackend()
+        self.plugins = plugins
+        if plugins is None:
+            self.plugins = Plugins()
         self.nvram = nvram
         self.opsys = opsys
         self.drive = drive
+        self.plan = plan
+        self.transfer = transfer
+        if transfer is None:
+            self.transfer = Transfer()
+        self.files_written = []
+        self.initrd_budget = initrd_budget
+        self.signer = signer
+        self.zboot_policy = zboot_policy
+        self.share_early_initrd = share_early_initrd
+        self.esp_layout = esp_layout
+        # Plan every file, even those already on the ESP, for bundles.
+        self.full_plan = full_plan
+        self.kernel_info = None
+        self.blobs = set()
 
         self.work_dir = os.path.join(self.drive.esp_path, "EFI")
         self.loader_dir = os.path.join(self.drive.esp_path, "loader")
@@ -51,15 +84,14 @@ class Installer():
         self.os_dir_name = "%s-%s" % (self.opsys.name, self.drive.root_uuid)
         self.os_folder = os.path.join(self.work_dir, self.os_dir_name)
         self.kernel_dest = os.path.join(self.os_folder, self.opsys.kernel_name)
+        self.kernel_file = '%s.efi' % self.opsys.kernel_name
+        self.old_kernel_file = '%s-previous.efi' % self.opsys.kernel_name
         self.initrd_dest = os.path.join(self.os_folder, self.opsys.initrd_name)
+        self.initrd_names = [self.opsys.initrd_name]
+        self.old_initrd_names = []
 
-        if not os.path.exists(self.loader_dir):
-            os.makedirs(self.loader_dir)
-        if not os.path.exists(self.entry_dir):
-            os.makedirs(self.entry_dir)
-
-
-    def backup_old(self, kernel_opts, setup_loader=False, simulate=False):
+    def backup_old(self, kernel_opts, setup_loader=False, simulate=False,
+                   artifacts=('kernel', 'initrd')):
         self.log.info('Backing up old kernel')
 
         old_path = Path(self.opsys.old_kernel_path).resolve()
@@ -68,66 +100,169 @@ class Installer():
             self.log.info('No old kernel found, skipping')
             return 0
 
-        old_kernel_name = "%s-previous.efi" % self.opsys.kernel_name
-        old_kernel_dest = os.path.join(self.os_folder, old_kernel_name)
-        try:
-            self.copy_files(
-                self.opsys.old_kernel_path,
-                old_kernel_dest,
-                simulate=simulate)
-        except:
-            self.log.debug('Couldn\'t back up old kernel. There\'s ' +
-                           'probably only one kernel installed.')
-            self.old_kernel = False
-            pass
+        if 'kernel' in artifacts:
+            self.backup_old_kernel(simulate)
+        else:
+            self.old_kernel_file = self.kernel_layout(
+                self.opsys.old_kernel_path, self.old_kernel_file)
 
         old_initrd_name = "%s-previous" % self.opsys.initrd_name
         old_initrd_dest = os.path.join(self.os_folder, old_initrd_name)
+        if 'initrd' in artifacts:
+            self.old_initrd_names = [old_initrd_name]
+            try:
+                self.old_initrd_names = self.install_initrd(
+                    self.opsys.old_initrd_path,
+                    old_initrd_dest,
+                    simulate=simulate)
+            except:
+                self.log.debug('Couldn\'t back up old initrd.img. There\'s ' +
+                               'probably only one kernel installed.')
+                self.old_kernel = False
+                pass
+        else:
+            self.old_initrd_names = self.initrd_layout(
+                self.opsys.old_initrd_path, old_initrd_dest)[1]
+
+        if setup_loader and self.old_kernel:
+            self.ensure_dir(self.entry_dir, simulate=simulate)
+            linux_line = '/EFI/%s-%s/%s' % (self.opsys.name,
+                                            self.drive.root_uuid,
+                                            self.old_kernel_file)
+            initrd_lines = ['/EFI/%s-%s/%s' % (self.opsys.name,
+                                               self.drive.root_uuid,
+                                               initrd_name)
+                            for initrd_name in self.old_initrd_names]
+            self.make_loader_entry(
+                self.opsys.name_pretty,
+                linux_line,
+                initrd_lines,
+                kernel_opts,
+                os.path.join(self.entry_dir, '%s-oldkern' % self.opsys.name),
+                simulate=simulate)
+
+    def backup_old_kernel(self, simulate):
+        # Raises if the old kernel is broken, so nothing is copied for it.
+        old_info = KernelImage(self.opsys.old_kernel_path).check()
+
+        # Signing is usually a cache hit: it was signed when it was the
+        # new kernel.
+        old_kernel_src, action = self.prepare_kernel(
+            self.opsys.old_kernel_path, old_info)
+
+        self.old_kernel_file = self.esp_name(
+            old_kernel_src, self.old_kernel_file, 'vmlinuz', '.efi', action)
+        old_kernel_dest = os.path.join(self.os_folder, self.old_kernel_file)
+        if self.already_stored(old_kernel_dest):
+            return
         try:
-            self.copy_files(
-                self.opsys.old_initrd_path,
-                old_initrd_dest,
+            self.install_kernel(
+                old_kernel_src,
+                old_kernel_dest,
+                action,
+                old_info,
                 simulate=simulate)
         except:
-            self.log.debug('Couldn\'t back up old initrd.img. There\'s ' +
+            self.log.debug('Couldn\'t back up old kernel. There\'s ' +
                            'probably only one kernel installed.')
             self.old_kernel = False
             pass
 
-        if setup_loader and self.old_kernel:
-            self.ensure_dir(self.entry_dir)
-            linux_line = '/EFI/%s-%s/%s-previous.efi' % (self.opsys.name,
-                                                         self.drive.root_uuid,
-                                                         self.opsys.kernel_name)
-            initrd_line = '/EFI/%s-%s/%s-previous' % (self.opsys.name,
-                                                      self.drive.root_uuid,
-                                                      self.opsys.initrd_name)
+    def setup_kernel(self, kernel_opts, setup_loader=False, overwrite=False,
+                     simulate=False, artifacts=('kernel', 'initrd')):
+        if 'kernel' in artifacts:
+            self.setup_kernel_image(simulate)
+        else:
+            self.kernel_file = self.kernel_layout(
+                self.opsys.kernel_path, self.kernel_file)
+
+        self.initrd_dest = os.path.join(self.os_folder, self.opsys.initrd_name)
+        if 'initrd' in artifacts:
+            self.setup_initrd(simulate)
+        else:
+            self.initrd_names = self.initrd_layout(
+                self.opsys.initrd_path, self.initrd_dest)[1]
+
+        if setup_loader:
+            self.log.info('Setting up loader.conf configuration')
+            linux_line = '/EFI/%s-%s/%s' % (self.opsys.name,
+                                            self.drive.root_uuid,
+                                            self.kernel_file)
+            initrd_lines = ['/EFI/%s-%s/%s' % (self.opsys.name,
+                                               self.drive.root_uuid,
+                                               initrd_name)
+                            for initrd_name in self.initrd_names]
+            if not overwrite:
+                if not self.backend.exists('%s/loader.conf' % self.loader_dir):
+                    overwrite = True
+
+            if overwrite:
+                self.ensure_dir(self.loader_dir, simulate=simulate)
+                default_line = 'default %s-current\n' % self.opsys.name
+                if simulate:
+                    self.log.info('Simulate writing loader.conf: %s', default_line)
+                    if self.plan is not None:
+                        self.plan.add_loader_file(
+                            'loader_conf',
+                            '%s/loader.conf' % self.loader_dir,
+                            default_line)
+                else:
+                    self.write_file(
+                        '%s/loader.conf' % self.loader_dir, default_line)
+
+            self.ensure_dir(self.entry_dir, simulate=simulate)
             self.make_loader_entry(
                 self.opsys.name_pretty,
                 linux_line,
-                initrd_line,
+                initrd_lines,
                 kernel_opts,
-                os.path.join(self.entry_dir, '%s-oldkern' % self.opsys.name))
+                os.path.join(self.entry_dir, '%s-current' % self.opsys.name),
+                simulate=simulate)
+
+    def setup_kernel_image(self, simulate):
+        try:
+            self.kernel_info = KernelImage(self.opsys.kernel_path).check()
+        except KernelImageError as e:
+            self.log.exception(
+                'The kernel image %s can\'t be booted by the firmware!\n' +
+                'This is a critical error and we cannot continue. Nothing ' +
+                'has been copied to the ESP.', self.opsys.kernel_path)
+            self.log.debug(e)
+            raise
 
-    def setup_kernel(self, kernel_opts, setup_loader=False, overwrite=False, simulate=False):
         self.log.info('Copying Kernel into ESP')
-        self.kernel_dest = os.path.join(
-            self.os_folder,
-            "%s.efi" % self.opsys.kernel_name)
         self.ensure_dir(self.os_folder, simulate=simulate)
-        self.log.debug('kernel being copied to %s' % self.kernel_dest)
 
+        # Signing only writes to kernelstub's own cache, so it happens in
+        # dry runs too and the plan can copy the signed image.
         try:
-            if self.is_gzip(self.opsys.kernel_path):
-                self.gunzip_files(
-                    self.opsys.kernel_path,
-                    self.kernel_dest,
-                    simulate=simulate)
-            else:
-                self.copy_files(
-                    self.opsys.kernel_path,
-                    self.kernel_dest,
-                    simulate=simulate)
+            kernel_src, action = self.prepare_kernel(
+                self.opsys.kernel_path, self.kernel_info)
+        except SigningError as e:
+            self.log.exception(
+                'Couldn\'t sign the kernel %s!\n' +
+                'This is a critical error and we cannot continue. Check ' +
+                'that sbsigntool is installed and that signing_key and ' +
+                'signing_cert are correct. Nothing has been copied to ' +
+                'the ESP.', self.opsys.kernel_path)
+            self.log.debug(e)
+            raise
+
+        self.kernel_file = self.esp_name(
+            kernel_src, '%s.efi' % self.opsys.kernel_name, 'vmlinuz', '.efi',
+            action)
+        self.kernel_dest = os.path.join(self.os_folder, self.kernel_file)
+        self.log.debug('kernel being copied to %s', self.kernel_dest)
+        if self.already_stored(self.kernel_dest):
+            return
+
+        try:
+            self.install_kernel(
+                kernel_src,
+                self.kernel_dest,
+                action,
+                self.kernel_info,
+                simulate=simulate)
 
         except FileOpsError as e:
             self.log.exception(
@@ -136,12 +271,15 @@ class Installer():
                 'settings to see if there is a typo. Otherwise, check ' +
                 'permissions and try again.')
             self.log.debug(e)
-            exit(170)
+            raise FileOpsError(
+                'Couldn\'t copy the kernel onto the ESP', exit_code=170) from e
+
+    def setup_initrd(self, simulate):
+        self.check_initrd_budget(self.opsys.initrd_path)
 
         self.log.info('Copying initrd.img into ESP')
-        self.initrd_dest = os.path.join(self.os_folder, self.opsys.initrd_name)
         try:
-            self.copy_files(
+            self.initrd_names = self.install_initrd(
                 self.opsys.initrd_path,
                 self.initrd_dest,
                 simulate=simulate)
@@ -153,51 +291,98 @@ class Installer():
                                'there is a typo. Otherwise, check permissions ' +
                                'and try again.')
             self.log.debug(e)
-            exit(171)
+            raise FileOpsError(
+                'Couldn\'t copy the initrd onto the ESP', exit_code=171) from e
 
         self.log.debug('Copy complete')
 
-        if setup_loader:
-            self.log.info('Setting up loader.conf configuration')
-            linux_line = '/EFI/%s-%s/%s.efi' % (self.opsys.name,
-                                                self.drive.root_uuid,
-                                                self.opsys.kernel_name)
-            initrd_line = '/EFI/%s-%s/%s' % (self.opsys.name,
-                                             self.drive.root_uuid,
-                                             self.opsys.initrd_name)
-            if simulate:
-                self.log.info("Simulate creation of entry...")
-                self.log.info('Loader entry: %s/%s-current\n' %(self.entry_dir,
-                                                                self.opsys.name) +
-                              'title %s\n' % self.opsys.name_pretty +
-                              'linux %s\n' % linux_line +
-                              'initrd %s\n' % initrd_line +
-                              'options %s\n' % kernel_opts)
-                return 0
-
-            if not overwrite:
-                if not os.path.exists('%s/loader.conf' % self.loader_dir):
-                    overwrite = True
-
-            if overwrite:
-                self.ensure_dir(self.loader_dir)
-                with open(
-                    '%s/loader.conf' % self.loader_dir, mode='w') as loader:
-
-                    default_line = 'default %s-current\n' % self.opsys.name
-                    loader.write(default_line)
-
-            self.ensure_dir(self.entry_dir)
-            self.make_loader_entry(
-                self.opsys.name_pretty,
-                linux_line,
-                initrd_line,
-                kernel_opts,
-                os.path.join(self.entry_dir, '%s-current' % self.opsys.name))
-
-
-
+    def unpack_action(self, path, info):
+        """Return how the kernel at path has to be unpacked for the ESP.
+
+        None copies it as it is. Gzipped Images always have to be
+        decompressed; zboot images decompress themselves, so they're only
+        unpacked here if zboot_policy asks for it for their architecture.
+        """
+        if info['format'] == 'gzip':
+            return 'gunzip'
+        if info['format'] != 'zboot':
+            return None
+
+        policy = self.zboot_policy
+        if isinstance(policy, dict):
+            policy = policy.get(info['arch'], 'compressed')
+        if policy == 'decompressed':
+            self.log.info('Decompressing the %s zboot kernel %s',
+                          info['arch'], path)
+            return 'unzboot'
+        self.log.info('Copying the %s zboot kernel %s compressed',
+                      info['arch'], path)
+        return None
+
+    def sign_variant(self, action):
+        # A zboot kernel can be signed compressed or unpacked.
+        if action == 'unzboot':
+            return 'unpacked'
+        return None
+
+    def prepare_kernel(self, path, info):
+        """Return the file to copy for the kernel at path, and its unpack action."""
+        action = self.unpack_action(path, info)
+        if self.signer is not None:
+            opener = None
+            if action is not None:
+                opener = KernelImage(path).opener(info)
+            path = self.signer.sign(
+                path,
+                opener=opener,
+                variant=self.sign_variant(action))
+            action = None
+        return path, action
+
+    def kernel_layout(self, path, name):
+        """Return the name the kernel at path is stored under, without copying."""
+        if self.esp_layout != 'content':
+            return name
+        src, action = self.prepare_kernel(path, KernelImage(path).check())
+        return self.esp_name(src, name, 'vmlinuz', '.efi', action)
+
+    def esp_name(self, src, name, prefix, suffix, action=None):
+        """Return the name src is stored under in the OS folder.
+
+        With the content layout, that is a hash of src and of how it is
+        unpacked, so each image is stored once, whichever slot uses it.
+        Otherwise it is the fixed name for the slot.
+        """
+        if self.esp_layout != 'content':
+            return name
+        digest = hashlib.sha256()
+        if action is not None:
+            digest.update(('%s\0' % action).encode('UTF-8'))
+        with open(src, 'rb') as in_obj:
+            while True:
+                data = in_obj.read(self.transfer.chunk_size)
+                if not data:
+                    break
+                digest.update(data)
+        name = '%s-%s%s' % (prefix, digest.hexdigest()[:16], suffix)
+        self.blobs.add(name)
+        return name
+
+    def already_stored(self, dest):
+        # Content-addressed files are only renamed into place once complete.
+        if self.full_plan:
+            return False
+        if self.esp_layout == 'content' and os.path.exists(dest):
+            self.log.info('%s is already on the ESP', os.path.basename(dest))
+            return True
+        return False
 
+    def install_kernel(self, src, dest, action, info, simulate):
+        if action == 'gunzip':
+            return self.gunzip_files(src, dest, simulate=simulate)
+        if action == 'unzboot':
+            return self.unzboot_files(src, dest, info, simulate=simulate)
+        return self.copy_files(src, dest, simulate=simulate)
 
     def setup_stub(self, kernel_opts, simulate=False):
         self.log.info("Setting up Kernel EFISTUB loader...")
@@ -211,72 +396,375 @@ class Installer():
         else:
             self.log.debug("No old entry found, skipping removal.")
 
-        self.nvram.add_entry(self.opsys, self.drive, kernel_opts, simulate)
+        self.nvram.add_entry(self.opsys, self.drive, kernel_opts, simulate,
+                             kernel=self.kernel_file,
+                             initrds=self.initrd_names)
         self.nvram.update()
         nvram_lines = "\n".join(self.nvram.nvram)
-        self.log.info('NVRAM configured, new values: \n\n%s\n' % nvram_lines)
+        self.log.info('NVRAM configured, new values: \n\n%s\n', nvram_lines)
+
+    def install_initrd(self, src, dest, simulate):
+        """Copy the initrd src to dest, returning the names to boot with.
+
+        With share_early_initrd, the early microcode and firmware archives
+        are split off into early-<sha256>.img, which every kernel slot with
+        the same early archives shares. The names are in load order, and
+        dest is replaced by a content-addressed name with that layout.
+        """
+        early_size, names = self.initrd_layout(src, dest)
+        dest = os.path.join(self.os_folder, names[-1])
+        if not early_size:
+            if not self.already_stored(dest):
+                self.copy_files(src, dest, simulate=simulate)
+            return names
+
+        early_dest = os.path.join(self.os_folder, names[0])
+
+        # The name is the content, so an existing copy is already right.
+        if (not self.full_plan and os.path.exists(early_dest) and
+                os.path.getsize(early_dest) == early_size):
+            self.log.debug('%s is already on the ESP', names[0])
+        else:
+            self.slice_files(src, early_dest, 0, early_size, simulate=simulate)
+        if not self.already_stored(dest):
+            self.slice_files(
+                src, dest, early_size, os.path.getsize(src) - early_size,
+                simulate=simulate)
+        return names
+
+    def split_initrd(self, src):
+        """Return the size and ESP name of the shared part of initrd src.
+
+        The size is 0 if the initrd isn't split.
+        """
+        early_size = 0
+        if self.share_early_initrd:
+            try:
+                early_size = Initrd(src).early_size()
+            except (OSError, InitrdError) as e:
+                self.log.debug('Couldn\'t split %s: %s', src, e)
+        if not early_size:
+            return 0, None
+
+        digest = hashlib.sha256()
+        with open(src, 'rb') as in_obj:
+            reader = SliceReader(in_obj, 0, early_size)
+            while True:
+                data = reader.read(self.transfer.chunk_size)
+                if not data:
+                    break
+                digest.update(data)
+        return early_size, 'early-%s.img' % digest.hexdigest()[:16]
+
+    def initrd_layout(self, src, dest):
+        """Return the size of the shared part of initrd src, and the names
+        install_initrd would boot with, without copying anything."""
+        early_size, early_name = self.split_initrd(src)
+        names = []
+        action = None
+        if early_size:
+            self.blobs.add(early_name)
+            names.append(early_name)
+            action = 'split'
+        names.append(self.esp_name(
+            src, os.path.basename(dest), 'initrd', '.img', action))
+        return early_size, names
+
+    def prune_blobs(self, simulate=False):
+        """Remove shared and content-addressed files no boot entry uses."""
+        keep = set(self.blobs)
+        # Switching to the content layout leaves the fixed names unused.
+        fixed = set()
+        if self.esp_layout == 'content':
+            fixed = {
+                '%s.efi' % self.opsys.kernel_name,
+                '%s-previous.efi' % self.opsys.kernel_name,
+                self.opsys.initrd_name,
+                '%s-previous' % self.opsys.initrd_name,
+            }
+        try:
+            entries = [name for name in os.listdir(self.entry_dir)
+                       if name.endswith('.conf')]
+        except OSError:
+            entries = []
+        for entry in entries:
+            try:
+                contents = self.backend.read_text(
+                    os.path.join(self.entry_dir, entry))
+            except OSError:
+                continue
+            for line in contents.splitlines():
+                if line.startswith(('linux ', 'initrd ')):
+                    keep.add(os.path.basename(line.split(None, 1)[1].strip()))
+
+        try:
+            names = os.listdir(self.os_folder)
+        except OSError:
+            return 0
+        for name in names:
+            if name in keep:
+                continue
+            if not (self.blob_pattern.match(name) or name in fixed):
+                continue
+            path = os.path.join(self.os_folder, name)
+            if simulate:
+                self.log.info('Simulate removing unused %s', path)
+                continue
+            self.log.info('Removing unused %s', path)
+            try:
+                os.remove(path)
+            except OSError as e:
+                self.log.warning('Couldn\'t remove %s', path)
+                self.log.debug(e)
+        return 0
+
+    def check_initrd_budget(self, path):
+        if not self.initrd_budget:
+            return True
+        size = os.path.getsize(path)
+        if size <= self.initrd_budget:
+            return True
+
+        self.log.warning('The initrd %s is %s bytes, over the budget of %s '
+                         'bytes.', path, size, self.initrd_budget)
+        initrd = Initrd(path)
+        try:
+            self.log.warning('Initrd contents:\n%s', initrd.report(initrd.analyze()))
+        except InitrdError as e:
+            self.log.debug('Couldn\'t analyze %s: %s', path, e)
+        return False
+
+    def identity(self, kernel_opts=None):
+        # What was installed, recorded so boots can be matched to it later
+        # and targeted updates can tell what the ESP holds.
+        identity = {
+            'installed' : int(time.time()),
+            'current' : self.image_identity(
+                self.opsys.kernel_path, self.opsys.initrd_path),
+        }
+        identity['current']['kernel_options'] = kernel_opts
+        identity['current']['esp_kernel'] = self.kernel_file
+        identity['current']['esp_initrds'] = self.initrd_names
+        if self.kernel_info and self.kernel_info['version']:
+            identity['current']['kernel_version'] = self.kernel_info['version']
+        if self.old_kernel and os.path.exists(self.opsys.old_kernel_path):
+            identity['previous'] = self.image_identity(
+                self.opsys.old_kernel_path, self.opsys.old_initrd_path)
+            identity['previous']['esp_kernel'] = self.old_kernel_file
+            identity['previous']['esp_initrds'] = self.old_initrd_names
+        return identity
+
+    def image_identity(self, kernel_path, initrd_path):
+        kernel_name = os.path.basename(os.path.realpath(kernel_path))
+        kernel_version = None
+        if kernel_name.startswith('vmlinuz-'):
+            kernel_version = kernel_name.split('-', 1)[1]
+        identity = {'kernel_version' : kernel_version}
+        for key, path in (('kernel', kernel_path), ('initrd', initrd_path)):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            identity['%s_path' % key] = os.path.realpath(path)
+            identity['%s_size' % key] = stat.st_size
+            identity['%s_mtime_ns' % key] = stat.st_mtime_ns
+        return identity
 
     def copy_cmdline(self, simulate):
-        self.copy_files(
-            '/proc/cmdline',
-            self.os_folder,
-            simulate = simulate
-        )
-
-
-    def make_loader_entry(self, title, linux, initrd, options, filename):
-        self.log.info('Making entry file for %s' % title)
-        with open('%s.conf' % filename, mode='w') as entry:
-            entry.write('title %s\n' % title)
-            entry.write('linux %s\n' % linux)
-            entry.write('initrd %s\n' % initrd)
-            entry.write('options %s\n' % options)
+        cmdline_path = os.path.join(self.os_folder, 'cmdline')
+        cmdline = self.backend.read_text('/proc/cmdline')
+        if simulate:
+            self.log.info('Simulate copying: /proc/cmdline => %s', cmdline_path)
+            if self.plan is not None:
+                # The running cmdline is recorded verbatim, since
+                # /proc/cmdline may not match by the time the plan is applied.
+                self.plan.add_loader_file('cmdline', cmdline_path, cmdline)
+            return True
+        try:
+            self.write_file(cmdline_path, cmdline)
+            return True
+        except Exception as e:
+            self.log.debug(e)
+            raise FileOpsError("Could not copy one or more files.")
+
+
+    def make_loader_entry(self, title, linux, initrds, options, filename,
+                          simulate=False):
+        self.log.info('Making entry file for %s', title)
+        contents = (
+            'title %s\n' % title +
+            'linux %s\n' % linux +
+            ''.join('initrd %s\n' % initrd for initrd in initrds) +
+            'options %s\n' % options)
+        contents = self.plugins.filter(
+            'loader_entry', contents, '%s.conf' % filename)
+        if simulate:
+            self.log.info('Simulate creation of entry %s.conf:\n%s',
+                          filename, contents)
+            if self.plan is not None:
+                self.plan.add_loader_file(
+                    'loader_entry', '%s.conf' % filename, contents)
+            return 0
+        try:
+            if self.backend.read_text('%s.conf' % filename) == contents:
+                self.log.debug('Entry %s.conf is unchanged', filename)
+                return 0
+        except OSError:
+            pass
+        self.write_file('%s.conf' % filename, contents)
         self.log.debug('Entry created!')
 
+    def write_file(self, path, contents):
+        artifact = {
+            'source' : None,
+            'destination' : path,
+            'action' : 'write',
+        }
+        self.plugins.run('before_write', artifact)
+        self.backend.write_text(path, contents)
+        self.files_written.append(path)
+        data = contents.encode('UTF-8')
+        self.transfer.bytes_written = self.transfer.bytes_written + len(data)
+        if self.plugins:
+            artifact['size'] = len(data)
+            artifact['bytes_written'] = len(data)
+            artifact['sha256'] = hashlib.sha256(data).hexdigest()
+            self.plugins.run('after_write', artifact)
+
+    def transfer_file(self, src, dest, action, **copy_args):
+        artifact = {
+            'source' : src,
+            'destination' : dest,
+            'action' : action,
+        }
+        self.plugins.run('before_write', artifact)
+        if self.blob_pattern.match(os.path.basename(dest)):
+            # Shared files are trusted by name, so they only ever appear
+            # complete.
+            tmp_dest = '%s.kernelstub-tmp' % dest
+            try:
+                written = self.transfer.copy(src, tmp_dest, **copy_args)[1]
+                self.transfer.rename(tmp_dest, dest)
+            finally:
+                if os.path.exists(tmp_dest):
+                    os.remove(tmp_dest)
+        else:
+            dest, written = self.transfer.copy(src, dest, **copy_args)
+        self.files_written.append(dest)
+        if self.plugins:
+            # The digest was taken while copying, not by reading dest again.
+            digest = self.transfer.digests.get(dest, {})
+            artifact['destination'] = dest
+            artifact['size'] = digest.get('size')
+            artifact['bytes_written'] = written
+            artifact['sha256'] = digest.get('sha256')
+            artifact['extents'] = self.transfer.extents.get(dest)
+            self.plugins.run('after_write', artifact)
+        return dest
+
     def ensure_dir(self, directory, simulate=False):
-        if not simulate:
+        if simulate:
+            if self.plan is not None:
+                self.plan.add_directory(directory)
+        else:
             try:
-                os.makedirs(directory, exist_ok=True)
+                self.backend.makedirs(directory)
                 return True
             except Exception as e:
-                self.log.exception('Couldn\'t make sure %s exists.' % directory)
+                self.log.exception('Couldn\'t make sure %s exists.', directory)
                 self.log.debug(e)
                 return False
 
-    def is_gzip(self, path):
-        try:
-            with open(path, 'rb') as file:
-                return file.read(2) == b'\x1f\x8b'
-        except Exception as e:
-            self.log.debug(e)
-            return False
-
     def gunzip_files(self, src, dest, simulate): # Decompress file src to dest
         if simulate:
-            self.log.info('Simulate decompressing: %s => %s' % (src, dest))
+            self.log.info('Simulate decompressing: %s => %s', src, dest)
+            if self.plan is not None:
+                self.plan.add_artifact('gunzip', src, dest)
             return True
         else:
             try:
-                self.log.debug('Decompressing: %s => %s' % (src, dest))
-                with gzip.open(src, 'rb') as in_obj:
-                    with open(dest, 'wb') as out_obj:
-                        shutil.copyfileobj(in_obj, out_obj)
+                self.log.debug('Decompressing: %s => %s', src, dest)
+                self.transfer_file(src, dest, 'gunzip', decompress=True)
                 return True
+            except (TransferError, PluginError):
+                raise
             except Exception as e:
                 self.log.debug(e)
                 raise FileOpsError("Could not decompress one or more files.")
                 return False
 
 
+    def zboot_size(self, info):
+        # The size comes from the image itself; one that wouldn't even fit
+        # on the ESP is garbage, not a reason to reserve that much space.
+        size = info.get('uncompressed_size')
+        try:
+            stat = os.statvfs(self.drive.esp_path)
+        except OSError:
+            return size
+        if size is not None and size > stat.f_bavail * stat.f_frsize:
+            self.log.debug('Ignoring the zboot size %s, larger than the '
+                           'free space on the ESP', size)
+            return None
+        return size
+
+    def unzboot_files(self, src, dest, info, simulate): # Unpack zboot src to dest
+        if simulate:
+            self.log.info('Simulate unpacking: %s => %s', src, dest)
+            if self.plan is not None:
+                self.plan.add_artifact('unzboot', src, dest,
+                                       length=self.zboot_size(info))
+            return True
+        else:
+            try:
+                self.log.debug('Unpacking: %s => %s', src, dest)
+                self.transfer_file(
+                    src, dest, 'unzboot', opener=KernelImage(src).opener(info),
+                    size=self.zboot_size(info))
+                return True
+            except (TransferError, PluginError):
+                raise
+            except Exception as e:
+                self.log.debug(e)
+                raise FileOpsError("Could not unpack one or more files.")
+                return False
+
+    def slice_files(self, src, dest, offset, length, simulate): # Copy part of src
+        if simulate:
+            self.log.info('Simulate copying %s bytes at %s: %s => %s',
+                          length, offset, src, dest)
+            if self.plan is not None:
+                self.plan.add_artifact(
+                    'slice', src, dest, offset=offset, length=length)
+            return True
+        else:
+            try:
+                self.log.debug('Copying %s bytes at %s: %s => %s',
+                               length, offset, src, dest)
+                self.transfer_file(
+                    src, dest, 'slice',
+                    opener=Initrd(src).opener(offset, length), size=length)
+                return True
+            except (TransferError, PluginError):
+                raise
+            except Exception as e:
+                self.log.debug(e)
+                raise FileOpsError("Could not copy one or more files.")
+                return False
+
     def copy_files(self, src, dest, simulate): # Copy file src into dest
         if simulate:
-            self.log.info('Simulate copying: %s => %s' % (src, dest))
+            self.log.info('Simulate copying: %s => %s', src, dest)
+            if self.plan is not None:
+                self.plan.add_artifact('copy', src, dest)
             return True
         else:
             try:
-                self.log.debug('Copying: %s => %s' % (src, dest))
-                shutil.copy(src, dest)
+                self.log.debug('Copying: %s => %s', src, dest)
+                self.transfer_file(src, dest, 'copy')
                 return True
+            except (TransferError, PluginError):
+                raise
             except Exception as e:
                 self.log.debug(e)
                 raise FileOpsError("Could not copy one or more files.")
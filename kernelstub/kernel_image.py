@@ -0,0 +1,259 @@
+#!/usr/bin/python3
+
+"""
+ kernelstub
+ The automatic manager for using the Linux Kernel EFI Stub to boot
+
+ Copyright 2017-2018 Ian Santopietro <isantop@gmail.com>
+
+Permission to use, copy, modify, and/or distribute this software for any purpose
+with or without fee is hereby granted, provided that the above copyright notice
+and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS
+OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF
+THIS SOFTWARE.
+
+Please see the provided LICENSE.txt file for additional distribution/copyright
+terms.
+"""
+
+import gzip, logging, mmap, struct, zlib
+
+from .errors import KernelstubError
+from .initrd import decompressor
+
+class KernelImageError(KernelstubError):
+    exit_code = 179
+
+class KernelImage():
+
+    # x86 boot protocol, see Documentation/x86/boot.rst in the kernel tree.
+    XLF_EFI_HANDOVER_32 = 1 << 2
+    XLF_EFI_HANDOVER_64 = 1 << 3
+
+    machines = {
+        0x014c : 'x86',
+        0x8664 : 'x86_64',
+        0x01c2 : 'arm',
+        0xaa64 : 'arm64',
+        0x5032 : 'riscv32',
+        0x5064 : 'riscv64',
+        0x6264 : 'loongarch64',
+    }
+    compressions = [
+        (b'\x1f\x8b', 'gzip'),
+        (b'\xfd7zXZ\x00', 'xz'),
+        (b'\x5d\x00\x00', 'lzma'),
+        (b'BZh', 'bzip2'),
+        (b'\x28\xb5\x2f\xfd', 'zstd'),
+        (b'\x02\x21\x4c\x18', 'lz4'),
+        (b'\x89LZO', 'lzo'),
+        (b'\x7fELF', 'none'),
+    ]
+    # Names used in zboot headers, see drivers/firmware/efi/libstub/Makefile.zboot
+    zboot_compressions = {
+        'xzkern' : 'xz',
+        'zstd22' : 'zstd',
+    }
+
+    def __init__(self, path):
+        self.log = logging.getLogger('kernelstub.KernelImage')
+        self.log.debug('loaded kernelstub.KernelImage')
+        self.path = path
+
+    def inspect(self):
+        info = {
+            'path' : self.path,
+            'format' : 'unknown',
+            'version' : None,
+            'arch' : None,
+            'efi_stub' : False,
+            'efi_handover' : False,
+            'compression' : None,
+            'truncated' : False,
+        }
+        with open(self.path, 'rb') as image_file:
+            if image_file.read(2) == b'\x1f\x8b':
+                # A gzipped Image (e.g. arm64 vmlinuz) only has its headers
+                # after decompression, so look at the start of it only.
+                image_file.seek(0)
+                info['format'] = 'gzip'
+                info['compression'] = 'gzip'
+                try:
+                    with gzip.GzipFile(fileobj=image_file) as gzip_file:
+                        header = gzip_file.read(65536)
+                except (OSError, EOFError, zlib.error):
+                    info['truncated'] = True
+                    return info
+                self.inspect_pe(header, info, len(header), partial=True)
+                info['format'] = 'gzip'
+                return info
+
+            image_file.seek(0)
+            try:
+                image = mmap.mmap(image_file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # Empty files can't be mapped.
+                info['truncated'] = True
+                return info
+            with image:
+                self.inspect_pe(image, info, len(image))
+                if image[0x202:0x206] == b'HdrS':
+                    self.inspect_bzimage(image, info)
+                elif image[4:8] == b'zimg':
+                    self.inspect_zboot(image, info)
+                elif info['version'] is None and info['efi_stub']:
+                    info['version'] = self.find_version(image)
+        self.log.debug('Kernel image %s: %s', self.path, info)
+        return info
+
+    def inspect_pe(self, image, info, size, partial=False):
+        if size < 0x40 or image[0:2] != b'MZ':
+            return
+        pe_offset = struct.unpack_from('<I', image, 0x3c)[0]
+        if pe_offset + 24 > size or image[pe_offset:pe_offset + 4] != b'PE\0\0':
+            return
+
+        info['format'] = 'pe'
+        info['efi_stub'] = True
+        machine, sections = struct.unpack_from('<HH', image, pe_offset + 4)
+        info['arch'] = self.machines.get(machine, hex(machine))
+        if partial:
+            info['version'] = self.find_version(image)
+            return
+
+        # Every section's raw data has to be inside the file.
+        optional_size = struct.unpack_from('<H', image, pe_offset + 20)[0]
+        table = pe_offset + 24 + optional_size
+        for index in range(sections):
+            entry = table + index * 40
+            if entry + 40 > size:
+                info['truncated'] = True
+                return
+            raw_size, raw_offset = struct.unpack_from('<II', image, entry + 16)
+            if raw_offset + raw_size > size:
+                info['truncated'] = True
+                return
+
+    def inspect_bzimage(self, image, info):
+        info['format'] = 'bzImage'
+        setup_sects = image[0x1f1] or 4
+        syssize = struct.unpack_from('<I', image, 0x1f4)[0]
+        protocol = struct.unpack_from('<H', image, 0x206)[0]
+        setup_size = (setup_sects + 1) * 512
+        if setup_size + syssize * 16 > len(image):
+            info['truncated'] = True
+
+        version_offset = struct.unpack_from('<H', image, 0x20e)[0]
+        if version_offset:
+            info['version'] = self.read_string(image, version_offset + 0x200)
+
+        if protocol >= 0x20c:
+            xloadflags = struct.unpack_from('<H', image, 0x236)[0]
+            handover_offset = struct.unpack_from('<I', image, 0x264)[0]
+            info['efi_handover'] = bool(
+                handover_offset and
+                xloadflags & (self.XLF_EFI_HANDOVER_32 | self.XLF_EFI_HANDOVER_64))
+
+        if protocol >= 0x208:
+            payload_offset, payload_length = struct.unpack_from(
+                '<II', image, 0x248)
+            start = setup_size + payload_offset
+            if start + payload_length > len(image):
+                info['truncated'] = True
+            info['compression'] = self.compression(image[start:start + 6])
+
+    def inspect_zboot(self, image, info):
+        # EFI zboot: a small PE decompressor with the compressed Image
+        # appended; see drivers/firmware/efi/libstub/zboot-header.S
+        info['format'] = 'zboot'
+        payload_offset, payload_size = struct.unpack_from('<II', image, 8)
+        info['payload_offset'] = payload_offset
+        info['payload_size'] = payload_size
+        compression = self.read_string(image, 0x18, 32) or None
+        info['compression'] = self.zboot_compressions.get(compression, compression)
+        # The build appends the Image's size after the compressed payload,
+        # except for gzip, whose payload already ends with it (ISIZE).
+        end = payload_offset + payload_size
+        if end > len(image):
+            info['truncated'] = True
+        elif info['compression'] == 'gzip':
+            if payload_size >= 4:
+                info['uncompressed_size'] = struct.unpack_from(
+                    '<I', image, end - 4)[0]
+        elif end + 4 <= len(image):
+            info['uncompressed_size'] = struct.unpack_from('<I', image, end)[0]
+
+    def opener(self, info):
+        """Return a function that wraps the open image file in a reader of
+        the plain EFI stub image inside it, or None for other formats.
+        """
+        if info['format'] == 'gzip':
+            return lambda file_obj: gzip.GzipFile(fileobj=file_obj, mode='rb')
+        if info['format'] == 'zboot':
+            if decompressor(info['compression']) is None:
+                raise KernelImageError('Can\'t decompress %s zboot kernels' %
+                                       info['compression'])
+            return lambda file_obj: PayloadReader(
+                file_obj,
+                info['payload_offset'],
+                info['payload_size'],
+                info['compression'])
+        return None
+
+    def compression(self, magic):
+        for signature, name in self.compressions:
+            if magic.startswith(signature):
+                return name
+        return 'unknown'
+
+    def read_string(self, image, offset, limit=256):
+        end = image.find(b'\0', offset, offset + limit)
+        if end < 0:
+            end = offset + limit
+        return bytes(image[offset:end]).decode('ASCII', 'replace').split(' ')[0]
+
+    def find_version(self, image):
+        offset = image.find(b'Linux version ')
+        if offset < 0:
+            return None
+        return self.read_string(image, offset + len('Linux version '))
+
+    def check(self):
+        info = self.inspect()
+        if info['truncated']:
+            raise KernelImageError('%s is truncated or corrupt' % self.path)
+        if not info['efi_stub']:
+            raise KernelImageError(
+                '%s isn\'t an EFI stub kernel (format: %s)' % (
+                    self.path, info['format']))
+        return info
+
+class PayloadReader():
+    """Reads the decompressed Image out of an EFI zboot kernel."""
+
+    chunk_size = 1048576
+
+    def __init__(self, file_obj, offset, size, compression):
+        self.file_obj = file_obj
+        self.file_obj.seek(offset)
+        self.remaining = size
+        self.decompressor = decompressor(compression)
+
+    def read(self, size=-1):
+        # Decompressors can take several chunks before producing output, and
+        # an empty read means the end of the image to callers.
+        while self.remaining > 0:
+            data = self.file_obj.read(min(self.chunk_size, self.remaining))
+            if not data:
+                raise KernelImageError('The zboot payload is truncated')
+            self.remaining = self.remaining - len(data)
+            output = self.decompressor.decompress(data)
+            if output:
+                return output
+        return b''
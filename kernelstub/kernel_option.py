@@ -4,55 +4,99 @@ from debian.changelog import Version
 import os
 import os.path
 
+class Inventory():
+    """Kernels and initrds found in one directory, newest first.
+
+    The directory is scanned once, and every version's sort key is computed
+    once, so lookups by version or flavor afterwards are dictionary reads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.items = {}
+        self.scan()
+
+        # Only complete options can be booted, so only they are indexed.
+        complete = [version for version, option in self.items.items()
+                    if 'kernel' in option and 'initrd' in option]
+        self.versions = sorted(complete, key=Version, reverse=True)
+
+        self.flavors = {}
+        for version in self.versions:
+            self.flavors.setdefault(self.flavor(version), []).append(version)
+
+    def scan(self):
+        try:
+            entries = os.scandir(self.path)
+        except OSError:
+            return
+        with entries:
+            for entry in entries:
+                key = None
+                if entry.name.startswith("vmlinuz-"):
+                    key = "kernel"
+                elif entry.name.startswith("initrd.img-"):
+                    key = "initrd"
+
+                if key is None:
+                    continue
+
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    # A dangling symlink isn't a usable option.
+                    continue
+
+                version = entry.name.split("-", 1)[1]
+                option = self.items.setdefault(version, {})
+                option[key] = entry.path
+                option['%s_stat' % key] = stat
+
+    def flavor(self, version):
+        # 5.4.0-42-generic => generic; versions without a flavor get None
+        suffix = version.rsplit("-", 1)[-1]
+        if suffix == version or suffix[:1].isdigit():
+            return None
+        return suffix
+
+    def get(self, version):
+        option = self.items.get(version)
+        if option is None or 'kernel' not in option or 'initrd' not in option:
+            return None
+        return option
+
+    def ordered(self, flavor=None):
+        if flavor is None:
+            return self.versions
+        return self.flavors.get(flavor, [])
+
+    def newest(self, flavor=None, index=0):
+        versions = self.ordered(flavor)
+        if index < len(versions):
+            return self.items[versions[index]], versions[index]
+        return None, None
+
+    def select(self, flavor=None, pinned=None):
+        """Return the (current, previous) options to install.
+
+        A pinned version that is present is always current; previous is then
+        the newest other version of the same flavor.
+        """
+        versions = self.ordered(flavor)
+        if pinned is not None and self.get(pinned) is not None:
+            others = [version for version in versions if version != pinned]
+            previous = None
+            if others:
+                previous = self.items[others[0]]
+            return self.items[pinned], previous
+
+        return self.newest(flavor)[0], self.newest(flavor, 1)[0]
+
 def options(path):
-    items={}
-    for name in os.listdir(path):
-        key = None
-        if name.startswith("vmlinuz-"):
-            key = "kernel"
-        elif name.startswith("initrd.img-"):
-            key = "initrd"
-
-        if key is None:
-            continue
-
-        parts = name.split("-", 1)
-        version = parts[1]
-
-        if not version in items:
-            items[version] = {}
-
-        items[version][key] = os.path.join(path, name)
-
-    return items
-
-def get_newest_option(opts):
-    latest_version = None
-    latest_option = None
-
-    for version, option in opts.items():
-        # If option is not complete, skip
-        if 'kernel' not in option or 'initrd' not in option:
-            continue
-
-        # If this option is newer, store this option and continue
-        if latest_version is None or Version(version) > Version(latest_version):
-            latest_version = version
-            latest_option = option
-    
-    return latest_option, latest_version
-
-def latest_option(path):
-    opts = options(path)
-    latest_option, latest_version = get_newest_option(opts)
-    
-    if latest_version is not None:
-        opts.pop(latest_version)
-    previous_option = None
-    if len(opts) > 0:
-        previous_option, latest_version = get_newest_option(opts)
-
-    return latest_option, previous_option
+    return Inventory(path).items
+
+def latest_option(path, flavor=None, pinned=None):
+    return Inventory(path).select(flavor=flavor, pinned=pinned)
 
 if __name__ == "__main__":
     print(latest_option("/boot"))
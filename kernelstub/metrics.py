@@ -0,0 +1,146 @@
+#!/usr/bin/python3
+
+"""
+ kernelstub
+ The automatic manager for using the Linux Kernel EFI Stub to boot
+
+ Copyright 2017-2018 Ian Santopietro <isantop@gmail.com>
+
+Permission to use, copy, modify, and/or distribute this software for any purpose
+with or without fee is hereby granted, provided that the above copyright notice
+and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS
+OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF
+THIS SOFTWARE.
+
+Please see the provided LICENSE.txt file for additional distribution/copyright
+terms.
+"""
+
+import contextlib, logging, os, time
+
+class Metrics():
+
+    file_name = 'kernelstub.prom'
+
+    def __init__(self):
+        self.log = logging.getLogger('kernelstub.Metrics')
+        self.log.debug('loaded kernelstub.Metrics')
+
+        self.directory = None
+        self.start = time.time()
+        self.end = None
+        self.phases = []
+        self.transfer = None
+        self.nvram = None
+        self.esp_path = None
+        self.kernel_version = None
+        self.exit_status = 0
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.monotonic() - start))
+
+    def watch(self, transfer, nvram):
+        # Counters are read when rendering, so a run that fails half way
+        # still reports what it did.
+        self.transfer = transfer
+        self.nvram = nvram
+
+    def esp_free_bytes(self):
+        if self.esp_path is None:
+            return None
+        try:
+            stat = os.statvfs(self.esp_path)
+        except OSError:
+            return None
+        return stat.f_bavail * stat.f_frsize
+
+    def escape(self, value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def render(self):
+        if self.end is None:
+            self.end = time.time()
+        bytes_read = bytes_written = nvram_writes = 0
+        if self.transfer is not None:
+            bytes_read = self.transfer.bytes_read
+            bytes_written = self.transfer.bytes_written
+        if self.nvram is not None:
+            nvram_writes = len(self.nvram.changes)
+        metrics = [
+            ('kernelstub_last_run_timestamp_seconds',
+             'Time the last kernelstub run finished.',
+             [('', self.end)]),
+            ('kernelstub_last_run_duration_seconds',
+             'How long the last kernelstub run took.',
+             [('', self.end - self.start)]),
+            ('kernelstub_last_run_phase_duration_seconds',
+             'How long each phase of the last kernelstub run took.',
+             [('{phase="%s"}' % self.escape(name), duration)
+              for name, duration in self.phases]),
+            ('kernelstub_last_run_read_bytes',
+             'Bytes read from kernel and initrd images in the last run.',
+             [('', bytes_read)]),
+            ('kernelstub_last_run_esp_written_bytes',
+             'Bytes written to the ESP in the last run.',
+             [('', bytes_written)]),
+            ('kernelstub_last_run_nvram_writes',
+             'NVRAM boot entries created or deleted in the last run.',
+             [('', nvram_writes)]),
+            ('kernelstub_last_run_exit_status',
+             'Exit status of the last kernelstub run.',
+             [('', self.exit_status)]),
+        ]
+        esp_free = self.esp_free_bytes()
+        if esp_free is not None:
+            metrics.append((
+                'kernelstub_esp_free_bytes',
+                'Free space on the ESP after the last run.',
+                [('', esp_free)]))
+        if self.transfer is not None and self.transfer.extents:
+            metrics.append((
+                'kernelstub_esp_file_extents',
+                'Extents each file written to the ESP is stored in.',
+                [('{path="%s"}' % self.escape(path), extents)
+                 for path, extents in sorted(self.transfer.extents.items())]))
+        if self.kernel_version is not None:
+            metrics.append((
+                'kernelstub_installed_kernel_info',
+                'The kernel kernelstub last installed.',
+                [('{version="%s"}' % self.escape(self.kernel_version), 1)]))
+
+        lines = []
+        for name, description, samples in metrics:
+            lines.append('# HELP %s %s' % (name, description))
+            lines.append('# TYPE %s gauge' % name)
+            for labels, value in samples:
+                lines.append('%s%s %s' % (name, labels, value))
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        if not self.directory:
+            return False
+        # node_exporter may read the file at any time, so it has to appear
+        # complete in one rename.
+        path = os.path.join(self.directory, self.file_name)
+        tmp_path = '%s.%s' % (path, os.getpid())
+        try:
+            with open(tmp_path, mode='w') as metrics_file:
+                metrics_file.write(self.render())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            self.log.warning('Couldn\'t write metrics to %s', path)
+            self.log.debug(e)
+            return False
+        self.log.debug('Metrics written to %s', path)
+        return True
@@ -22,7 +22,47 @@ Please see the provided LICENSE.txt file for additional distribution/copyright
 terms.
 """
 
-import subprocess, logging
+import logging, string
+
+from .backend import SystemBackend
+from .plugins import Plugins
+from .errors import KernelstubError
+
+class NVRAMError(KernelstubError):
+    exit_code = 172
+
+def entry_command(action, entry):
+    """Build the efibootmgr command that makes the NVRAM change action.
+
+    entry holds the boot number to delete, or the device, partition, label,
+    loader and options of the entry to create. Plans and bundles store only
+    these fields, so a malformed one raises ValueError instead of running
+    anything else.
+    """
+    if action == 'delete':
+        boot_num = entry.get('boot_num')
+        if (not isinstance(boot_num, str) or len(boot_num) != 4 or
+                not all(char in string.hexdigits for char in boot_num)):
+            raise ValueError('Invalid boot number %r' % (boot_num,))
+        return ['efibootmgr', '-B', '-b', boot_num]
+    if action == 'create':
+        fields = ['device', 'partition', 'label', 'loader', 'options']
+        for field in fields:
+            if not isinstance(entry.get(field), str):
+                raise ValueError('Invalid %s %r' % (field, entry.get(field)))
+        if not entry['device'].startswith('/dev/'):
+            raise ValueError('Invalid device %r' % entry['device'])
+        return [
+            'efibootmgr',
+            '-c',
+            '-d', entry['device'],
+            '-p', entry['partition'],
+            '-L', entry['label'],
+            '-l', entry['loader'],
+            '-u',
+            entry['options']
+        ]
+    raise ValueError('Unknown NVRAM action %r' % (action,))
 
 class NVRAM():
 
@@ -31,65 +71,92 @@ class NVRAM():
     nvram = []
     order_num = "0000"
 
-    def __init__(self, name, version):
+    def __init__(self, name, version, plan=None, backend=None, plugins=None,
+                 verbose=False):
         self.log = logging.getLogger('kernelstub.NVRAM')
         self.log.debug('loaded kernelstub.NVRAM')
 
+        self.plan = plan
+        self.backend = backend
+        if backend is None:
+            self.backend = SystemBackend()
+        self.plugins = plugins
+        if plugins is None:
+            self.plugins = Plugins()
+        self.changes = []
+        # The verbose listing includes each entry's device path.
+        self.verbose = verbose
+
         self.os_label = "%s %s" % (name, version)
         self.update()
 
     def update(self):
         self.log.debug('Updating NVRAM info')
-        self.nvram = self.get_nvram()
+        self.nvram = self.get_nvram(verbose=self.verbose)
         self.find_os_entry(self.nvram, self.os_label)
         if self.os_entry_index >= 0:
             self.order_num = str(self.nvram[self.os_entry_index])[4:8]
 
-    def get_nvram(self):
+    def get_nvram(self, verbose=False):
         self.log.debug('Getting NVRAM data')
         command = [
             'efibootmgr'
         ]
+        if verbose:
+            command.append('-v')
         try:
-            return subprocess.check_output(command).decode('UTF-8').split('\n')
+            return self.backend.run(command, check=True).split('\n')
         except Exception as e:
             self.log.exception('Failed to retrieve NVRAM data. Are you running in a chroot?')
             self.log.debug(e)
             return []
 
     def find_os_entry(self, nvram, os_label):
-        self.log.debug('Finding NVRAM entry for %s' % os_label)
+        self.log.debug('Finding NVRAM entry for %s', os_label)
         self.os_entry_index = -1
         find_index = self.os_entry_index
         for entry in nvram:
             find_index = find_index + 1
             if os_label in entry:
                 self.os_entry_index = find_index
-                self.log.debug('Entry found! Index: %s' % self.os_entry_index)
+                self.log.debug('Entry found! Index: %s', self.os_entry_index)
                 return find_index
 
 
-    def add_entry(self, this_os, this_drive, kernel_opts, simulate=False):
+    def add_entry(self, this_os, this_drive, kernel_opts, simulate=False,
+                  kernel='vmlinuz.efi', initrds=None):
         self.log.info('Creating NVRAM entry')
-        device = '/dev/%s' % this_drive.drive_name
-        esp_num = this_drive.esp_num
+        if initrds is None:
+            initrds = ['initrd.img']
         entry_label = '%s %s' % (this_os.name, this_os.version)
-        entry_linux = '\\EFI\\%s-%s\\vmlinuz.efi' % (this_os.name, this_drive.root_uuid)
-        entry_initrd = 'EFI/%s-%s/initrd.img' % (this_os.name, this_drive.root_uuid)
-        command = [
-            'efibootmgr',
-            '-c',
-            '-d', device,
-            '-p', esp_num,
-            '-L', '%s' % entry_label,
-            '-l', '%s' % entry_linux,
-            '-u',
-            'initrd=%s %s' % (entry_initrd, kernel_opts)
-        ]
-        self.log.debug('NVRAM command:\n%s' % command)
+        entry_linux = '\\EFI\\%s-%s\\%s' % (this_os.name, this_drive.root_uuid, kernel)
+        # The stub loads every initrd= argument and concatenates them.
+        entry_initrd = ' '.join(
+            'initrd=EFI/%s-%s/%s' % (this_os.name, this_drive.root_uuid, initrd)
+            for initrd in initrds)
+        self.create_entry(this_drive, entry_label, entry_linux,
+                          '%s %s' % (entry_initrd, kernel_opts), simulate)
+
+    def create_entry(self, this_drive, label, loader, options, simulate=False):
+        """Create an entry booting loader from this_drive's ESP."""
+        entry = {
+            'device' : '/dev/%s' % this_drive.drive_name,
+            'partition' : str(this_drive.esp_num),
+            'label' : label,
+            'loader' : loader,
+            'options' : options,
+        }
+        command = entry_command('create', entry)
+        self.log.debug('NVRAM command:\n%s', command)
+        if simulate and self.plan is not None:
+            self.plan.add_nvram(
+                'create', label,
+                self.estimate_entry_size(label, loader, options), entry)
         if not simulate:
+            self.plugins.run('before_nvram', 'create', command)
             try:
-                subprocess.run(command)
+                self.log.debug(self.backend.run(command))
+                self.changes.append(('create', label))
             except Exception as e:
                 self.log.exception('Couldn\'t create boot entry for kernel! ' +
                                    'This means that the system will not boot from ' +
@@ -98,22 +165,53 @@ class NVRAM():
                                    'this problem. More information is available in ' +
                                    'the log or by running again with -vv')
                 self.log.debug(e)
-                exit(172)
+                raise NVRAMError(
+                    'Couldn\'t create boot entry', exit_code=172) from e
+            self.plugins.run('after_nvram', 'create', command)
         self.update()
 
     def delete_boot_entry(self, index, simulate):
-        self.log.info('Deleting old boot entry: %s' % index)
-        command = ['efibootmgr',
-                   '-B',
-                   '-b', str(index)]
-        self.log.debug('NVRAM command:\n%s' % command)
+        self.log.info('Deleting old boot entry: %s', index)
+        entry = {'boot_num' : str(index)}
+        command = entry_command('delete', entry)
+        self.log.debug('NVRAM command:\n%s', command)
+        if simulate and self.plan is not None:
+            self.plan.add_nvram(
+                'delete', self.os_label, self.boot_order_size(), entry)
         if not simulate:
+            self.plugins.run('before_nvram', 'delete', command)
             try:
-                subprocess.run(command)
+                self.log.debug(self.backend.run(command))
+                self.changes.append(('delete', index))
             except Exception as e:
-                self.log.exception('Couldn\'t delete old boot entry %s. ' % index +
+                self.log.exception('Couldn\'t delete old boot entry %s. ' +
                                    'This could cause problems, so kernelstub will ' +
-                                   'not continue. Check again with -vv for more info.')
+                                   'not continue. Check again with -vv for more info.',
+                                   index)
                 self.log.debug(e)
-                exit(173)
+                raise NVRAMError(
+                    'Couldn\'t delete boot entry %s' % index,
+                    exit_code=173) from e
+            self.plugins.run('after_nvram', 'delete', command)
         self.update()
+
+    def boot_order_size(self):
+        # BootOrder is rewritten on every change: attributes plus two bytes
+        # for each Boot#### variable.
+        entries = [line for line in self.nvram if line[:4] == 'Boot'
+                   and len(line) > 8
+                   and all(char in string.hexdigits for char in line[4:8])]
+        return 4 + 2 * (len(entries) + 1)
+
+    def estimate_entry_size(self, label, loader, options):
+        # An EFI_LOAD_OPTION holds the description and file path as UCS-2,
+        # a 42 byte hard drive node, the end node and the optional data,
+        # which efibootmgr -u also stores as UCS-2.
+        load_option = (
+            4 + 2 +
+            (len(label) + 1) * 2 +
+            42 +
+            4 + (len(loader) + 1) * 2 +
+            4 +
+            len(options) * 2)
+        return 4 + load_option + self.boot_order_size()
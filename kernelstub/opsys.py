@@ -22,7 +22,9 @@ Please see the provided LICENSE.txt file for additional distribution/copyright
 terms.
 """
 
-import platform
+import platform, re
+
+from .backend import SystemBackend
 
 class OS():
 
@@ -40,60 +42,63 @@ class OS():
     old_kernel_path = '/vmlinuz.old'
     old_initrd_path = '/initrd.img.old'
 
-    def __init__(self):
+    # Characters we can't/don't want to have in technical names for the
+    # OS, and reserved DOS device names. name_pretty will still have them.
+    badchars = str.maketrans({
+        ' ' : '_',
+        '~' : '-',
+        '!' : '',
+        "'" : "",
+        '<' : '',
+        '>' : '',
+        ':' : '',
+        '"' : '',
+        '/' : '',
+        '\\' : '',
+        '|' : '',
+        '?' : '',
+        '*' : '',
+    })
+    badnames = re.compile(r'CON|PRN|AUX|NUL|COM[1-9]|LPT[1-9]')
+
+    def __init__(self, backend=None, facts=None):
+        self.backend = backend
+        if backend is None:
+            self.backend = SystemBackend()
+        self.os_release = None
+
+        key = None
+        cached = None
+        if facts is not None:
+            key = {'os_release' : facts.mtime('/etc/os-release')}
+            cached = facts.get('os', key)
+        if cached is not None:
+            self.name_pretty = cached['name_pretty']
+            self.name = cached['name']
+            self.version = cached['version']
+            self.cmdline = cached['cmdline']
+            return
+
         self.name_pretty = self.get_os_name()
         self.name = self.clean_names(self.name_pretty)
         self.version = self.get_os_version()
         self.cmdline = self.get_os_cmdline()
+        if facts is not None:
+            # /proc/cmdline can't change within a boot.
+            facts.put('os', key, {
+                'name_pretty' : self.name_pretty,
+                'name' : self.name,
+                'version' : self.version,
+                'cmdline' : self.cmdline,
+            })
 
     def clean_names(self, name):
-        # This is a list of characters we can't/don't want to have in technical
-        # names for the OS. name_pretty will still have them.
-        badchar = {
-            ' ' : '_',
-            '~' : '-',
-            '!' : '',
-            "'" : "",
-            '<' : '',
-            '>' : '',
-            ':' : '',
-            '"' : '',
-            '/' : '',
-            '\\' : '',
-            '|' : '',
-            '?' : '',
-            '*' : '',
-            'CON' : '',
-            'PRN' : '',
-            'AUX' : '',
-            'NUL' : '',
-            'COM1' : '',
-            'COM2' : '',
-            'COM3' : '',
-            'COM4' : '',
-            'COM5' : '',
-            'COM6' : '',
-            'COM7' : '',
-            'COM8' : '',
-            'COM9' : '',
-            'LPT1' : '',
-            'LPT2' : '',
-            'LPT3' : '',
-            'LPT4' : '',
-            'LPT5' : '',
-            'LPT6' : '',
-            'LPT7' : '',
-            'LPT8' : '',
-            'LPT9' : '',
-        }
-
-        for char in badchar:
-            name = name.replace(char, badchar[char])
-        return name
+        name = name.translate(self.badchars)
+        return self.badnames.sub('', name)
 
     def get_os_cmdline(self):
-        with open('/proc/cmdline') as cmdline_file:
-            cmdline_list = cmdline_file.readlines()[0].split(" ")
+        cmdline_text = self.backend.read_text('/proc/cmdline')
+        cmdline_list = cmdline_text.splitlines(keepends=True)[0].split(" ")
 
         cmdline = []
         for option in cmdline_list:
@@ -126,13 +131,17 @@ class OS():
         return new_value
 
     def get_os_release(self):
+        # Read once; the name and version both come from it.
+        if self.os_release is not None:
+            return self.os_release
         try:
-            with open('/etc/os-release') as os_release_file:
-                os_release = os_release_file.readlines()
+            os_release = self.backend.read_text(
+                '/etc/os-release').splitlines(keepends=True)
         except FileNotFoundError:
             os_release = ['NAME="%s"\n' % self.name,
                           'ID=linux\n',
                           'ID_LIKE=linux\n',
                           'VERSION_ID="%s"\n' % self.version]
 
+        self.os_release = os_release
         return os_release
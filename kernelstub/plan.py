@@ -0,0 +1,259 @@
+#!/usr/bin/python3
+
+"""
+ kernelstub
+ The automatic manager for using the Linux Kernel EFI Stub to boot
+
+ Copyright 2017-2018 Ian Santopietro <isantop@gmail.com>
+
+Permission to use, copy, modify, and/or distribute this software for any purpose
+with or without fee is hereby granted, provided that the above copyright notice
+and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS
+OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF
+THIS SOFTWARE.
+
+Please see the provided LICENSE.txt file for additional distribution/copyright
+terms.
+"""
+
+import gzip, hashlib, json, logging, os, shutil, subprocess, time
+
+from .backend import SystemBackend
+from .errors import KernelstubError
+from .initrd import SliceReader
+from .kernel_image import KernelImage
+from .nvram import entry_command
+
+class PlanError(KernelstubError):
+    exit_code = 178
+
+class Plan():
+
+    plan_rev = 3
+    chunk_size = 1048576
+
+    def __init__(self, backend=None):
+        self.log = logging.getLogger('kernelstub.Plan')
+        self.log.debug('loaded kernelstub.Plan')
+
+        self.backend = backend
+        if backend is None:
+            self.backend = SystemBackend()
+
+        self.created = int(time.time())
+        self.directories = []
+        self.artifacts = []
+        self.loader = []
+        self.nvram = []
+
+    def add_directory(self, path):
+        if path not in self.directories:
+            self.directories.append(path)
+
+    def add_artifact(self, action, src, dest, offset=0, length=None):
+        size, digest = self.hash_file(src)
+        written = size
+        if action == 'gunzip':
+            written = self.gzip_size(src)
+        elif action == 'unzboot':
+            written = length or 0
+        elif action == 'slice':
+            written = length
+        self.log.debug('Planned %s: %s => %s (%s bytes)', action, src, dest, written)
+        artifact = {
+            'action' : action,
+            'source' : src,
+            'source_size' : size,
+            'source_sha256' : digest,
+            'destination' : dest,
+            'bytes_written' : written,
+        }
+        if action == 'slice':
+            artifact['offset'] = offset
+            artifact['length'] = length
+        self.artifacts.append(artifact)
+
+    def add_loader_file(self, kind, path, contents):
+        self.log.debug('Planned %s: %s', kind, path)
+        self.loader = [item for item in self.loader if item['path'] != path]
+        self.loader.append({
+            'kind' : kind,
+            'path' : path,
+            'contents' : contents,
+            'bytes_written' : len(contents.encode('UTF-8')),
+        })
+
+    def add_nvram(self, action, label, estimated_bytes, entry):
+        # Only the fields are kept; apply() builds the command from them.
+        self.log.debug('Planned NVRAM %s: %s', action, label)
+        item = {
+            'action' : action,
+            'label' : label,
+            'estimated_bytes' : estimated_bytes,
+        }
+        item.update(entry)
+        self.nvram.append(item)
+
+    def totals(self):
+        return {
+            'esp_bytes_written' : (
+                sum(item['bytes_written'] for item in self.artifacts) +
+                sum(item['bytes_written'] for item in self.loader)),
+            'nvram_bytes_written' : sum(
+                item['estimated_bytes'] for item in self.nvram),
+            'nvram_writes' : len(self.nvram),
+        }
+
+    def to_dict(self):
+        return {
+            'plan_rev' : self.plan_rev,
+            'created' : self.created,
+            'directories' : self.directories,
+            'artifacts' : self.artifacts,
+            'loader' : self.loader,
+            'nvram' : self.nvram,
+            'totals' : self.totals(),
+        }
+
+    def save(self, path):
+        self.log.info('Saving execution plan to %s', path)
+        with open(path, mode='w') as plan_file:
+            json.dump(self.to_dict(), plan_file, indent=2)
+        return 0
+
+    def load(self, path):
+        self.log.info('Loading execution plan from %s', path)
+        try:
+            with open(path) as plan_file:
+                plan = json.load(plan_file)
+        except (OSError, ValueError) as e:
+            raise PlanError('Could not read the plan %s' % path) from e
+
+        if plan.get('plan_rev') != self.plan_rev:
+            raise PlanError('Unsupported plan revision: %s' % plan.get('plan_rev'))
+
+        self.created = plan['created']
+        self.directories = plan['directories']
+        self.artifacts = plan['artifacts']
+        self.loader = plan['loader']
+        self.nvram = plan['nvram']
+        return self
+
+    def apply(self):
+        self.log.info('Applying execution plan from %s', time.ctime(self.created))
+        for directory in self.directories:
+            try:
+                self.backend.makedirs(directory)
+            except OSError as e:
+                raise PlanError('Could not apply %s' % directory) from e
+
+        for artifact in self.artifacts:
+            self.apply_artifact(artifact)
+
+        for item in self.loader:
+            self.log.info('Writing %s %s', item['kind'], item['path'])
+            try:
+                self.backend.write_text(item['path'], item['contents'])
+            except OSError as e:
+                raise PlanError('Could not apply %s' % item['path']) from e
+
+        for item in self.nvram:
+            try:
+                command = entry_command(item['action'], item)
+                label = str(item['label'])
+            except (KeyError, TypeError, ValueError) as e:
+                raise PlanError('Malformed NVRAM change in the plan') from e
+            self.log.info('NVRAM %s: %s', item['action'], label)
+            if item['action'] == 'delete':
+                self.check_entry(item['boot_num'], label)
+            try:
+                self.backend.run(command, check=True)
+            except (OSError, subprocess.CalledProcessError) as e:
+                raise PlanError('NVRAM %s failed for %s' % (
+                    item['action'], label)) from e
+        return 0
+
+    def check_entry(self, boot_num, label):
+        # Entries can be added or renumbered between planning and applying,
+        # so Boot#### is only deleted while it still carries the planned label.
+        try:
+            listing = self.backend.run(['efibootmgr'], check=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            raise PlanError('Could not read the NVRAM') from e
+        for line in listing.splitlines():
+            if line[:8] == 'Boot%s' % boot_num:
+                if line[9:].split('\t')[0].strip() == label:
+                    return
+                break
+        raise PlanError('Boot%s is no longer %s, not deleting it' % (
+            boot_num, label))
+
+    def apply_artifact(self, artifact):
+        src = artifact['source']
+        dest = artifact['destination']
+        self.log.info('Applying %s: %s => %s', artifact['action'], src, dest)
+
+        try:
+            digest = self.hash_file(src)[1]
+        except OSError as e:
+            raise PlanError('Could not read %s' % src) from e
+        if digest != artifact['source_sha256']:
+            raise PlanError('%s changed since the plan was made' % src)
+
+        # Write next to the destination and move it into place, so a failed
+        # apply never leaves a truncated image on the ESP.
+        tmp_dest = '%s.kernelstub-tmp' % dest
+        try:
+            with open(tmp_dest, 'wb') as out_obj:
+                self.write_artifact(artifact, out_obj)
+            os.replace(tmp_dest, dest)
+        except (OSError, KernelstubError) as e:
+            raise PlanError('Could not apply %s' % dest) from e
+        finally:
+            if os.path.exists(tmp_dest):
+                os.remove(tmp_dest)
+
+    def write_artifact(self, artifact, out_obj):
+        """Write what artifact puts on the ESP to the file object out_obj."""
+        src = artifact['source']
+        if artifact['action'] == 'gunzip':
+            with gzip.open(src, 'rb') as in_obj:
+                shutil.copyfileobj(in_obj, out_obj, self.chunk_size)
+        elif artifact['action'] == 'unzboot':
+            image = KernelImage(src)
+            opener = image.opener(image.inspect())
+            with open(src, 'rb') as in_obj:
+                shutil.copyfileobj(opener(in_obj), out_obj, self.chunk_size)
+        elif artifact['action'] == 'slice':
+            with open(src, 'rb') as in_obj:
+                shutil.copyfileobj(
+                    SliceReader(in_obj, artifact['offset'], artifact['length']),
+                    out_obj, self.chunk_size)
+        else:
+            with open(src, 'rb') as in_obj:
+                shutil.copyfileobj(in_obj, out_obj, self.chunk_size)
+
+    def hash_file(self, path):
+        digest = hashlib.sha256()
+        size = 0
+        with open(path, 'rb') as in_obj:
+            while True:
+                data = in_obj.read(self.chunk_size)
+                if not data:
+                    break
+                size = size + len(data)
+                digest.update(data)
+        return size, digest.hexdigest()
+
+    def gzip_size(self, path):
+        # ISIZE, the last four bytes of a gzip member, is the uncompressed
+        # size modulo 2^32, which is plenty for a kernel image.
+        with open(path, 'rb') as in_obj:
+            in_obj.seek(-4, os.SEEK_END)
+            return int.from_bytes(in_obj.read(4), 'little')
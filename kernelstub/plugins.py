@@ -0,0 +1,140 @@
+#!/usr/bin/python3
+
+"""
+ kernelstub
+ The automatic manager for using the Linux Kernel EFI Stub to boot
+
+ Copyright 2017-2018 Ian Santopietro <isantop@gmail.com>
+
+Permission to use, copy, modify, and/or distribute this software for any purpose
+with or without fee is hereby granted, provided that the above copyright notice
+and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS
+OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF
+THIS SOFTWARE.
+
+Please see the provided LICENSE.txt file for additional distribution/copyright
+terms.
+"""
+
+
+import logging
+
+from .errors import KernelstubError
+
+entry_point_support = True
+try:
+    from importlib.metadata import entry_points
+
+except ImportError:
+    entry_point_support = False
+
+class PluginError(KernelstubError):
+    exit_code = 182
+
+class Plugin():
+    """Base class for kernelstub plugins; every stage is optional.
+
+    Plugins are installed as entry points in the kernelstub.plugins group,
+    naming either a class, which is created without arguments, or an
+    object. Artifacts are dictionaries of the metadata kernelstub already
+    has, so plugins never need to read the images again. Raising an
+    exception from a stage stops kernelstub with PluginError.
+    """
+
+    def select(self, artifacts):
+        """Called with the kernel, initrd, old_kernel and old_initrd picked
+        for installation ({'path', 'size', 'mtime', 'mtime_ns'} each).
+        Changing a path installs that file instead.
+        """
+
+    def before_write(self, artifact):
+        """Called before each file is written to the ESP, with its source,
+        destination and action (copy, gunzip, unzboot or write).
+        """
+
+    def after_write(self, artifact):
+        """Called after each file is written to the ESP; artifact now also
+        has size, bytes_written, sha256 and extents.
+        """
+
+    def loader_entry(self, path, contents):
+        """Return the contents to write to the loader entry at path."""
+        return contents
+
+    def before_nvram(self, action, command):
+        """Called before each NVRAM change ('create' or 'delete')."""
+
+    def after_nvram(self, action, command):
+        """Called after each NVRAM change."""
+
+class Plugins():
+
+    group = 'kernelstub.plugins'
+
+    def __init__(self, plugins=None):
+        self.log = logging.getLogger('kernelstub.Plugins')
+        self.log.debug('loaded kernelstub.Plugins')
+        self.plugins = list(plugins or [])
+
+    def __bool__(self):
+        return bool(self.plugins)
+
+    @classmethod
+    def load(cls, group=None):
+        """Return the plugins installed as entry points in group."""
+        plugins = cls()
+        if group is None:
+            group = cls.group
+        if not entry_point_support:
+            plugins.log.debug('importlib.metadata is unavailable, no plugins')
+            return plugins
+
+        found = entry_points()
+        if hasattr(found, 'select'):
+            found = found.select(group=group)
+        else:
+            found = found.get(group, [])
+
+        for entry_point in sorted(found, key=lambda entry: entry.name):
+            try:
+                plugin = entry_point.load()
+                if isinstance(plugin, type):
+                    plugin = plugin()
+            except Exception as e:
+                plugins.log.exception('Couldn\'t load the plugin %s',
+                                      entry_point.name)
+                raise PluginError(
+                    'Couldn\'t load the plugin %s' % entry_point.name) from e
+            plugins.log.info('Loaded plugin %s', entry_point.name)
+            plugins.plugins.append((entry_point.name, plugin))
+        return plugins
+
+    def run(self, stage, *args):
+        for name, plugin in self.plugins:
+            self.call(name, plugin, stage, *args)
+
+    def filter(self, stage, value, *args):
+        # Each plugin gets the value returned by the one before it.
+        for name, plugin in self.plugins:
+            result = self.call(name, plugin, stage, *(args + (value,)))
+            if result is not None:
+                value = result
+        return value
+
+    def call(self, name, plugin, stage, *args):
+        method = getattr(plugin, stage, None)
+        if method is None:
+            return None
+        self.log.debug('Running plugin %s: %s', name, stage)
+        try:
+            return method(*args)
+        except Exception as e:
+            self.log.exception('The plugin %s failed in %s', name, stage)
+            raise PluginError(
+                'The plugin %s failed in %s' % (name, stage)) from e
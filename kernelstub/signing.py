@@ -0,0 +1,150 @@
+#!/usr/bin/python3
+
+"""
+ kernelstub
+ The automatic manager for using the Linux Kernel EFI Stub to boot
+
+ Copyright 2017-2018 Ian Santopietro <isantop@gmail.com>
+
+Permission to use, copy, modify, and/or distribute this software for any purpose
+with or without fee is hereby granted, provided that the above copyright notice
+and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS
+OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF
+THIS SOFTWARE.
+
+Please see the provided LICENSE.txt file for additional distribution/copyright
+terms.
+"""
+
+
+import base64, hashlib, logging, os, shutil, subprocess
+
+from .errors import KernelstubError
+
+class SigningError(KernelstubError):
+    exit_code = 181
+
+class Signer():
+    """Sign kernels for Secure Boot with sbsign, caching the results.
+
+    Signed images are named after the hash of the unsigned image and the
+    certificate's fingerprint, so an unchanged kernel signed with the same
+    key is never signed twice.
+    """
+
+    chunk_size = 1048576
+    cache_size = 8
+
+    def __init__(self, key, cert, cache_dir='/var/lib/kernelstub/signed'):
+        self.log = logging.getLogger('kernelstub.Signer')
+        self.log.debug('loaded kernelstub.Signer')
+
+        self.key = key
+        self.cert = cert
+        self.cache_dir = cache_dir
+        self._fingerprint = None
+
+    def fingerprint(self):
+        # The SHA-256 of the certificate's DER encoding, the same value
+        # `openssl x509 -fingerprint -sha256` prints.
+        if self._fingerprint is None:
+            try:
+                with open(self.cert, 'rb') as cert_file:
+                    data = cert_file.read()
+            except OSError as e:
+                raise SigningError(
+                    'Could not read the signing certificate %s' % self.cert) from e
+            if b'-----BEGIN CERTIFICATE-----' in data:
+                body = data.split(b'-----BEGIN CERTIFICATE-----', 1)[1]
+                body = body.split(b'-----END CERTIFICATE-----', 1)[0]
+                data = base64.b64decode(b''.join(body.split()))
+            self._fingerprint = hashlib.sha256(data).hexdigest()
+        return self._fingerprint
+
+    def cache_path(self, path, variant=None):
+        name = '%s-%s' % (self.hash_file(path), self.fingerprint()[:16])
+        if variant:
+            name = '%s-%s' % (name, variant)
+        return os.path.join(self.cache_dir, '%s.efi' % name)
+
+    def sign(self, path, opener=None, variant=None):
+        """Return the path of a signed copy of the kernel at path.
+
+        opener works as in Transfer.copy(), for kernels that have to be
+        decompressed before signing; variant tells apart differently
+        unpacked images of the same file in the cache.
+        """
+        try:
+            signed = self.cache_path(path, variant)
+        except OSError as e:
+            raise SigningError('Could not read %s' % path) from e
+
+        if os.path.exists(signed):
+            self.log.info('Using cached signed kernel %s', signed)
+            os.utime(signed)
+            return signed
+
+        os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+        unsigned = path
+        tmp_signed = '%s.tmp' % signed
+        tmp_unsigned = '%s.unsigned' % signed
+        try:
+            if opener is not None:
+                # sbsign needs the PE image itself, not the file around it.
+                with open(path, 'rb') as file_obj:
+                    with open(tmp_unsigned, 'wb') as out_obj:
+                        shutil.copyfileobj(
+                            opener(file_obj), out_obj, self.chunk_size)
+                unsigned = tmp_unsigned
+
+            command = ['sbsign', '--key', self.key, '--cert', self.cert,
+                       '--output', tmp_signed, unsigned]
+            self.log.info('Signing %s', path)
+            self.log.debug('Signing command: %s', command)
+            subprocess.run(command, check=True, stdout=subprocess.PIPE,
+                           stderr=subprocess.STDOUT)
+            os.replace(tmp_signed, signed)
+        except subprocess.CalledProcessError as e:
+            self.log.debug(e.output)
+            raise SigningError('sbsign failed to sign %s' % path) from e
+        except (OSError, EOFError, KernelstubError) as e:
+            raise SigningError('Could not sign %s' % path) from e
+        finally:
+            for tmp_path in (tmp_signed, tmp_unsigned):
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+
+        self.prune()
+        return signed
+
+    def prune(self):
+        # Keep the most recently used images; older kernels are removed
+        # from /boot eventually and their signatures are never needed again.
+        try:
+            entries = [entry for entry in os.scandir(self.cache_dir)
+                       if entry.name.endswith('.efi')]
+        except OSError:
+            return
+        entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+        for entry in entries[self.cache_size:]:
+            self.log.debug('Removing cached signed kernel %s', entry.path)
+            try:
+                os.remove(entry.path)
+            except OSError as e:
+                self.log.debug(e)
+
+    def hash_file(self, path):
+        digest = hashlib.sha256()
+        with open(path, 'rb') as in_obj:
+            while True:
+                data = in_obj.read(self.chunk_size)
+                if not data:
+                    break
+                digest.update(data)
+        return digest.hexdigest()
@@ -0,0 +1,70 @@
+#!/usr/bin/python3
+
+"""
+ kernelstub
+ The automatic manager for using the Linux Kernel EFI Stub to boot
+
+ Copyright 2017-2018 Ian Santopietro <isantop@gmail.com>
+
+Permission to use, copy, modify, and/or distribute this software for any purpose
+with or without fee is hereby granted, provided that the above copyright notice
+and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS
+OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF
+THIS SOFTWARE.
+
+Please see the provided LICENSE.txt file for additional distribution/copyright
+terms.
+"""
+
+import json, logging, os
+
+from .backend import SystemBackend
+
+class State():
+
+    state_dir = '/var/lib/kernelstub'
+
+    def __init__(self, state_dir='/var/lib/kernelstub', backend=None):
+        self.log = logging.getLogger('kernelstub.State')
+        self.log.debug('loaded kernelstub.State')
+        self.state_dir = state_dir
+        self.backend = backend
+        if backend is None:
+            self.backend = SystemBackend()
+
+    def path(self, name):
+        return os.path.join(self.state_dir, name)
+
+    def load(self, name, default=None):
+        try:
+            return json.loads(self.backend.read_text(self.path(name)))
+        except FileNotFoundError:
+            return default
+        except (OSError, ValueError) as e:
+            self.log.warning('Ignoring unreadable state file %s', self.path(name))
+            self.log.debug(e)
+            return default
+
+    def save(self, name, data):
+        # Write a new file and rename it over the old one, so readers never
+        # see a partially written state file.
+        self.backend.makedirs(self.state_dir)
+        tmp_path = '%s.tmp' % self.path(name)
+        self.backend.write_text(tmp_path, json.dumps(data, indent=2))
+        self.backend.rename(tmp_path, self.path(name))
+        self.log.debug('Saved state %s', self.path(name))
+        return 0
+
+    def remove(self, name):
+        try:
+            self.backend.remove(self.path(name))
+            self.log.debug('Removed state %s', self.path(name))
+        except FileNotFoundError:
+            pass
+        return 0
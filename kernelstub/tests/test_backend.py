@@ -0,0 +1,134 @@
+"""
+ kernelstub
+ The automatic manager for using the Linux Kernel EFI Stub to boot
+
+ Copyright 2017-2018 Ian Santopietro <isantop@gmail.com>
+
+Permission to use, copy, modify, and/or distribute this software for any purpose
+with or without fee is hereby granted, provided that the above copyright notice
+and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS
+OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF
+THIS SOFTWARE.
+
+Please see the provided LICENSE.txt file for additional distribution/copyright
+terms.
+"""
+
+import os, shutil, struct, tempfile, unittest
+from unittest import mock
+
+from kernelstub.application import Kernelstub, Options
+from kernelstub.backend import MemoryBackend
+from kernelstub.plan import Plan, PlanError
+from kernelstub.plugins import Plugins
+
+ROOT_UUID = '12345678-1234-1234-1234-123456789abc'
+OLD_UUID = '87654321-4321-4321-4321-cba987654321'
+
+def make_kernel(path):
+    # Just enough of a PE image to pass as an EFI stub kernel.
+    image = bytearray(4096)
+    image[0:2] = b'MZ'
+    struct.pack_into('<I', image, 0x3c, 0x40)
+    image[0x40:0x44] = b'PE\0\0'
+    struct.pack_into('<HH', image, 0x44, 0x8664, 0)
+    with open(path, 'wb') as out_file:
+        out_file.write(bytes(image) + b'Linux version 6.1.0-test ')
+
+class TestMemoryBackend(unittest.TestCase):
+
+    def setUp(self):
+        # Kernel images are the only thing read from the real filesystem.
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        boot = os.path.join(self.root, 'boot')
+        os.mkdir(boot)
+        make_kernel(os.path.join(boot, 'vmlinuz-6.1.0-test'))
+        with open(os.path.join(boot, 'initrd.img-6.1.0-test'), 'wb') as out_file:
+            out_file.write(b'initrd' * 100)
+
+        self.backend = MemoryBackend.layout(
+            name='Pop!_OS', version='22.04', root_uuid=ROOT_UUID,
+            boot_entries={1 : 'Windows Boot Manager'})
+        mounts = self.backend.files['/proc/mounts']
+        self.backend.files['/proc/mounts'] = mounts.replace(
+            ' / ', ' %s ' % self.root)
+        self.backend.uuids[self.root] = self.backend.uuids.pop('/')
+
+        self.kernelstub = Kernelstub()
+        self.kernelstub.backend = self.backend
+        self.kernelstub.plugins = Plugins()
+
+        # Anything still reaching for the host fails the test.
+        patcher = mock.patch('subprocess.run', side_effect=AssertionError(
+            'ran a program outside the backend'))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def add_esp_dir(self, uuid, entry=False):
+        directory = '/boot/efi/EFI/Pop_OS-%s' % uuid
+        self.backend.makedirs(directory)
+        self.backend.write_text('%s/vmlinuz.efi' % directory, 'kernel')
+        if entry:
+            self.backend.makedirs('/boot/efi/loader/entries')
+            self.backend.write_text(
+                '/boot/efi/loader/entries/Pop_OS-old.conf',
+                'title Pop!_OS\nlinux /EFI/Pop_OS-%s/vmlinuz.efi\n' % uuid)
+        return directory
+
+    def test_dry_run(self):
+        result = self.kernelstub.run(Options(
+            root_path=self.root, dry_run=True, setup_loader=True))
+        self.assertEqual(result.status, 'complete')
+
+        esp_dir = '/boot/efi/EFI/Pop_OS-%s' % ROOT_UUID
+        self.assertEqual(
+            [artifact['destination'] for artifact in result.plan.artifacts],
+            ['%s/vmlinuz.efi' % esp_dir, '%s/initrd.img' % esp_dir])
+        self.assertEqual(len(result.plan.nvram), 1)
+        entry = result.plan.nvram[0]
+        self.assertEqual(entry['action'], 'create')
+        self.assertEqual(entry['device'], '/dev/sda')
+        self.assertEqual(entry['loader'], '\\EFI\\Pop_OS-%s\\vmlinuz.efi' % ROOT_UUID)
+        self.assertNotIn('command', entry)
+
+        # Nothing was written and the firmware was only read.
+        self.assertFalse(self.backend.exists(esp_dir))
+        self.assertEqual(self.backend.efibootmgr.entries,
+                         {1 : 'Windows Boot Manager'})
+        for command in self.backend.history:
+            self.assertNotIn('-c', command)
+            self.assertNotIn('-B', command)
+
+    def test_gc(self):
+        orphan = self.add_esp_dir(OLD_UUID)
+        current = self.add_esp_dir(ROOT_UUID)
+        result = self.kernelstub.run(Options(root_path=self.root, gc=True))
+        self.assertEqual(result.status, 'esp_report')
+        self.assertFalse(self.backend.exists(orphan))
+        self.assertTrue(self.backend.exists('%s/vmlinuz.efi' % current))
+
+    def test_gc_keeps_loader_entries(self):
+        directory = self.add_esp_dir(OLD_UUID, entry=True)
+        self.kernelstub.run(Options(root_path=self.root, gc=True))
+        self.assertTrue(self.backend.exists('%s/vmlinuz.efi' % directory))
+
+    def test_apply_plan_checks_label(self):
+        self.backend.efibootmgr.entries[2] = 'Pop!_OS 22.04'
+        self.backend.efibootmgr.order.append(2)
+        plan = Plan(backend=self.backend)
+        plan.nvram = [{'action' : 'delete', 'label' : 'Pop!_OS 22.04',
+                       'boot_num' : '0001', 'estimated_bytes' : 8}]
+        with self.assertRaises(PlanError):
+            plan.apply()
+        self.assertIn(1, self.backend.efibootmgr.entries)
+
+        plan.nvram[0]['boot_num'] = '0002'
+        plan.apply()
+        self.assertNotIn(2, self.backend.efibootmgr.entries)
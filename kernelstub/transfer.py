@@ -0,0 +1,471 @@
+#!/usr/bin/python3
+
+"""
+ kernelstub
+ The automatic manager for using the Linux Kernel EFI Stub to boot
+
+ Copyright 2017-2018 Ian Santopietro <isantop@gmail.com>
+
+Permission to use, copy, modify, and/or distribute this software for any purpose
+with or without fee is hereby granted, provided that the above copyright notice
+and this permission notice appear in all copies.
+
+THE SOFTWARE IS PROVIDED "AS IS" AND THE AUTHOR DISCLAIMS ALL WARRANTIES WITH
+REGARD TO THIS SOFTWARE INCLUDING ALL IMPLIED WARRANTIES OF MERCHANTABILITY AND
+FITNESS. IN NO EVENT SHALL THE AUTHOR BE LIABLE FOR ANY SPECIAL, DIRECT,
+INDIRECT, OR CONSEQUENTIAL DAMAGES OR ANY DAMAGES WHATSOEVER RESULTING FROM LOSS
+OF USE, DATA OR PROFITS, WHETHER IN AN ACTION OF CONTRACT, NEGLIGENCE OR OTHER
+TORTIOUS ACTION, ARISING OUT OF OR IN CONNECTION WITH THE USE OR PERFORMANCE OF
+THIS SOFTWARE.
+
+Please see the provided LICENSE.txt file for additional distribution/copyright
+terms.
+"""
+
+import ctypes, ctypes.util, fcntl, gzip, hashlib, logging, mmap, os, shutil
+import struct, subprocess, time
+
+from .errors import KernelstubError
+
+class TransferError(KernelstubError):
+    exit_code = 180
+
+class Blocks():
+    """Hashes a stream in fixed-size blocks for delta updates."""
+
+    block_size = 262144
+
+    def __init__(self):
+        self.hashes = []
+        self.pending = bytearray()
+        self.size = 0
+
+    def digest(self, data):
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+    def update(self, data):
+        self.size = self.size + len(data)
+        self.pending.extend(data)
+        while len(self.pending) >= self.block_size:
+            self.hashes.append(self.digest(self.pending[:self.block_size]))
+            del self.pending[:self.block_size]
+
+    def add_block(self, data):
+        # For callers that already read whole blocks (or the short last one).
+        block_hash = self.digest(data)
+        self.hashes.append(block_hash)
+        self.size = self.size + len(data)
+        return block_hash
+
+    def finish(self):
+        if self.pending:
+            self.hashes.append(self.digest(self.pending))
+            self.pending = bytearray()
+        return self.hashes
+
+class Transfer():
+
+    chunk_size = 1048576
+    idle_priority_set = False
+
+    # linux/fiemap.h
+    FS_IOC_FIEMAP = 0xc020660b
+    FIEMAP_FLAG_SYNC = 0x1
+    # linux/falloc.h
+    FALLOC_FL_KEEP_SIZE = 0x1
+
+    libc = None
+
+    def __init__(self, low_impact=False, rate_limit=0, verify=False,
+                 delta=False, manifests=None, hashing=False, defragment=False):
+        self.log = logging.getLogger('kernelstub.Transfer')
+        self.log.debug('loaded kernelstub.Transfer')
+
+        self.low_impact = low_impact
+        self.verify = verify
+        # Copies are hashed on the way for verification, or for anyone else
+        # who wants the digests.
+        self.hashing = hashing or verify
+        self.rate_limit = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+        self.digests = {}
+        self.delta = delta
+        self.defragment = defragment
+        self.extents = {}
+        self.manifests = manifests
+        if self.manifests is None:
+            self.manifests = {}
+        if low_impact:
+            self.rate_limit = rate_limit
+            self.set_idle_priority()
+
+    def set_idle_priority(self):
+        # Move the whole process into the idle I/O scheduling class, so our
+        # reads and writes only get disk time nobody else wants.
+        if Transfer.idle_priority_set:
+            return
+        command = ['ionice', '-c', '3', '-p', str(os.getpid())]
+        self.log.debug('Setting idle I/O priority: %s', command)
+        try:
+            subprocess.run(command, check=True)
+            Transfer.idle_priority_set = True
+        except (OSError, subprocess.CalledProcessError) as e:
+            self.log.warning('Couldn\'t set idle I/O priority, continuing.')
+            self.log.debug(e)
+
+    def copy(self, src, dest, decompress=False, opener=None, size=None):
+        """Copy src to dest, returning dest and the bytes written.
+
+        decompress gunzips src on the way; opener, if given, is called with
+        the open source file and returns the reader to copy from instead.
+        size is the expected size of dest, if known, for preallocation.
+        """
+        if os.path.isdir(dest):
+            dest = os.path.join(dest, os.path.basename(src))
+        if size is None:
+            size = self.expected_size(src, decompress, opener)
+        if decompress and opener is None:
+            opener = lambda file_obj: gzip.GzipFile(fileobj=file_obj, mode='rb')
+
+        dest, written, digest = self.copy_once(src, dest, opener, size)
+        if self.verify:
+            if self.read_back(dest) != digest:
+                # One retry covers a transient write error; a second
+                # mismatch means the ESP can't be trusted.
+                self.log.warning('%s failed verification, copying again.', dest)
+                self.manifests.pop(dest, None)
+                dest, written, digest = self.copy_once(src, dest, opener, size)
+                if self.read_back(dest) != digest:
+                    self.log.error('%s is corrupt after copying %s', dest, src)
+                    raise TransferError('Verification of %s failed' % dest)
+            self.log.debug('Verified %s: %s', dest, digest)
+
+        if digest is not None:
+            self.digests[dest] = {
+                'source' : src,
+                'size' : os.path.getsize(dest),
+                'sha256' : digest,
+            }
+            if self.verify:
+                self.digests[dest]['verified'] = int(time.time())
+
+        if opener is None:
+            shutil.copymode(src, dest)
+        self.check_layout(dest, digest)
+        return dest, written
+
+    def rename(self, src, dest):
+        """Move a file written by copy() to dest, along with its records."""
+        os.replace(src, dest)
+        for records in (self.digests, self.manifests, self.extents):
+            if src in records:
+                records[dest] = records.pop(src)
+        return dest
+
+    def expected_size(self, src, decompress, opener):
+        try:
+            if decompress:
+                # ISIZE, the uncompressed size modulo 2^32, ends a gzip member.
+                with open(src, 'rb') as in_obj:
+                    in_obj.seek(-4, os.SEEK_END)
+                    return int.from_bytes(in_obj.read(4), 'little')
+            if opener is None:
+                return os.path.getsize(src)
+        except OSError:
+            pass
+        return None
+
+    def copy_once(self, src, dest, opener, size=None):
+        if self.delta and opener is None:
+            manifest = self.delta_manifest(src, dest)
+            if manifest is not None:
+                return self.copy_delta(src, dest, manifest)
+
+        digest = None
+        if self.hashing:
+            digest = hashlib.sha256()
+        blocks = None
+        if self.delta:
+            blocks = Blocks()
+
+        with open(src, 'rb') as src_obj:
+            in_obj = src_obj
+            if opener is not None:
+                in_obj = opener(src_obj)
+            with open(dest, 'wb') as out_obj:
+                preallocated = self.preallocate(out_obj.fileno(), size)
+                if self.low_impact:
+                    self.advise(src_obj, os.POSIX_FADV_NOREUSE)
+                    self.advise(out_obj, os.POSIX_FADV_NOREUSE)
+                written = self.stream(in_obj, out_obj, digest, blocks)
+                if preallocated and written < size:
+                    # Release the clusters reserved past the end.
+                    out_obj.truncate(written)
+                self.finish_writing(out_obj.fileno())
+                if self.low_impact:
+                    self.advise(src_obj, os.POSIX_FADV_DONTNEED)
+            self.bytes_read = self.bytes_read + src_obj.tell()
+        self.bytes_written = self.bytes_written + written
+
+        if blocks is not None:
+            self.record_manifest(dest, blocks)
+        if digest is not None:
+            digest = digest.hexdigest()
+        return dest, written, digest
+
+    def delta_manifest(self, src, dest):
+        """Return the block manifest of dest if dest can be updated in place.
+
+        The manifest is only trusted while dest is exactly as we left it,
+        and in-place updates only handle sources of the same size.
+        """
+        manifest = self.manifests.get(dest)
+        if manifest is None or manifest['block_size'] != Blocks.block_size:
+            return None
+        try:
+            dest_stat = os.stat(dest)
+            src_size = os.path.getsize(src)
+        except OSError:
+            return None
+        if (dest_stat.st_size != manifest['size'] or
+                dest_stat.st_mtime_ns != manifest['mtime_ns']):
+            self.log.debug('%s changed since its manifest was recorded', dest)
+            return None
+        if src_size != manifest['size']:
+            self.log.debug('%s changed size, copying it in full', src)
+            return None
+        return manifest
+
+    def copy_delta(self, src, dest, manifest):
+        """Rewrite only the blocks of dest that differ from src."""
+        digest = None
+        if self.hashing:
+            digest = hashlib.sha256()
+        blocks = Blocks()
+        old_hashes = manifest['blocks']
+        block_size = Blocks.block_size
+
+        written = 0
+        offset = 0
+        start = time.monotonic()
+        with open(src, 'rb') as src_obj:
+            if self.low_impact:
+                self.advise(src_obj, os.POSIX_FADV_NOREUSE)
+            fd = os.open(dest, os.O_WRONLY)
+            try:
+                while True:
+                    data = src_obj.read(block_size)
+                    if not data:
+                        break
+                    if digest is not None:
+                        digest.update(data)
+                    block_hash = blocks.add_block(data)
+                    index = offset // block_size
+                    if (index >= len(old_hashes) or
+                            block_hash != old_hashes[index]):
+                        os.pwrite(fd, data, offset)
+                        written = written + len(data)
+                        self.throttle(written, start)
+                    offset = offset + len(data)
+                self.finish_writing(fd)
+            finally:
+                os.close(fd)
+            if self.low_impact:
+                self.advise(src_obj, os.POSIX_FADV_DONTNEED)
+        self.bytes_read = self.bytes_read + offset
+        self.bytes_written = self.bytes_written + written
+        self.log.info('Delta update of %s: %s of %s bytes rewritten',
+                      dest, written, offset)
+
+        self.record_manifest(dest, blocks)
+        if digest is not None:
+            digest = digest.hexdigest()
+        return dest, written, digest
+
+    def record_manifest(self, dest, blocks):
+        self.manifests[dest] = {
+            'block_size' : Blocks.block_size,
+            'size' : blocks.size,
+            'mtime_ns' : os.stat(dest).st_mtime_ns,
+            'blocks' : blocks.finish(),
+        }
+
+    def fallocate(self):
+        if Transfer.libc is None:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            call = getattr(libc, 'fallocate64', None) or libc.fallocate
+            call.argtypes = [ctypes.c_int, ctypes.c_int,
+                             ctypes.c_int64, ctypes.c_int64]
+            call.restype = ctypes.c_int
+            Transfer.libc = call
+        return Transfer.libc
+
+    def preallocate(self, fd, size):
+        # Allocating the whole file up front lets the filesystem pick one
+        # contiguous run of clusters, which firmware FAT drivers read fastest.
+        # Only KEEP_SIZE is used: mode 0 on vfat extends the file by writing
+        # zeros, so every byte would hit the ESP twice.
+        if not size or not (self.low_impact or self.defragment):
+            return False
+        try:
+            fallocate = self.fallocate()
+        except (OSError, AttributeError) as e:
+            self.log.debug('fallocate unavailable: %s', e)
+            return False
+        if fallocate(fd, self.FALLOC_FL_KEEP_SIZE, 0, size) != 0:
+            self.log.debug('Couldn\'t preallocate %s bytes: %s', size,
+                           os.strerror(ctypes.get_errno()))
+            return False
+        return True
+
+    def count_extents(self, path):
+        """Return how many extents path is stored in, or None if the
+        filesystem can't tell.
+        """
+        # struct fiemap with fm_extent_count = 0 only counts the extents.
+        request = bytearray(struct.pack(
+            '=QQIIII', 0, 0xffffffffffffffff, self.FIEMAP_FLAG_SYNC, 0, 0, 0))
+        try:
+            with open(path, 'rb') as in_obj:
+                fcntl.ioctl(in_obj.fileno(), self.FS_IOC_FIEMAP, request, True)
+        except OSError as e:
+            self.log.debug('FIEMAP failed for %s: %s', path, e)
+            return None
+        return struct.unpack_from('=I', request, 20)[0]
+
+    def check_layout(self, dest, digest):
+        extents = self.count_extents(dest)
+        if extents is None:
+            return
+        if extents > 1:
+            self.log.info('%s is fragmented into %s extents', dest, extents)
+            if self.defragment:
+                extents = self.rewrite_contiguous(dest, extents, digest)
+        else:
+            self.log.debug('%s is contiguous', dest)
+        self.extents[dest] = extents
+
+    def rewrite_contiguous(self, dest, extents, digest):
+        """Copy a fragmented dest into freshly allocated space, keeping the
+        copy only if it has fewer extents. Returns the resulting count.
+        """
+        size = os.path.getsize(dest)
+        stat = os.statvfs(os.path.dirname(dest))
+        if stat.f_bavail * stat.f_frsize < size * 2:
+            # Without plenty of room the new copy would fragment as well.
+            self.log.info('Not enough free space to defragment %s', dest)
+            return extents
+
+        tmp_dest = '%s.kernelstub-defrag' % dest
+        try:
+            with open(dest, 'rb') as in_obj:
+                with open(tmp_dest, 'wb') as out_obj:
+                    self.preallocate(out_obj.fileno(), size)
+                    written = self.stream(in_obj, out_obj)
+                    os.fdatasync(out_obj.fileno())
+            self.bytes_read = self.bytes_read + size
+            self.bytes_written = self.bytes_written + written
+            new_extents = self.count_extents(tmp_dest)
+            if new_extents is None or new_extents >= extents:
+                self.log.info('Couldn\'t find contiguous space for %s', dest)
+                return extents
+            if digest is not None and self.verify:
+                if self.read_back(tmp_dest) != digest:
+                    self.log.warning('Defragmented copy of %s is corrupt', dest)
+                    return extents
+            shutil.copymode(dest, tmp_dest)
+            os.replace(tmp_dest, dest)
+        except OSError as e:
+            self.log.warning('Couldn\'t defragment %s', dest)
+            self.log.debug(e)
+            return extents
+        finally:
+            if os.path.exists(tmp_dest):
+                os.remove(tmp_dest)
+
+        # The contents are unchanged, so the block manifest still applies.
+        if dest in self.manifests:
+            self.manifests[dest]['mtime_ns'] = os.stat(dest).st_mtime_ns
+        self.log.info('Rewrote %s from %s extents into %s', dest, extents,
+                      new_extents)
+        return new_extents
+
+    def finish_writing(self, fd):
+        if self.low_impact or self.verify:
+            # Pages have to be clean before the kernel will drop them, and
+            # the read-back has to come from the disk, so flush first.
+            os.fdatasync(fd)
+            self.advise(fd, os.POSIX_FADV_DONTNEED)
+
+    def read_back(self, path):
+        """Hash path as stored on the disk rather than in the page cache.
+
+        O_DIRECT needs an aligned buffer, which an anonymous mmap provides.
+        Filesystems that refuse O_DIRECT get a cache drop and a normal read.
+        """
+        fd = None
+        if hasattr(os, 'O_DIRECT'):
+            try:
+                fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+            except OSError as e:
+                self.log.debug('O_DIRECT unavailable for %s: %s', path, e)
+
+        if fd is not None:
+            digest = hashlib.sha256()
+            try:
+                with mmap.mmap(-1, self.chunk_size) as buf:
+                    while True:
+                        length = os.readv(fd, [buf])
+                        if not length:
+                            break
+                        self.bytes_read = self.bytes_read + length
+                        digest.update(buf[:length])
+                return digest.hexdigest()
+            except OSError as e:
+                self.log.debug('O_DIRECT read of %s failed: %s', path, e)
+            finally:
+                os.close(fd)
+
+        digest = hashlib.sha256()
+        with open(path, 'rb') as in_obj:
+            self.advise(in_obj, os.POSIX_FADV_DONTNEED)
+            while True:
+                data = in_obj.read(self.chunk_size)
+                if not data:
+                    break
+                self.bytes_read = self.bytes_read + len(data)
+                digest.update(data)
+        return digest.hexdigest()
+
+    def stream(self, in_obj, out_obj, digest=None, blocks=None):
+        written = 0
+        start = time.monotonic()
+        while True:
+            data = in_obj.read(self.chunk_size)
+            if not data:
+                break
+            out_obj.write(data)
+            if digest is not None:
+                digest.update(data)
+            if blocks is not None:
+                blocks.update(data)
+            written = written + len(data)
+            self.throttle(written, start)
+        out_obj.flush()
+        return written
+
+    def throttle(self, written, start):
+        if self.rate_limit:
+            ahead = written / self.rate_limit - (time.monotonic() - start)
+            if ahead > 0:
+                time.sleep(ahead)
+
+    def advise(self, file_obj, advice):
+        fd = file_obj
+        if not isinstance(fd, int):
+            fd = file_obj.fileno()
+        try:
+            os.posix_fadvise(fd, 0, 0, advice)
+        except OSError as e:
+            self.log.debug('posix_fadvise failed: %s', e)
@@ -21,7 +21,7 @@ Portions of test-related code authored by Jason DeRose <jason@system76.com>
 
 from setuptools import setup
 from setuptools import Command
-import os, subprocess, sys
+import os, subprocess, sys, unittest
 
 TREE = os.path.dirname(os.path.abspath(__file__))
 DIRS = [
@@ -52,23 +52,33 @@ def run_pyflakes3():
     args = [os.path.join(TREE, name) for name in names]
     run_under_same_interpreter('flakes', script, args)
 
+def run_unittests():
+    suite = unittest.TestLoader().discover(
+        os.path.join(TREE, 'kernelstub', 'tests'), top_level_dir=TREE)
+    result = unittest.TextTestRunner(verbosity=2).run(suite)
+    if not result.wasSuccessful():
+        sys.exit(2)
 
 
 class Test(Command):
-    description = 'run pyflakes3'
+    description = 'run unit tests and pyflakes3'
 
     user_options = [
         ('skip-flakes', None, 'do not run pyflakes static checks'),
+        ('skip-unittests', None, 'do not run the unit tests'),
     ]
 
     def initialize_options(self):
         self.skip_sphinx = 0
         self.skip_flakes = 0
+        self.skip_unittests = 0
 
     def finalize_options(self):
         pass
 
     def run(self):
+        if not self.skip_unittests:
+            run_unittests()
         if not self.skip_flakes:
             run_pyflakes3()
 
@@ -85,5 +95,7 @@ setup(name='kernelstub',
     data_files=[
         ('/etc/kernel/postinst.d', ['data/kernel/zz-kernelstub']),
         ('/etc/initramfs/post-update.d', ['data/initramfs/zz-kernelstub']),
+        ('/lib/systemd/system', ['data/systemd/kernelstub-boottime.service',
+                                  'data/systemd/kernelstub-commit.service']),
         ('/etc/default', ['data/config/kernelstub.SAMPLE'])]
     )